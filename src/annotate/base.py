@@ -1,20 +1,18 @@
 import abc
-import base64
 import dataclasses
 import pathlib
 import typing
 
-import dotenv
 import openai
 from openai.types.chat import ChatCompletionContentPartTextParam, ChatCompletionContentPartImageParam, \
     ChatCompletionUserMessageParam, ChatCompletionDeveloperMessageParam
 from openai.types.chat.chat_completion_content_part_image_param import ImageURL
 
+import cache
 import data
+import images
 import prompts
 
-dotenv.load_dotenv()
-
 
 @dataclasses.dataclass
 class LLMAnnotation:
@@ -30,13 +28,17 @@ class BaseParser(abc.ABC):
 
 class BaseAnnotator(abc.ABC):
     def __init__(self, client: openai.OpenAI, model: str,
-                 reasoning_effort: typing.Literal["minimal", "low", "medium", "high"] = "minimal"):
+                 reasoning_effort: typing.Literal["minimal", "low", "medium", "high"] = "minimal",
+                 response_cache: typing.Optional[cache.ResponseCache] = None,
+                 prompt_layout: prompts.PromptLayout = "default"):
         self.client = client
         self.model = model
         self.prompt_template = self.get_prompt_template()
         self.text_formatter = self.get_text_formatter()
         self.parser = self.get_parser()
         self.reasoning_effort = reasoning_effort
+        self.response_cache = response_cache
+        self.prompt_layout = prompt_layout
 
     def get_prompt_template(self) -> prompts.Prompt:
         raise NotImplementedError()
@@ -54,6 +56,12 @@ class BaseAnnotator(abc.ABC):
             hints: typing.Optional[str] = None,
             image_path: typing.Optional[pathlib.Path | str] = None
     ):
+        """
+        With the prefix prompt layout, the user message starts with the image, followed by the text,
+        and the SBVR hints last, so that all versions of a model with the same image, or the same
+        text, share the longest possible prefix after the prompt, e.g., image and combined. Requests
+        of a model share a prompt cache key, to be routed to the same cache.
+        """
         text = self.text_formatter(doc)
 
         prompt = self.prompt_template.apply()
@@ -65,31 +73,35 @@ class BaseAnnotator(abc.ABC):
             )
         ]
 
-        user_content = []
+        hint_content = []
         if hints is not None:
-            user_content.append(ChatCompletionContentPartTextParam(
+            hint_content.append(ChatCompletionContentPartTextParam(
                 text=f"Use the following SBVR as guidance in your task. You can find the original "
                      f"activities (<activity>), actors (<actor>), and conditions (<cond>) marked with "
                      f"XML-style tags to help you identifying relevant mentions.:\n{hints}",
                 type="text"
             ))
+        image_content = []
         if image_path is not None:
-            user_content.append(ChatCompletionContentPartTextParam(
+            image_content.append(ChatCompletionContentPartTextParam(
                 text="You are also given this image the description is based on to help you.",
                 type="text"
             ))
-            with open(image_path, "rb") as f:
-                image_b64 = base64.b64encode(f.read()).decode("utf-8")
-            user_content.append(ChatCompletionContentPartImageParam(
-                image_url=ImageURL(url=f"data:image/png;base64,{image_b64}"),
+            image_content.append(ChatCompletionContentPartImageParam(
+                image_url=ImageURL(url=images.cache.data_url(image_path)),
                 type="image_url"
             ))
-        user_content.append(ChatCompletionContentPartTextParam(
+        text_content = [ChatCompletionContentPartTextParam(
             text=f"Here is the text in question: \n\n{text}",
             type="text"
-        ))
+        )]
 
-        return {
+        if self.prompt_layout == "prefix":
+            user_content = image_content + text_content + hint_content
+        else:
+            user_content = hint_content + image_content + text_content
+
+        params = {
             "messages": [
                 ChatCompletionDeveloperMessageParam(
                     role="developer",
@@ -103,6 +115,9 @@ class BaseAnnotator(abc.ABC):
             "model": self.model,
             "reasoning_effort": self.reasoning_effort,
         }
+        if self.prompt_layout == "prefix":
+            params["prompt_cache_key"] = f"{self.__class__.__name__}-{doc.id}"
+        return params
 
     def batch_line(
             self,
@@ -138,9 +153,11 @@ class BaseAnnotator(abc.ABC):
             hints: typing.Optional[str] = None,
             image_path: typing.Optional[pathlib.Path | str] = None
     ) -> LLMAnnotation:
-        resp = self.client.chat.completions.create(
-            **self.get_params(doc=doc, hints=hints, image_path=image_path)
-        )
+        params = self.get_params(doc=doc, hints=hints, image_path=image_path)
+        if self.response_cache is not None:
+            resp = self.response_cache.complete(self.client, params)
+        else:
+            resp = self.client.chat.completions.create(**params)
         answer = resp.choices[0].message.content
         doc = self.parser.parse(doc, answer)
         return LLMAnnotation(
@@ -1,15 +1,11 @@
 import pathlib
 import typing
 
-import dotenv
-
 import data
 import prompts
 from annotate import util, base
 from annotate.base import BaseParser
 
-dotenv.load_dotenv()
-
 
 class EntityParser(base.BaseParser):
     def parse(self, document: data.PetDocument, string: str) -> data.PetDocument:
@@ -2,14 +2,10 @@ import pathlib
 import traceback
 import typing
 
-import dotenv
-
 import data
 import prompts
 from annotate import base
 
-dotenv.load_dotenv()
-
 
 class MentionParser(base.BaseParser):
     @staticmethod
@@ -1,14 +1,10 @@
 import pathlib
 import typing
 
-import dotenv
-
 import data
 import prompts
 from annotate import util, base
 
-dotenv.load_dotenv()
-
 
 class RelationParser(base.BaseParser):
     def parse(self, document: data.PetDocument, string: str) -> data.PetDocument:
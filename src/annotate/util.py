@@ -1,15 +1,17 @@
 import typing
 
-import spacy
-
 import data
+import registry
 
-nlp = spacy.load("en_core_web_sm")
+# spaCy model documents are tokenized with, tokens, sentences and
+# part-of-speech tags are used, named entities and lemmas are not
+spacy_model_name = "en_core_web_sm"
+_unused_pipes = ["ner", "lemmatizer"]
 
 
 def parse_text_to_pet_doc(text: str, doc_id: str) -> data.PetDocument:
     tokens = []
-    spacy_doc = nlp(text)
+    spacy_doc = next(registry.parse(spacy_model_name, [text], disable=_unused_pipes))
     for i, s in enumerate(spacy_doc.sents):
         for t in s:
             tokens.append(data.PetToken(
@@ -0,0 +1,202 @@
+import dataclasses
+import json
+import mmap
+import pathlib
+import typing
+import uuid
+
+import load
+
+
+def completion_from_line(answer_line: typing.Dict) -> typing.Optional[load.LLMCompletion]:
+    """
+    Completion of a line of a batch output file, None if the request failed.
+    """
+    response = answer_line.get("response")
+    if response is None or response.get("status_code", 200) != 200:
+        return None
+    body = response["body"]
+    return load.LLMCompletion(
+        text=body["choices"][0]["message"]["content"],
+        prompt_tokens=body["usage"]["prompt_tokens"],
+        completion_tokens=body["usage"]["completion_tokens"],
+    )
+
+
+@dataclasses.dataclass
+class TokenUsage:
+    """
+    Tokens used by answered requests, cached_tokens of the prompt tokens were answered from the
+    provider's prompt cache, at a discount.
+    """
+    num_answers: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+
+    def add(self, usage: typing.Dict) -> None:
+        self.num_answers += 1
+        self.prompt_tokens += usage["prompt_tokens"]
+        self.cached_tokens += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        self.completion_tokens += usage["completion_tokens"]
+
+    def update(self, other: "TokenUsage") -> None:
+        self.num_answers += other.num_answers
+        self.prompt_tokens += other.prompt_tokens
+        self.cached_tokens += other.cached_tokens
+        self.completion_tokens += other.completion_tokens
+
+    @property
+    def cached_share(self) -> float:
+        if self.prompt_tokens == 0:
+            return 0.0
+        return self.cached_tokens / self.prompt_tokens
+
+    def __str__(self):
+        return (f"{self.num_answers} answers, {self.prompt_tokens} prompt tokens, "
+                f"{self.cached_tokens} of them cached ({self.cached_share:.1%}), "
+                f"{self.completion_tokens} completion tokens")
+
+
+def token_usage(answers_file_path: pathlib.Path) -> TokenUsage:
+    """
+    Tokens used by the successful answers of a batch output file.
+    """
+    usage = TokenUsage()
+    with open(answers_file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            answer_line = json.loads(line)
+            if completion_from_line(answer_line) is not None:
+                usage.add(answer_line["response"]["body"]["usage"])
+    return usage
+
+
+def answer_line(custom_id: str,
+                response: typing.Dict,
+                *,
+                source: str,
+                request_id: typing.Optional[str] = None) -> typing.Dict:
+    """
+    Line of a batch output file for a response not answered by the batch API, source becomes the
+    prefix of its id, e.g., online or cached.
+    """
+    return {
+        "id": f"{source}_{uuid.uuid4().hex}",
+        "custom_id": custom_id,
+        "response": {
+            "status_code": 200,
+            "request_id": request_id,
+            "body": response,
+        },
+        "error": None,
+    }
+
+
+class AnswerIndex:
+    """
+    Answers of a batch output file, retrieved one at a time from a memory map of the file, using an
+    index of the byte offsets of all lines by custom id. The index is built once and kept next to
+    the file, as <file name>.idx, it is rebuilt, when the file changed. Failed requests are not
+    indexed, of requests answered more than once, e.g., after retries, the last answer is used.
+    A missing file, e.g., of a stage without any answers yet, is an empty index.
+    """
+
+    def __init__(self, answers_file_path: pathlib.Path):
+        self._answers_file_path = answers_file_path
+        self._index_path = answers_file_path.parent / f"{answers_file_path.name}.idx"
+        self._offsets: typing.Dict[str, typing.Tuple[int, int]] = self._load_index()
+        self._custom_ids_by_model_id: typing.Dict[str, typing.List[str]] = {}
+        for custom_id in self._offsets:
+            # e.g. describe-1d1451c4a6e9488ba78e34cee314cf10-sbvr
+            _, model_id, _ = custom_id.split("-")
+            self._custom_ids_by_model_id.setdefault(model_id, []).append(custom_id)
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._map: typing.Optional[mmap.mmap] = None
+
+    def _load_index(self) -> typing.Dict[str, typing.Tuple[int, int]]:
+        if not self._answers_file_path.exists():
+            return {}
+        stat = self._answers_file_path.stat()
+        if self._index_path.exists():
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+                return {custom_id: (offset, length) for custom_id, (offset, length) in index["offsets"].items()}
+
+        offsets = {}
+        offset = 0
+        with open(self._answers_file_path, "rb") as f:
+            for line in f:
+                if line.strip() != b"":
+                    answer_line = json.loads(line)
+                    if completion_from_line(answer_line) is not None:
+                        offsets[answer_line["custom_id"]] = (offset, len(line))
+                offset += len(line)
+        with open(self._index_path, "w", encoding="utf-8") as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "offsets": offsets}, f)
+        return offsets
+
+    def __enter__(self) -> "AnswerIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __contains__(self, custom_id: str) -> bool:
+        return custom_id in self._offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def model_ids(self) -> typing.List[str]:
+        """
+        Ids of all answered models, in the order of their first answer in the file.
+        """
+        return list(self._custom_ids_by_model_id)
+
+    def get(self, custom_id: str) -> typing.Optional[load.LLMCompletion]:
+        if custom_id not in self._offsets:
+            return None
+        if self._map is None:
+            self._file = open(self._answers_file_path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length = self._offsets[custom_id]
+        return completion_from_line(json.loads(self._map[offset:offset + length]))
+
+    def by_model_id(self, model_id: str) -> typing.Dict[str, load.LLMCompletion]:
+        """
+        Answers of a model by version, same as load_answers_by_model_id(...)[model_id], but only
+        reading the answers of this model.
+        """
+        answers = {}
+        for custom_id in self._custom_ids_by_model_id.get(model_id, []):
+            _, _, version = custom_id.split("-")
+            answers[version] = self.get(custom_id)
+        return answers
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+
+
+ModelT = typing.TypeVar("ModelT", bound=load.ModelSBVR)
+
+
+def join_by_model_id(
+        models: typing.Iterable[ModelT],
+        *indices: AnswerIndex
+) -> typing.Iterator[typing.Tuple[ModelT, typing.List[typing.Dict[str, load.LLMCompletion]]]]:
+    """
+    Answers of each model by version from all indices, e.g., of mentions, entities, and relations.
+    This is not a merge join: answers files are not in model order, as batches answer requests in
+    any order, so each model's answers are looked up in each index instead, one model at a time.
+    Only the answers of a single model are held in memory, the answers files are read through the
+    page cache, and each line is read once.
+    """
+    for model in models:
+        yield model, [index.by_model_id(model.model.id) for index in indices]
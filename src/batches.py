@@ -1,5 +1,9 @@
+import concurrent.futures
 import csv
+import functools
+import hashlib
 import json
+import os
 import pathlib
 import time
 import typing
@@ -11,21 +15,382 @@ import tqdm
 from openai.types import Batch
 
 import annotate
+import answers
+import cache
 import data
 import description
+import images
 import load
+import online
 import prompts
+import registry
+import state
 
 resources_folder = pathlib.Path(__file__).parent.parent / "resources"
+documents_cache_path = resources_folder / "cache" / "documents.sqlite"
+responses_cache_path = resources_folder / "cache" / "responses.sqlite"
 
 
-def batch_line(*, custom_id: str, body: typing.Dict):
-    return json.dumps({
+def batch_request(*, custom_id: str, body: typing.Dict) -> typing.Dict:
+    return {
         "custom_id": custom_id,
         "method": "POST",
         "url": "/v1/chat/completions",
         "body": body,
-    })
+    }
+
+
+def batch_line(*, custom_id: str, body: typing.Dict):
+    return json.dumps(batch_request(custom_id=custom_id, body=body))
+
+
+# limits of the batch API per input file
+max_batch_file_bytes = 200 * 1024 * 1024
+max_batch_file_requests = 50_000
+
+
+def manifest_path(batch_file_path: pathlib.Path) -> pathlib.Path:
+    return batch_file_path.parent.parent / "manifests" / f"{batch_file_path.stem}.json"
+
+
+class BatchPacker:
+    """
+    Streams requests into the shards of a batch, i.e., batch files next to batch_file_path, named
+    <stem>-<index>.jsonl, of at most max_bytes, max_requests, and, if given, max_tokens estimated
+    prompt tokens each. Requests are never split, a single request exceeding a limit gets a shard
+    of its own. On close, a manifest mapping the custom id of each request to its shard is written
+    (see manifest_path), which is used to start the shards and to merge their answers.
+
+    With a response_cache, requests answered before are not added to any shard, their answers are
+    written to outputs/<stem>-cached.jsonl instead, which is listed in the manifest as well.
+    """
+
+    def __init__(self,
+                 batch_file_path: pathlib.Path,
+                 *,
+                 max_bytes: int = max_batch_file_bytes,
+                 max_requests: int = max_batch_file_requests,
+                 max_tokens: typing.Optional[int] = None,
+                 response_cache: typing.Optional[cache.ResponseCache] = None):
+        assert batch_file_path.suffix == ".jsonl", "Can only write batches to JSON lines file"
+        self._batch_file_path = batch_file_path
+        self._max_bytes = max_bytes
+        self._max_requests = max_requests
+        self._max_tokens = max_tokens
+        self._response_cache = response_cache
+        self._cached = f"{batch_file_path.stem}-cached"
+        self._cached_file: typing.Optional[typing.TextIO] = None
+        self._num_cached = 0
+
+        self._shards: typing.List[str] = []
+        self._custom_ids: typing.Dict[str, str] = {}
+        self._file: typing.Optional[typing.TextIO] = None
+        self._num_bytes = 0
+        self._num_requests = 0
+        self._num_tokens = 0
+        self._image_savings = images.ImageSavings()
+
+        batch_file_path.parent.mkdir(parents=True, exist_ok=True)
+        # shards of an earlier packing of this batch would otherwise be started as well
+        if manifest_path(batch_file_path).exists():
+            for shard in load_manifest(manifest_path(batch_file_path))["shards"]:
+                self._remove_shard(shard)
+        self._cached_path.unlink(missing_ok=True)
+
+    @property
+    def _cached_path(self) -> pathlib.Path:
+        return self._batch_file_path.parent.parent / "outputs" / f"{self._cached}.jsonl"
+
+    def _remove_shard(self, shard: str) -> None:
+        """
+        Removes the batch file of a shard and everything derived from it, i.e., its file id, batch
+        info and answers, which would otherwise be taken for those of a new shard of the same name,
+        e.g., by start_batch, which skips shards with an info.
+        """
+        batch_directory = self._batch_file_path.parent.parent
+        (self._batch_file_path.parent / f"{shard}.jsonl").unlink(missing_ok=True)
+        (batch_directory / "ids" / f"{shard}.fileid").unlink(missing_ok=True)
+        (batch_directory / "infos" / f"{shard}.json").unlink(missing_ok=True)
+        for directory in ["outputs", "errors"]:
+            for suffix in [".jsonl", ".jsonl.part", ".jsonl.idx"]:
+                (batch_directory / directory / f"{shard}{suffix}").unlink(missing_ok=True)
+
+    def __enter__(self) -> "BatchPacker":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _fits(self, num_bytes: int, num_tokens: int) -> bool:
+        if self._num_requests + 1 > self._max_requests:
+            return False
+        if self._num_bytes + num_bytes > self._max_bytes:
+            return False
+        if self._max_tokens is not None and self._num_tokens + num_tokens > self._max_tokens:
+            return False
+        return True
+
+    def _next_shard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        shard = f"{self._batch_file_path.stem}-{len(self._shards):03d}"
+        # left by a packing without a manifest, e.g., an interrupted one
+        self._remove_shard(shard)
+        self._shards.append(shard)
+        self._file = open(self._batch_file_path.parent / f"{shard}.jsonl", "w", encoding="utf-8")
+        self._num_bytes = 0
+        self._num_requests = 0
+        self._num_tokens = 0
+
+    def _add_cached(self, request: typing.Dict, response: typing.Dict) -> None:
+        if self._cached_file is None:
+            self._cached_path.parent.mkdir(parents=True, exist_ok=True)
+            self._cached_file = open(self._cached_path, "w", encoding="utf-8")
+        answer_line = answers.answer_line(request["custom_id"], response, source="cached")
+        self._cached_file.write(json.dumps(answer_line) + "\n")
+        self._custom_ids[request["custom_id"]] = self._cached
+        self._num_cached += 1
+
+    def add(self, request: typing.Dict) -> None:
+        if self._response_cache is not None:
+            response = self._response_cache.get(request["body"])
+            if response is not None:
+                self._add_cached(request, response)
+                return
+        line = json.dumps(request) + "\n"
+        num_bytes = len(line.encode("utf-8"))
+        num_tokens = online.estimate_prompt_tokens(request["body"])
+        if self._file is None or (self._num_requests > 0 and not self._fits(num_bytes, num_tokens)):
+            self._next_shard()
+        self._file.write(line)
+        self._num_bytes += num_bytes
+        self._num_requests += 1
+        self._num_tokens += num_tokens
+        self._custom_ids[request["custom_id"]] = self._shards[-1]
+        self._image_savings.update(images.cache.savings(request["body"]))
+
+    def close(self) -> pathlib.Path:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._cached_file is not None:
+            self._cached_file.close()
+            self._cached_file = None
+        path = manifest_path(self._batch_file_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # a manifest marks its shards as complete, so it is only ever written entirely
+        temp_path = path.parent / f"{path.name}.part"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "shards": self._shards,
+                "cached": self._cached if self._num_cached > 0 else None,
+                "custom_ids": self._custom_ids
+            }, f)
+        os.replace(temp_path, path)
+        if self._response_cache is not None:
+            print(f"{self._batch_file_path.stem}: {self._num_cached} of {len(self._custom_ids)} "
+                  f"requests answered from cache.")
+        if self._image_savings.num_images > 0:
+            print(f"{self._batch_file_path.stem}: {self._image_savings}.")
+        return path
+
+
+def load_manifest(path: pathlib.Path) -> typing.Dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def cache_answers(batch_file_path: pathlib.Path,
+                  answers_file_path: pathlib.Path,
+                  response_cache: cache.ResponseCache) -> None:
+    """
+    Adds the successful answers of a batch to the response cache, keyed by their requests.
+    """
+    bodies = {request["custom_id"]: request["body"] for request in online.read_requests(batch_file_path)}
+    responses = []
+    with open(answers_file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            answer_line = json.loads(line)
+            if answers.completion_from_line(answer_line) is not None and answer_line["custom_id"] in bodies:
+                responses.append((bodies[answer_line["custom_id"]], answer_line["response"]["body"]))
+    response_cache.put_many(responses)
+
+
+def cache_batch_answers(path: pathlib.Path, response_cache: cache.ResponseCache) -> None:
+    """
+    Adds the answers of all shards of the manifest at path to the response cache.
+    """
+    for batch_file_path, answers_file_path in zip(shard_paths(path, "inputs", ".jsonl"),
+                                                  shard_paths(path, "outputs", ".jsonl")):
+        if answers_file_path.exists():
+            cache_answers(batch_file_path, answers_file_path, response_cache)
+
+
+def shard_paths(path: pathlib.Path, directory: str, suffix: str) -> typing.List[pathlib.Path]:
+    """
+    Paths of the files of all shards of the manifest at path, in the given directory of the batch,
+    e.g., shard_paths(path, "infos", ".json") for the batch infos.
+    """
+    return [path.parent.parent / directory / f"{shard}{suffix}" for shard in load_manifest(path)["shards"]]
+
+
+def start_manifest_batches(path: pathlib.Path, client: openai.OpenAI) -> typing.List[pathlib.Path]:
+    for batch_file_path in shard_paths(path, "inputs", ".jsonl"):
+        start_batch(batch_file_path=batch_file_path, client=client)
+    return shard_paths(path, "infos", ".json")
+
+
+def merge_batch_answers(path: pathlib.Path, answers_file_path: pathlib.Path) -> None:
+    """
+    Merges the answers of all shards of the manifest at path into a single file, e.g., to be read
+    with load_answers_by_model_id.
+    """
+    manifest = load_manifest(path)
+    answers_paths = shard_paths(path, "outputs", ".jsonl")
+    if manifest.get("cached") is not None:
+        answers_paths.append(path.parent.parent / "outputs" / f"{manifest['cached']}.jsonl")
+    merge_answers(answers_paths, set(manifest["custom_ids"]), answers_file_path, name=path.stem)
+
+
+def merge_answers(answers_paths: typing.List[pathlib.Path],
+                  custom_ids: typing.Set[str],
+                  answers_file_path: pathlib.Path,
+                  *,
+                  name: typing.Optional[str] = None) -> None:
+    """
+    Merges the answers of the given requests from the output files of several shards into a single
+    file, e.g., also their error files. Missing answers are reported, if a name is given.
+    """
+    answered = set()
+    answers_file_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(answers_file_path, "w", encoding="utf-8") as out_f:
+        for shard_answers_path in answers_paths:
+            if not shard_answers_path.exists():
+                if name is not None:
+                    print(f"No answers for shard {shard_answers_path.stem}!")
+                continue
+            with open(shard_answers_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip() == "":
+                        continue
+                    custom_id = json.loads(line)["custom_id"]
+                    if custom_id not in custom_ids or custom_id in answered:
+                        continue
+                    answered.add(custom_id)
+                    out_f.write(line if line.endswith("\n") else line + "\n")
+    if name is not None and len(answered) < len(custom_ids):
+        print(f"{len(custom_ids) - len(answered)} of {len(custom_ids)} requests of {name} have no answer.")
+
+
+# order of versions in batch files
+description_versions = ["sbvr", "image", "combined"]
+annotation_versions = ["no_hints", "sbvr", "image", "combined"]
+
+
+def description_text(described_model: load.DescribedModel,
+                     version: typing.Literal["sbvr", "image", "combined", "no_hints"]) -> str:
+    if version == "sbvr" or version == "no_hints":
+        return described_model.descriptions.from_sbvr.text
+    elif version == "image":
+        return described_model.descriptions.from_picture.text
+    elif version == "combined":
+        return described_model.descriptions.from_both.text
+    raise ValueError(f"Unknown version {version}")
+
+
+class DocumentStore:
+    """
+    Keeps the tokenized documents of model descriptions, so that each description is tokenized only
+    once, by the first annotation stage, and later stages and reruns load it instead. Documents are
+    keyed by model id, version and a hash of the description text, per version of the spaCy model
+    they were tokenized with.
+
+    Documents are also kept after each annotation stage, keyed by the key of the previous stage,
+    the parser and a hash of the parsed answer, so that each stage continues from the result of
+    the previous one, instead of replaying the parsers of all earlier stages.
+    """
+
+    def __init__(self, document_cache: typing.Optional[cache.PersistentCache] = None):
+        if document_cache is None:
+            document_cache = cache.PersistentCache(documents_cache_path)
+        self._cache = document_cache
+        spacy_model_key = registry.spacy_model_key(annotate.util.spacy_model_name)
+        self._namespace = f"pet-tokens/{spacy_model_key}"
+        self._stages_namespace = f"pet-stages/{spacy_model_key}"
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _key(model_id: str, version: str, text: str) -> str:
+        return f"{model_id}/{version}/{DocumentStore._hash(text)}"
+
+    def tokenized(self,
+                  described_model: load.DescribedModel,
+                  version: typing.Literal["sbvr", "image", "combined", "no_hints"]) -> data.PetDocument:
+        text = description_text(described_model, version)
+        key = self._key(described_model.model.id, version, text)
+        exported = self._cache.get(self._namespace, key)
+        if exported is not None:
+            return data.PetImporter.read_document_from_json(exported)
+        document = annotate.parse_text_to_pet_doc(text, described_model.model.id)
+        self._cache.put(self._namespace, key, data.PetDictExporter().export_document(document))
+        return document
+
+    def parsed(self,
+               described_model: load.DescribedModel,
+               version: typing.Literal["sbvr", "image", "combined", "no_hints"],
+               stages: typing.List[typing.Tuple[annotate.BaseParser, str]]) -> data.PetDocument:
+        """
+        Returns the document of the given description, after parsing the answer of each stage with
+        its parser, one stage after the other. Only stages after the last one already stored are parsed.
+        """
+        keys = [self._key(described_model.model.id, version, description_text(described_model, version))]
+        for parser, answer in stages:
+            keys.append(f"{keys[-1]}/{type(parser).__name__}-{self._hash(answer)}")
+
+        stored = self._cache.get_many(self._stages_namespace, keys[1:])
+        num_done = 0
+        document = None
+        for i in range(len(stages), 0, -1):
+            if keys[i] in stored:
+                document = data.PetImporter.read_document_from_json(stored[keys[i]])
+                num_done = i
+                break
+        if document is None:
+            document = self.tokenized(described_model, version)
+
+        for i in range(num_done, len(stages)):
+            parser, answer = stages[i]
+            document = parser.parse(document=document, string=answer)
+            self._cache.put(self._stages_namespace, keys[i + 1], data.PetDictExporter().export_document(document))
+        return document
+
+
+def description_request(model_sbvr: load.ModelSBVR,
+                        version: typing.Literal["sbvr", "image", "combined"],
+                        *,
+                        client: openai.OpenAI,
+                        model: str,
+                        example: typing.Optional[str],
+                        prompt_layout: prompts.PromptLayout = "default") -> typing.Dict:
+    text = "\n".join(model_sbvr.sbvr.rules)
+    image_path = resources_folder / "images" / f"{model_sbvr.model.id}.png"
+    if version == "sbvr":
+        describer = description.LLMSBVRDescriber(client, model, prompt_layout=prompt_layout)
+        body = describer.request_params(sbvr=text, image_path=None, example=example)
+    elif version == "image":
+        describer = description.LLMPictureDescriber(client, model, prompt_layout=prompt_layout)
+        body = describer.request_params(sbvr=None, image_path=image_path, example=example)
+    elif version == "combined":
+        describer = description.LLMCombinedDescriber(client, model, prompt_layout=prompt_layout)
+        body = describer.request_params(sbvr=text, image_path=image_path, example=example)
+    else:
+        raise ValueError(f"No description for version {version}")
+    return batch_request(custom_id=f"describe-{model_sbvr.model.id}-{version}", body=body)
 
 
 def generate_descriptions_batch(*,
@@ -34,50 +399,119 @@ def generate_descriptions_batch(*,
                                 example: typing.Optional[str],
                                 client: openai.OpenAI,
                                 model: str,
-                                versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]], ):
+                                versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]],
+                                response_cache: typing.Optional[cache.ResponseCache] = None,
+                                skip: typing.Optional[typing.Set[str]] = None,
+                                prompt_layout: prompts.PromptLayout = "default"):
+    """
+    Writes the description requests of all models in in_file, except those with custom ids in skip,
+    e.g., requests already sent by an earlier run.
+    """
+    if skip is None:
+        skip = set()
     models = list(load.load_sbvr_models(in_file))
-    out_file.parent.mkdir(parents=True, exist_ok=True)
-
-    assert out_file.suffix == ".jsonl", "Can only write batches to JSON lines file"
 
-    with open(out_file, "w", encoding="utf-8") as out_f:
+    with BatchPacker(out_file, response_cache=response_cache) as packer:
         for model_sbvr in tqdm.tqdm(models):
-            text = "\n".join(model_sbvr.sbvr.rules)
-
-            if "sbvr" in versions:
-                sbvr_request = description.LLMSBVRDescriber(client, model).request_params(sbvr=text,
-                                                                                          image_path=None,
-                                                                                          example=example)
-                out_f.write(batch_line(custom_id=f"describe-{model_sbvr.model.id}-sbvr", body=sbvr_request) + "\n")
-
-            if "image" in versions:
-                image_path = resources_folder / "images" / f"{model_sbvr.model.id}.png"
-                image_request = description.LLMPictureDescriber(client, model).request_params(sbvr=None,
-                                                                                              image_path=image_path,
-                                                                                              example=example)
-                out_f.write(batch_line(custom_id=f"describe-{model_sbvr.model.id}-image", body=image_request) + "\n")
-
-            if "combined" in versions:
-                image_path = resources_folder / "images" / f"{model_sbvr.model.id}.png"
-                combined_request = description.LLMCombinedDescriber(client, model).request_params(sbvr=text,
-                                                                                                  image_path=image_path,
-                                                                                                  example=example)
-                out_f.write(
-                    batch_line(custom_id=f"describe-{model_sbvr.model.id}-combined", body=combined_request) + "\n")
+            for version in description_versions:
+                if version not in versions or f"describe-{model_sbvr.model.id}-{version}" in skip:
+                    continue
+                packer.add(description_request(model_sbvr, version, client=client, model=model, example=example,
+                                               prompt_layout=prompt_layout))
+
+
+def download_file(file_id: str, path: pathlib.Path, client: openai.OpenAI) -> int:
+    """
+    Streams a file of the files API to a temporary file next to path, and returns its number of
+    lines. The file is only moved to path by write_batch_file, once it is known to be complete.
+    """
+    temp_path = path.parent / f"{path.name}.part"
+    temp_path.parent.mkdir(parents=True, exist_ok=True)
+    num_lines = 0
+    last_byte = b"\n"
+    with client.files.with_streaming_response.content(file_id) as response, open(temp_path, "wb") as f:
+        for chunk in response.iter_bytes():
+            f.write(chunk)
+            num_lines += chunk.count(b"\n")
+            last_byte = chunk[-1:] or last_byte
+    if last_byte != b"\n":
+        num_lines += 1
+    return num_lines
+
+
+def write_batch_file(file_id: str,
+                     path: pathlib.Path,
+                     client: openai.OpenAI,
+                     *,
+                     num_lines: typing.Optional[int],
+                     max_attempts: int = 2) -> bool:
+    """
+    Downloads a batch output or error file to path, and checks its number of lines against the
+    request counts of the batch, downloading it again, if they differ. path only ever holds a
+    complete download: if the lines still differ after max_attempts downloads, the last download
+    is left at <path>.part, so the next run downloads it again, same as after an interrupted
+    download, and False is returned.
+    """
+    temp_path = path.parent / f"{path.name}.part"
+    for attempt in range(max_attempts):
+        num_downloaded = download_file(file_id, path, client)
+        if num_lines is None or num_downloaded == num_lines:
+            os.replace(temp_path, path)
+            return True
+        if attempt + 1 < max_attempts:
+            print(f"\nDownloaded {num_downloaded} lines of {path.name}, expected {num_lines}, downloading again.")
+    print(f"\nDownloaded {num_downloaded} lines of {path.name} {max_attempts} times, expected {num_lines}, "
+          f"left it at {temp_path.name} to download it again next run.")
+    return False
+
+
+def incomplete_batch_answers(batch_info_path: pathlib.Path) -> bool:
+    """
+    Whether an answer or error file of a terminated batch was left at <path>.part by write_batch_file.
+    """
+    return any((batch_info_path.parent.parent / directory / f"{batch_info_path.stem}.jsonl.part").exists()
+               for directory in ["outputs", "errors"])
 
 
 def write_batch_answers(batch_info_paths: typing.List[pathlib.Path], client: openai.OpenAI, ):
+    """
+    Downloads the answers of terminated batches to outputs/<stem>.jsonl, and their failed requests
+    to errors/<stem>.jsonl. Batches that failed, or expired before answering any request, have
+    neither, expired or cancelled batches may have answered some of their requests, their error
+    files also list the requests they did not get to. Downloads that do not match the request
+    counts are left incomplete, see write_batch_file and incomplete_batch_answers.
+    """
     for batch_info_path in batch_info_paths:
         with open(batch_info_path, "r", encoding="utf-8") as f:
             batch_info = Batch.model_validate_json(f.read())
-        assert batch_info.status == "completed"
-        batch_answer_file_path = batch_info_path.parent.parent / "outputs" / f"{batch_info_path.stem}.jsonl"
-        if batch_answer_file_path.exists():
-            continue
-        batch_answer_file_path.parent.mkdir(parents=True, exist_ok=True)
-        batch_answers = client.files.content(batch_info.output_file_id)
-        with open(batch_answer_file_path, "w", encoding="utf-8") as f:
-            f.write(batch_answers.text)
+        assert batch_info.status in terminated_batch_statuses
+        request_counts = batch_info.request_counts
+        for file_id, directory, num_lines in [
+            (batch_info.output_file_id, "outputs", request_counts.completed if request_counts else None),
+            (batch_info.error_file_id, "errors",
+             request_counts.total - request_counts.completed if request_counts else None),
+        ]:
+            path = batch_info_path.parent.parent / directory / f"{batch_info_path.stem}.jsonl"
+            if file_id is None or path.exists():
+                continue
+            write_batch_file(file_id, path, client, num_lines=num_lines)
+
+
+def write_online_answers(batch_file_paths: typing.List[pathlib.Path], client: openai.AsyncOpenAI, **runner_args):
+    """
+    Answers batch files with the online API instead, for small runs, that can not wait for the batch API.
+    Answers are written to the same place as those of write_batch_answers, failed requests next to them.
+    """
+    stats = online.answer_online([
+        (batch_file_path,
+         batch_file_path.parent.parent / "outputs" / f"{batch_file_path.stem}.jsonl",
+         batch_file_path.parent.parent / "errors" / f"{batch_file_path.stem}.jsonl")
+        for batch_file_path in batch_file_paths
+    ], client=client, **runner_args)
+    print(f"Answered {stats.num_requests - stats.num_failed} requests online "
+          f"({stats.num_skipped} answered before, {stats.num_failed} failed, {stats.num_retries} retries), "
+          f"using {stats.prompt_tokens} prompt ({stats.cached_tokens} cached) and {stats.completion_tokens} "
+          f"completion tokens.")
 
 
 def load_answers_by_model_id(answers_file_path: pathlib.Path) -> typing.Dict[str, typing.Dict[str, load.LLMCompletion]]:
@@ -112,6 +546,9 @@ def write_described(*,
     with open(output_file_path, "w", encoding="utf-8") as f:
         writer = csv.writer(f, lineterminator="\n")
         for model_sbvr in load.load_sbvr_models(models_sbvr_file_path):
+            if model_sbvr.model.id not in answers_by_model_id:
+                # description failed, requested again by the next run
+                continue
             described_model = load.DescribedModel(
                 model=model_sbvr.model,
                 sbvr=model_sbvr.sbvr,
@@ -127,55 +564,79 @@ def write_described(*,
             writer.writerow(described_model.row.values())
 
 
+@functools.lru_cache(maxsize=None)
+def _hint_template() -> prompts.Prompt:
+    return prompts.Prompt(resources_folder / "prompts" / "hints" / "sbvr.txt")
+
+
+def annotation_hints(
+        described_model: load.DescribedModel,
+        version: typing.Literal["sbvr", "image", "combined", "no_hints"]
+) -> typing.Tuple[typing.Optional[str], typing.Optional[pathlib.Path]]:
+    """
+    Returns the SBVR hints and the image path, that annotation requests of the given version contain.
+    """
+    image_path = resources_folder / "images" / f"{described_model.model.id}.png"
+    rules = "\n".join(described_model.sbvr.rules)
+    facts = "\n".join(described_model.sbvr.vocab)
+    assert rules is not None and len(rules) > 0
+    assert facts is not None and len(facts) > 0
+    hint = _hint_template()(rules=rules)
+
+    if version == "no_hints":
+        return None, None
+    elif version == "sbvr":
+        return hint, None
+    elif version == "image":
+        return None, image_path
+    elif version == "combined":
+        return hint, image_path
+    raise ValueError(f"Unknown version {version}")
+
+
+def annotation_request(annotator: annotate.BaseAnnotator,
+                       doc: data.PetDocument,
+                       described_model: load.DescribedModel,
+                       version: typing.Literal["sbvr", "image", "combined", "no_hints"]) -> typing.Dict:
+    hints, image_path = annotation_hints(described_model, version)
+    return annotator.batch_line(doc=doc, hints=hints, image_path=image_path)
+
+
+def annotation_custom_id(annotator: annotate.BaseAnnotator,
+                         described_model: load.DescribedModel,
+                         version: typing.Literal["sbvr", "image", "combined", "no_hints"]) -> str:
+    """
+    Custom id of the request annotation_request would build, without building it, see BaseAnnotator.batch_line.
+    """
+    return f"{annotator.__class__.__name__}-{described_model.model.id}-{version}"
+
+
 def generate_mention_annotations_batch(*,
                                        in_file: pathlib.Path,
                                        out_file: pathlib.Path,
                                        client: openai.OpenAI,
                                        model: str,
-                                       versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]]):
+                                       versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]],
+                                       documents: typing.Optional[DocumentStore] = None,
+                                       response_cache: typing.Optional[cache.ResponseCache] = None,
+                                       skip: typing.Optional[typing.Set[str]] = None,
+                                       prompt_layout: prompts.PromptLayout = "default"):
+    if documents is None:
+        documents = DocumentStore()
+    if skip is None:
+        skip = set()
     models = list(load.load_described_models(in_file))
-    out_file.parent.mkdir(parents=True, exist_ok=True)
-
-    hint_template_path = resources_folder / "prompts" / "hints" / "sbvr.txt"
-    hint_template = prompts.Prompt(hint_template_path)
 
-    assert out_file.suffix == ".jsonl", "Can only write batches to JSON lines file"
-
-    with open(out_file, "w", encoding="utf-8") as out_f:
+    with BatchPacker(out_file, response_cache=response_cache) as packer:
         for described_model in tqdm.tqdm(models):
-            image_path = resources_folder / "images" / f"{described_model.model.id}.png"
-            rules = "\n".join(described_model.sbvr.rules)
-            facts = "\n".join(described_model.sbvr.vocab)
-            assert rules is not None and len(rules) > 0
-            assert facts is not None and len(facts) > 0
-
-            hint = hint_template(rules=rules)
+            annotator = annotate.LLMMentionAnnotator(client, model, reasoning_effort="low",
+                                                     prompt_layout=prompt_layout)
 
-            annotator = annotate.LLMMentionAnnotator(client, model, reasoning_effort="low")
-
-            if "no_hints" in versions:
-                from_sbvr_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_sbvr.text,
-                                                               described_model.model.id)
-                none_annotation = annotator.batch_line(doc=from_sbvr_doc, hints=None, image_path=None)
-                out_f.write(json.dumps(none_annotation) + "\n")
-
-            if "sbvr" in versions:
-                from_sbvr_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_sbvr.text,
-                                                               described_model.model.id)
-                sbvr_annotation = annotator.batch_line(doc=from_sbvr_doc, hints=hint, image_path=None)
-                out_f.write(json.dumps(sbvr_annotation) + "\n")
-
-            if "image" in versions:
-                from_image_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_picture.text,
-                                                                described_model.model.id)
-                image_annotation = annotator.batch_line(doc=from_image_doc, hints=None, image_path=image_path)
-                out_f.write(json.dumps(image_annotation) + "\n")
-
-            if "combined" in versions:
-                from_combined_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_both.text,
-                                                                   described_model.model.id)
-                combined_annotation = annotator.batch_line(doc=from_combined_doc, hints=hint, image_path=image_path)
-                out_f.write(json.dumps(combined_annotation) + "\n")
+            for version in annotation_versions:
+                if version not in versions or annotation_custom_id(annotator, described_model, version) in skip:
+                    continue
+                doc = documents.tokenized(described_model, version)
+                packer.add(annotation_request(annotator, doc, described_model, version))
 
 
 def generate_entity_annotations_batch(*,
@@ -184,64 +645,35 @@ def generate_entity_annotations_batch(*,
                                       out_file: pathlib.Path,
                                       client: openai.OpenAI,
                                       model: str,
-                                      versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]]):
+                                      versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]],
+                                      documents: typing.Optional[DocumentStore] = None,
+                                      response_cache: typing.Optional[cache.ResponseCache] = None,
+                                      skip: typing.Optional[typing.Set[str]] = None,
+                                      prompt_layout: prompts.PromptLayout = "default"):
+    if documents is None:
+        documents = DocumentStore()
+    if skip is None:
+        skip = set()
     models = list(load.load_described_models(in_file))
-    out_file.parent.mkdir(parents=True, exist_ok=True)
-
-    mention_answers_by_id = load_answers_by_model_id(mention_answers_file)
-
-    hint_template_path = resources_folder / "prompts" / "hints" / "sbvr.txt"
-    hint_template = prompts.Prompt(hint_template_path)
 
-    assert out_file.suffix == ".jsonl", "Can only write batches to JSON lines file"
-
-    with open(out_file, "w", encoding="utf-8") as out_f:
-        for described_model in tqdm.tqdm(models):
-            image_path = resources_folder / "images" / f"{described_model.model.id}.png"
-            rules = "\n".join(described_model.sbvr.rules)
-            facts = "\n".join(described_model.sbvr.vocab)
-            assert rules is not None and len(rules) > 0
-            assert facts is not None and len(facts) > 0
-
-            hint = hint_template(rules=rules)
+    mention_index = answers.AnswerIndex(mention_answers_file)
 
+    with mention_index, BatchPacker(out_file, response_cache=response_cache) as packer:
+        for described_model, (mention_answers,) in answers.join_by_model_id(tqdm.tqdm(models), mention_index):
             mentions_annotator = annotate.LLMMentionAnnotator(client, model, reasoning_effort="low")
-            entities_annotator = annotate.LLMEntitiesAnnotator(client, model, reasoning_effort="low")
+            entities_annotator = annotate.LLMEntitiesAnnotator(client, model, reasoning_effort="low",
+                                                               prompt_layout=prompt_layout)
 
-            mention_answers = mention_answers_by_id[described_model.model.id]
-
-            if "no_hints" in versions:
-                from_sbvr_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_sbvr.text,
-                                                               described_model.model.id)
-                from_sbvr_doc = mentions_annotator.parser.parse(document=from_sbvr_doc,
-                                                                string=mention_answers["no_hints"].text)
-                none_annotation = entities_annotator.batch_line(doc=from_sbvr_doc, hints=None, image_path=None)
-                out_f.write(json.dumps(none_annotation) + "\n")
-
-            if "sbvr" in versions:
-                from_sbvr_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_sbvr.text,
-                                                               described_model.model.id)
-                from_sbvr_doc = mentions_annotator.parser.parse(document=from_sbvr_doc,
-                                                                string=mention_answers["sbvr"].text)
-                sbvr_annotation = entities_annotator.batch_line(doc=from_sbvr_doc, hints=hint, image_path=None)
-                out_f.write(json.dumps(sbvr_annotation) + "\n")
-
-            if "image" in versions:
-                from_image_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_picture.text,
-                                                                described_model.model.id)
-                from_image_doc = mentions_annotator.parser.parse(document=from_image_doc,
-                                                                 string=mention_answers["image"].text)
-                image_annotation = entities_annotator.batch_line(doc=from_image_doc, hints=None, image_path=image_path)
-                out_f.write(json.dumps(image_annotation) + "\n")
-
-            if "combined" in versions:
-                from_combined_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_both.text,
-                                                                   described_model.model.id)
-                from_combined_doc = mentions_annotator.parser.parse(document=from_combined_doc,
-                                                                    string=mention_answers["combined"].text)
-                combined_annotation = entities_annotator.batch_line(doc=from_combined_doc, hints=hint,
-                                                                    image_path=image_path)
-                out_f.write(json.dumps(combined_annotation) + "\n")
+            for version in annotation_versions:
+                if version not in versions or annotation_custom_id(entities_annotator, described_model, version) in skip:
+                    continue
+                if version not in mention_answers:
+                    # mentions failed, requested again by the next run
+                    continue
+                doc = documents.parsed(described_model, version, [
+                    (mentions_annotator.parser, mention_answers[version].text),
+                ])
+                packer.add(annotation_request(entities_annotator, doc, described_model, version))
 
 
 def generate_relation_annotations_batch(*,
@@ -251,75 +683,39 @@ def generate_relation_annotations_batch(*,
                                         out_file: pathlib.Path,
                                         client: openai.OpenAI,
                                         model: str,
-                                        versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]]):
+                                        versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]],
+                                        documents: typing.Optional[DocumentStore] = None,
+                                        response_cache: typing.Optional[cache.ResponseCache] = None,
+                                        skip: typing.Optional[typing.Set[str]] = None,
+                                        prompt_layout: prompts.PromptLayout = "default"):
+    if documents is None:
+        documents = DocumentStore()
+    if skip is None:
+        skip = set()
     models = list(load.load_described_models(in_file))
-    out_file.parent.mkdir(parents=True, exist_ok=True)
-
-    mention_answers_by_id = load_answers_by_model_id(mention_answers_file)
-    entity_answers_by_id = load_answers_by_model_id(entities_answers_file)
 
-    hint_template_path = resources_folder / "prompts" / "hints" / "sbvr.txt"
-    hint_template = prompts.Prompt(hint_template_path)
-
-    assert out_file.suffix == ".jsonl", "Can only write batches to JSON lines file"
-
-    with open(out_file, "w", encoding="utf-8") as out_f:
-        for described_model in tqdm.tqdm(models):
-            image_path = resources_folder / "images" / f"{described_model.model.id}.png"
-            rules = "\n".join(described_model.sbvr.rules)
-            facts = "\n".join(described_model.sbvr.vocab)
-            assert rules is not None and len(rules) > 0
-            assert facts is not None and len(facts) > 0
-
-            hint = hint_template(rules=rules)
+    mention_index = answers.AnswerIndex(mention_answers_file)
+    entity_index = answers.AnswerIndex(entities_answers_file)
 
+    with mention_index, entity_index, BatchPacker(out_file, response_cache=response_cache) as packer:
+        joined = answers.join_by_model_id(tqdm.tqdm(models), mention_index, entity_index)
+        for described_model, (mention_answers, entity_answers) in joined:
             mentions_annotator = annotate.LLMMentionAnnotator(client, model, reasoning_effort="low")
             entities_annotator = annotate.LLMEntitiesAnnotator(client, model, reasoning_effort="low")
-            relations_annotator = annotate.LLMRelationsAnnotator(client, model, reasoning_effort="low")
-
-            mention_answers = mention_answers_by_id[described_model.model.id]
-            entity_answers = entity_answers_by_id[described_model.model.id]
-
-            if "no_hints" in versions:
-                from_sbvr_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_sbvr.text,
-                                                               described_model.model.id)
-                from_sbvr_doc = mentions_annotator.parser.parse(document=from_sbvr_doc,
-                                                                string=mention_answers["no_hints"].text)
-                from_sbvr_doc = entities_annotator.parser.parse(document=from_sbvr_doc,
-                                                                string=entity_answers["no_hints"].text)
-                sbvr_annotation = relations_annotator.batch_line(doc=from_sbvr_doc, hints=None, image_path=None)
-                out_f.write(json.dumps(sbvr_annotation) + "\n")
-
-            if "sbvr" in versions:
-                from_sbvr_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_sbvr.text,
-                                                               described_model.model.id)
-                from_sbvr_doc = mentions_annotator.parser.parse(document=from_sbvr_doc,
-                                                                string=mention_answers["sbvr"].text)
-                from_sbvr_doc = entities_annotator.parser.parse(document=from_sbvr_doc,
-                                                                string=entity_answers["sbvr"].text)
-                sbvr_annotation = relations_annotator.batch_line(doc=from_sbvr_doc, hints=hint, image_path=None)
-                out_f.write(json.dumps(sbvr_annotation) + "\n")
-
-            if "image" in versions:
-                from_image_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_picture.text,
-                                                                described_model.model.id)
-                from_image_doc = mentions_annotator.parser.parse(document=from_image_doc,
-                                                                 string=mention_answers["image"].text)
-                from_image_doc = entities_annotator.parser.parse(document=from_image_doc,
-                                                                 string=entity_answers["image"].text)
-                image_annotation = relations_annotator.batch_line(doc=from_image_doc, hints=None, image_path=image_path)
-                out_f.write(json.dumps(image_annotation) + "\n")
-
-            if "combined" in versions:
-                from_combined_doc = annotate.parse_text_to_pet_doc(described_model.descriptions.from_both.text,
-                                                                   described_model.model.id)
-                from_combined_doc = mentions_annotator.parser.parse(document=from_combined_doc,
-                                                                    string=mention_answers["combined"].text)
-                from_combined_doc = entities_annotator.parser.parse(document=from_combined_doc,
-                                                                    string=entity_answers["combined"].text)
-                combined_annotation = relations_annotator.batch_line(doc=from_combined_doc, hints=hint,
-                                                                     image_path=image_path)
-                out_f.write(json.dumps(combined_annotation) + "\n")
+            relations_annotator = annotate.LLMRelationsAnnotator(client, model, reasoning_effort="low",
+                                                                 prompt_layout=prompt_layout)
+
+            for version in annotation_versions:
+                if version not in versions or annotation_custom_id(relations_annotator, described_model, version) in skip:
+                    continue
+                if version not in mention_answers or version not in entity_answers:
+                    # earlier stages failed, requested again by the next run
+                    continue
+                doc = documents.parsed(described_model, version, [
+                    (mentions_annotator.parser, mention_answers[version].text),
+                    (entities_annotator.parser, entity_answers[version].text),
+                ])
+                packer.add(annotation_request(relations_annotator, doc, described_model, version))
 
 
 def count_selected_models(*, models_dir: pathlib.Path) -> int:
@@ -370,44 +766,247 @@ def start_batch(*, batch_file_path: pathlib.Path, client: openai.OpenAI) -> Batc
 def check_batch_status(*, batch_info_file_path: pathlib.Path, client: openai.OpenAI) -> str:
     with open(batch_info_file_path, "r") as f:
         batch = Batch.model_validate_json(f.read())
+    status = batch.status
     batch = client.batches.retrieve(batch.id)
-    with open(batch_info_file_path, "w") as f:
-        f.write(batch.model_dump_json())
+    # the info only changes with the status, apart from progress
+    if batch.status != status:
+        with open(batch_info_file_path, "w") as f:
+            f.write(batch.model_dump_json())
     return batch.status
 
 
-def wait_for_batches(batch_info_file_paths: typing.List[pathlib.Path], client: openai.OpenAI) -> None:
-    symbols = {
-        "validating": f"{colorama.Fore.YELLOW}▁",
-        "in_progress": f"{colorama.Fore.YELLOW}▄",
-        "finalizing": f"{colorama.Fore.YELLOW}▆",
-        "completed": f"{colorama.Fore.GREEN}█",
-
-        "expired": f"{colorama.Fore.RED}▓",
-        "failed": f"{colorama.Fore.RED}▓",
-        "cancelling": f"{colorama.Fore.YELLOW}░",
-        "cancelled": f"{colorama.Fore.RED}▓"
-    }
-
-    terminated = [
-        "failed", "expired", "cancelled", "completed"
-    ]
+batch_symbols = {
+    "validating": f"{colorama.Fore.YELLOW}▁",
+    "in_progress": f"{colorama.Fore.YELLOW}▄",
+    "finalizing": f"{colorama.Fore.YELLOW}▆",
+    "completed": f"{colorama.Fore.GREEN}█",
+
+    "expired": f"{colorama.Fore.RED}▓",
+    "failed": f"{colorama.Fore.RED}▓",
+    "cancelling": f"{colorama.Fore.YELLOW}░",
+    "cancelled": f"{colorama.Fore.RED}▓"
+}
+
+terminated_batch_statuses = [
+    "failed", "expired", "cancelled", "completed"
+]
+
+# seconds until a batch is checked again after its status changed, doubled with every check without change
+batch_poll_intervals = {
+    "validating": 5,
+    "in_progress": 30,
+    "finalizing": 10,
+    "cancelling": 10,
+}
+max_batch_poll_interval = 300
+
+
+class BatchPoller:
+    """
+    Checks the status of batches concurrently, on up to max_workers connections of the client's
+    pool. Each batch is checked again after an interval depending on its status, e.g., batches in
+    progress less often than finalizing ones. The interval doubles with every check that finds the
+    status unchanged, up to max_batch_poll_interval.
+    """
+
+    def __init__(self, client: openai.OpenAI, *, max_workers: int = 16):
+        self._client = client
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.statuses: typing.Dict[pathlib.Path, str] = {}
+        self._intervals: typing.Dict[pathlib.Path, float] = {}
+        self._next_checks: typing.Dict[pathlib.Path, float] = {}
+        self._terminated: typing.List[pathlib.Path] = []
+
+    def add(self, batch_info_file_path: pathlib.Path) -> None:
+        with open(batch_info_file_path, "r") as f:
+            self.statuses[batch_info_file_path] = Batch.model_validate_json(f.read()).status
+        if self.statuses[batch_info_file_path] in terminated_batch_statuses:
+            # terminated before, e.g., in an interrupted run, reported by the next poll
+            self._terminated.append(batch_info_file_path)
+        self._intervals[batch_info_file_path] = batch_poll_intervals.get(self.statuses[batch_info_file_path], 5)
+        self._next_checks[batch_info_file_path] = time.monotonic()
+
+    @property
+    def pending(self) -> typing.List[pathlib.Path]:
+        return [p for p, status in self.statuses.items() if status not in terminated_batch_statuses]
+
+    def next_poll_in(self) -> float:
+        if len(self._terminated) > 0 or len(self.pending) == 0:
+            return 0
+        return max(0.0, min(self._next_checks[p] for p in self.pending) - time.monotonic())
+
+    def _reschedule(self, batch_info_file_path: pathlib.Path, status: str) -> None:
+        if status != self.statuses[batch_info_file_path]:
+            self._intervals[batch_info_file_path] = batch_poll_intervals.get(status, 5)
+        else:
+            self._intervals[batch_info_file_path] = min(max_batch_poll_interval,
+                                                        self._intervals[batch_info_file_path] * 2)
+        self.statuses[batch_info_file_path] = status
+        self._next_checks[batch_info_file_path] = time.monotonic() + self._intervals[batch_info_file_path]
+
+    def poll(self) -> typing.List[pathlib.Path]:
+        """
+        Checks all batches that are due, returns those that terminated, in the order they did.
+        """
+        terminated, self._terminated = self._terminated, []
+        now = time.monotonic()
+        due = [p for p in self.pending if self._next_checks[p] <= now]
+        futures = {
+            self._executor.submit(check_batch_status, batch_info_file_path=p, client=self._client): p
+            for p in due
+        }
+        for future in concurrent.futures.as_completed(futures):
+            batch_info_file_path = futures[future]
+            try:
+                status = future.result()
+            except openai.OpenAIError as e:
+                print(f"\nCould not check batch {batch_info_file_path.stem}: {e}")
+                status = self.statuses[batch_info_file_path]
+            self._reschedule(batch_info_file_path, status)
+            if status in terminated_batch_statuses:
+                terminated.append(batch_info_file_path)
+        return terminated
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
+def wait_for_batches(batch_info_file_paths: typing.List[pathlib.Path],
+                     client: openai.OpenAI,
+                     *,
+                     on_terminated: typing.Optional[typing.Callable[[pathlib.Path], None]] = None,
+                     max_workers: int = 16) -> None:
+    """
+    Waits for all batches to terminate, see BatchPoller. on_terminated is called for each batch as
+    soon as it terminated, e.g., to download its answers while others are still running. Calls run
+    concurrently, on up to 4 threads.
+    """
+    poller = BatchPoller(client, max_workers=max_workers)
+    downloads = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    futures = []
+    for f in batch_info_file_paths:
+        poller.add(f)
 
-    finished = False
     print()
-    while not finished:
-        status_string = f"Status of {len(batch_info_file_paths)} batches: "
-        finished = True
-        for f in batch_info_file_paths:
-            status = check_batch_status(batch_info_file_path=f, client=client)
-            status_string += symbols[status]
-            if status not in terminated:
-                finished = False
-        print(f"\r[{datetime.now():%Y-%m-%d %H:%M:%S}] {status_string}{colorama.Style.RESET_ALL}", end="", flush=True)
-        if finished:
-            print()
-            break
-        time.sleep(5)
+    try:
+        while True:
+            for f in poller.poll():
+                if on_terminated is not None:
+                    futures.append(downloads.submit(on_terminated, f))
+            status_string = f"Status of {len(batch_info_file_paths)} batches: "
+            status_string += "".join(batch_symbols[poller.statuses[f]] for f in batch_info_file_paths)
+            print(f"\r[{datetime.now():%Y-%m-%d %H:%M:%S}] {status_string}{colorama.Style.RESET_ALL}", end="", flush=True)
+            if len(poller.pending) == 0:
+                print()
+                break
+            time.sleep(poller.next_poll_in())
+        # raises errors of downloads
+        for future in futures:
+            future.result()
+    finally:
+        poller.close()
+        downloads.shutdown()
+
+
+def answered_custom_ids(answers_file_path: pathlib.Path) -> typing.Set[str]:
+    answered = set()
+    with open(answers_file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            answer_line = json.loads(line)
+            if answers.completion_from_line(answer_line) is not None:
+                answered.add(answer_line["custom_id"])
+    return answered
+
+
+def answer_stage(stage_directory: pathlib.Path,
+                 sources: typing.List[str],
+                 generate: typing.Callable[[str, pathlib.Path, typing.Set[str]], None],
+                 *,
+                 client: openai.OpenAI,
+                 pipeline_state: state.PipelineState,
+                 response_cache: typing.Optional[cache.ResponseCache] = None,
+                 max_attempts: int = 3) -> None:
+    """
+    Answers all requests of a stage, e.g., mentions, for each source, i.e., models file, and merges
+    them into stage_directory / "answers" / <source>.jsonl. generate(source, batch_file_path, skip)
+    writes the requests of a source, except those in skip, e.g., generate_mention_annotations_batch.
+
+    Progress is kept in pipeline_state, so an interrupted stage continues where it stopped: only
+    requests not sent before, or failed, are generated, in a new batch per attempt, only shards not
+    started before are uploaded, and only answers not downloaded before are downloaded. Failed
+    requests are sent again in a retry batch, up to max_attempts times per run, the errors of those
+    that still failed are merged into stage_directory / "errors" / <source>.jsonl.
+    """
+    stage = stage_directory.name
+    usage = answers.TokenUsage()
+
+    for attempt in range(max_attempts):
+        if attempt == 0:
+            retry_sources = sources
+        else:
+            retry_sources = [source for source in sources
+                             if len(pipeline_state.custom_ids(stage, source=source, statuses=["failed"])) > 0]
+            if len(retry_sources) == 0:
+                break
+            print(f"Retrying failed {stage} requests of {len(retry_sources)} sources ...")
+
+        print(f"Generating {stage} batches ...")
+        for source in tqdm.tqdm(retry_sources):
+            skip = pipeline_state.custom_ids(stage, source=source, statuses=["generated", "answered"])
+            num_batches = pipeline_state.num_batches(stage, source)
+            name = source if num_batches == 0 else f"{source}-retry{num_batches}"
+            batch_file_path = stage_directory / "inputs" / f"{name}.jsonl"
+            generate(source, batch_file_path, skip)
+            manifest = load_manifest(manifest_path(batch_file_path))
+            if len(manifest["custom_ids"]) == 0:
+                # nothing left to request, the name is used by the next run that has
+                manifest_path(batch_file_path).unlink()
+                continue
+            pipeline_state.record_manifest(stage, source, name, manifest)
+
+        print(f"Uploading {stage} batches ...")
+        for shard in tqdm.tqdm(pipeline_state.shards(stage, statuses=["generated"])):
+            start_batch(batch_file_path=stage_directory / "inputs" / f"{shard}.jsonl", client=client)
+            pipeline_state.set_shard_status(stage, shard, "started")
+
+        shards = pipeline_state.shards(stage, statuses=["started"])
+        if len(shards) > 0:
+            print(f"Waiting for {stage} batch completion ...")
+            wait_for_batches([stage_directory / "infos" / f"{shard}.json" for shard in shards], client=client,
+                             on_terminated=lambda path: write_batch_answers([path], client=client))
+        for shard in shards:
+            if incomplete_batch_answers(stage_directory / "infos" / f"{shard}.json"):
+                # stays started, so its answers are downloaded again by the next run
+                print(f"Answers of batch {shard} are incomplete, skipping it.")
+                continue
+            answers_file_path = stage_directory / "outputs" / f"{shard}.jsonl"
+            if not answers_file_path.exists():
+                print(f"Batch {shard} answered no request.")
+                pipeline_state.record_answers(stage, shard, set())
+                continue
+            if response_cache is not None:
+                cache_answers(stage_directory / "inputs" / f"{shard}.jsonl", answers_file_path, response_cache)
+            pipeline_state.record_answers(stage, shard, answered_custom_ids(answers_file_path))
+            usage.update(answers.token_usage(answers_file_path))
+    if usage.num_answers > 0:
+        print(f"Answered {stage}: {usage}.")
+
+    for source in sources:
+        merge_answers([stage_directory / "outputs" / f"{shard}.jsonl"
+                       for shard in pipeline_state.answer_shards(stage, source)],
+                      pipeline_state.custom_ids(stage, source=source, statuses=["answered"]),
+                      stage_directory / "answers" / f"{source}.jsonl",
+                      name=f"{stage} of {source}")
+        failed = pipeline_state.custom_ids(stage, source=source, statuses=["failed"])
+        if len(failed) > 0:
+            merge_answers([stage_directory / "errors" / f"{shard}.jsonl"
+                           for shard in reversed(pipeline_state.shards(stage, source=source))],
+                          failed,
+                          stage_directory / "errors" / f"{source}.jsonl")
+            print(f"{len(failed)} {stage} requests of {source} failed, they are generated again by the next run, "
+                  f"see {stage_directory / 'errors' / f'{source}.jsonl'}.")
 
 
 def models_from_answers(*,
@@ -418,40 +1017,136 @@ def models_from_answers(*,
                         entities_answers_path: pathlib.Path,
                         relations_answers_path: pathlib.Path,
                         out_directory: pathlib.Path,
-                        version: typing.Literal["sbvr", "image", "combined", "no_hints"]):
-    models = list(load.load_described_models(model_path))
-    out_directory.parent.mkdir(parents=True, exist_ok=True)
+                        versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]],
+                        documents: typing.Optional[DocumentStore] = None):
+    """
+    Writes the documents of all versions of the models in model_path in a single pass over the
+    models, see answers.join_by_model_id.
+    """
+    if documents is None:
+        documents = DocumentStore()
+    mentions_annotator = annotate.LLMMentionAnnotator(client, model)
+    entities_annotator = annotate.LLMEntitiesAnnotator(client, model)
+    relations_annotator = annotate.LLMRelationsAnnotator(client, model)
+
+    out_files = {}
+    for version in versions:
+        out_file = out_directory / version / f"{model_path.stem}.jsonl"
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        out_files[version] = open(out_file, "w")
+
+    mention_index = answers.AnswerIndex(mention_answers_path)
+    entity_index = answers.AnswerIndex(entities_answers_path)
+    relation_index = answers.AnswerIndex(relations_answers_path)
+    try:
+        joined = answers.join_by_model_id(tqdm.tqdm(load.load_described_models(model_path)),
+                                          mention_index, entity_index, relation_index)
+        for described_model, (mention_answers, entity_answers, relation_answers) in joined:
+            for version in versions:
+                if version not in relation_answers:
+                    # an annotation stage failed, requested again by the next run
+                    continue
+                doc = documents.parsed(described_model, version, [
+                    (mentions_annotator.parser, mention_answers[version].text),
+                    (entities_annotator.parser, entity_answers[version].text),
+                ])
+                doc = relations_annotator.parser.parse(document=doc, string=relation_answers[version].text)
+                out_files[version].write(json.dumps(data.PetDictExporter().export_document(doc)) + "\n")
+    finally:
+        for f in out_files.values():
+            f.close()
+        for index in [mention_index, entity_index, relation_index]:
+            index.close()
+
+
+def run(*,
+        resources_dir: pathlib.Path,
+        client: openai.OpenAI,
+        pipeline_state: state.PipelineState,
+        versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]],
+        example: typing.Optional[str],
+        max_files: typing.Optional[int] = None,
+        documents: typing.Optional[DocumentStore] = None,
+        response_cache: typing.Optional[cache.ResponseCache] = None,
+        prompt_layout: prompts.PromptLayout = "default"):
+    """
+    Describes the SBVR models of the first max_files files in resources_dir / "models" / "sbvr",
+    annotates the descriptions, and writes the documents to resources_dir / "docs". Can be
+    interrupted at any time, and is continued from pipeline_state by the next run.
+    """
+    if documents is None:
+        documents = DocumentStore()
+    batches_dir = resources_dir / "batches"
+    described_dir = resources_dir / "models" / "described"
+
+    sources = sorted(f.stem for f in (resources_dir / "models" / "sbvr").iterdir() if f.suffix == ".csv")
+    if max_files is not None:
+        sources = sources[:max_files]
+
+    answer_stage(
+        batches_dir / "descriptions", sources,
+        lambda source, out_file, skip: generate_descriptions_batch(
+            in_file=resources_dir / "models" / "sbvr" / f"{source}.csv", out_file=out_file,
+            client=client, model="gpt-5-nano-2025-08-07", example=example, versions=versions,
+            response_cache=response_cache, skip=skip, prompt_layout=prompt_layout
+        ),
+        client=client, pipeline_state=pipeline_state, response_cache=response_cache
+    )
+
+    print("Batches completed, writing csv ...")
+    for source in tqdm.tqdm(sources):
+        write_described(
+            models_sbvr_file_path=resources_dir / "models" / "sbvr" / f"{source}.csv",
+            answers_file_path=batches_dir / "descriptions" / "answers" / f"{source}.jsonl",
+            output_file_path=described_dir / f"{source}.csv"
+        )
 
-    mention_answers_by_id = load_answers_by_model_id(mention_answers_path)
-    entity_answers_by_id = load_answers_by_model_id(entities_answers_path)
-    relation_answers_by_id = load_answers_by_model_id(relations_answers_path)
+    answer_stage(
+        batches_dir / "mentions", sources,
+        lambda source, out_file, skip: generate_mention_annotations_batch(
+            in_file=described_dir / f"{source}.csv", out_file=out_file,
+            client=client, model="gpt-5-mini-2025-08-07", versions=versions, documents=documents,
+            response_cache=response_cache, skip=skip, prompt_layout=prompt_layout
+        ),
+        client=client, pipeline_state=pipeline_state, response_cache=response_cache
+    )
 
-    out_file = out_directory / version / f"{model_path.stem}.jsonl"
-    out_file.parent.mkdir(parents=True, exist_ok=True)
+    answer_stage(
+        batches_dir / "entities", sources,
+        lambda source, out_file, skip: generate_entity_annotations_batch(
+            in_file=described_dir / f"{source}.csv", out_file=out_file,
+            mention_answers_file=batches_dir / "mentions" / "answers" / f"{source}.jsonl",
+            client=client, model="gpt-5-mini-2025-08-07", versions=versions, documents=documents,
+            response_cache=response_cache, skip=skip, prompt_layout=prompt_layout
+        ),
+        client=client, pipeline_state=pipeline_state, response_cache=response_cache
+    )
 
-    with open(out_file, "w") as f:
-        for described_model in tqdm.tqdm(models):
-            mentions_annotator = annotate.LLMMentionAnnotator(client, model)
-            entities_annotator = annotate.LLMEntitiesAnnotator(client, model)
-            relations_annotator = annotate.LLMRelationsAnnotator(client, model)
-
-            mention_answers = mention_answers_by_id[described_model.model.id]
-            entity_answers = entity_answers_by_id[described_model.model.id]
-            relation_answers = relation_answers_by_id[described_model.model.id]
-
-            if version == "sbvr" or version == "no_hints":
-                text = described_model.descriptions.from_sbvr.text
-            elif version == "image":
-                text = described_model.descriptions.from_picture.text
-            elif version == "combined":
-                text = described_model.descriptions.from_both.text
-            else:
-                raise ValueError(f"Unknown version {version}")
-            doc = annotate.parse_text_to_pet_doc(text, described_model.model.id)
-            doc = mentions_annotator.parser.parse(document=doc, string=mention_answers[version].text)
-            doc = entities_annotator.parser.parse(document=doc, string=entity_answers[version].text)
-            doc = relations_annotator.parser.parse(document=doc, string=relation_answers[version].text)
-            f.write(json.dumps(data.PetDictExporter().export_document(doc)) + "\n")
+    answer_stage(
+        batches_dir / "relations", sources,
+        lambda source, out_file, skip: generate_relation_annotations_batch(
+            in_file=described_dir / f"{source}.csv", out_file=out_file,
+            mention_answers_file=batches_dir / "mentions" / "answers" / f"{source}.jsonl",
+            entities_answers_file=batches_dir / "entities" / "answers" / f"{source}.jsonl",
+            client=client, model="gpt-5-mini-2025-08-07", versions=versions, documents=documents,
+            response_cache=response_cache, skip=skip, prompt_layout=prompt_layout
+        ),
+        client=client, pipeline_state=pipeline_state, response_cache=response_cache
+    )
+
+    print("Dumping generated documents ...")
+    for source in tqdm.tqdm(sources):
+        models_from_answers(
+            client=client,
+            model="gpt-5-nano-2025-08-07",
+            model_path=described_dir / f"{source}.csv",
+            mention_answers_path=batches_dir / "mentions" / "answers" / f"{source}.jsonl",
+            entities_answers_path=batches_dir / "entities" / "answers" / f"{source}.jsonl",
+            relations_answers_path=batches_dir / "relations" / "answers" / f"{source}.jsonl",
+            out_directory=resources_dir / "docs",
+            versions=versions,
+            documents=documents
+        )
 
 
 def main():
@@ -461,7 +1156,12 @@ def main():
     # model = "gpt-5-2025-08-07"
     resources_dir = pathlib.Path(__file__).parent.parent / "resources"
 
-    client = openai.OpenAI()
+    client = registry.openai_client()
+    # images.cache = images.ImageCache(max_side=1024)
+    # unchanged requests of earlier runs are answered from the cache, instead of being sent again
+    responses = cache.ResponseCache(cache.PersistentCache(responses_cache_path))
+    # what was generated, sent, and answered, so an interrupted run continues where it stopped
+    pipeline_state = state.PipelineState(resources_dir / "batches" / "state.sqlite")
 
     total_num_selected = count_selected_models(models_dir=resources_dir / "models" / "selected")
     print(f"Selected {total_num_selected} models!")
@@ -470,111 +1170,17 @@ def main():
         example = f.read()
 
     versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]] = ["no_hints"]
-
-    print("Generating batches for process description ...")
-    max_files: typing.Optional[int] = 10
-    for f in tqdm.tqdm((resources_dir / "models" / "sbvr").iterdir()):
-        batch_file_path = (resources_dir / "batches" / "descriptions" / "inputs" / f"{f.stem}.jsonl")
-        batch_file_path.parent.mkdir(parents=True, exist_ok=True)
-        if batch_file_path.exists():
-            pass
-        generate_descriptions_batch(in_file=f,
-                                    out_file=batch_file_path,
-                                    client=client,
-                                    model="gpt-5-nano-2025-08-07",
-                                    example=example,
-                                    versions=versions)
-
-        if max_files is not None:
-            max_files -= 1
-            if max_files <= 0:
-                break
-
-    print("Uploading batches ...")
-    for batch_file_path in (resources_dir / "batches" / "descriptions" / "inputs").iterdir():
-        start_batch(batch_file_path=batch_file_path, client=client)
-
-    print("Waiting for batch completion ...")
-    description_batch_info_paths = list((resources_dir / "batches" / "descriptions" / "infos").iterdir())
-    wait_for_batches(description_batch_info_paths, client=client)
-    write_batch_answers(description_batch_info_paths, client=client)
-
-    print("Batches completed, writing csv ...")
-    for f in tqdm.tqdm((resources_dir / "batches" / "descriptions" / "outputs").iterdir()):
-        write_described(
-            models_sbvr_file_path=resources_dir / "models" / "sbvr" / f"{f.stem}.csv",
-            answers_file_path=f,
-            output_file_path=resources_dir / "models" / "described" / f"{f.stem}.csv"
-        )
-
-    print("Building mention annotation batches ...")
-    for f in tqdm.tqdm((resources_dir / "models" / "described").iterdir()):
-        out_f = resources_dir / "batches" / "mentions" / "inputs" / f"{f.stem}.jsonl"
-        generate_mention_annotations_batch(in_file=f, out_file=out_f,
-                                           client=client, model="gpt-5-mini-2025-08-07",
-                                           versions=versions)
-
-    print("Uploading batches ...")
-    batch_file_path = resources_dir / "batches" / "mentions" / "inputs"
-    for f in tqdm.tqdm(batch_file_path.iterdir()):
-        start_batch(batch_file_path=f, client=client)
-
-    print("Waiting for batch completion ...")
-    mention_batches = list((resources_dir / "batches" / "mentions" / "infos").iterdir())
-    wait_for_batches(mention_batches, client=client)
-    write_batch_answers(mention_batches, client=client)
-
-    print("Building entity annotation batches ...")
-    for f in tqdm.tqdm((resources_dir / "models" / "described").iterdir()):
-        out_f = resources_dir / "batches" / "entities" / "inputs" / f"{f.stem}.jsonl"
-        mentions_answer_f = resources_dir / "batches" / "mentions" / "outputs" / f"{f.stem}.jsonl"
-        generate_entity_annotations_batch(in_file=f, out_file=out_f, mention_answers_file=mentions_answer_f,
-                                          client=client, model="gpt-5-mini-2025-08-07",
-                                          versions=versions)
-    print("Uploading batches ...")
-    batch_file_path = resources_dir / "batches" / "entities" / "inputs"
-    for f in tqdm.tqdm(batch_file_path.iterdir()):
-        start_batch(batch_file_path=f, client=client)
-
-    print("Waiting for batch completion ...")
-    entity_batches = list((resources_dir / "batches" / "entities" / "infos").iterdir())
-    wait_for_batches(entity_batches, client=client)
-    write_batch_answers(entity_batches, client=client)
-
-    print("Building relation annotation batches ...")
-    for f in tqdm.tqdm((resources_dir / "models" / "described").iterdir()):
-        out_f = resources_dir / "batches" / "relations" / "inputs" / f"{f.stem}.jsonl"
-        mentions_answer_f = resources_dir / "batches" / "mentions" / "outputs" / f"{f.stem}.jsonl"
-        entities_answer_f = resources_dir / "batches" / "entities" / "outputs" / f"{f.stem}.jsonl"
-        generate_relation_annotations_batch(in_file=f, out_file=out_f,
-                                            mention_answers_file=mentions_answer_f,
-                                            entities_answers_file=entities_answer_f,
-                                            client=client, model="gpt-5-mini-2025-08-07",
-                                            versions=versions)
-
-    print("Uploading batches ...")
-    batch_file_path = resources_dir / "batches" / "relations" / "inputs"
-    for f in tqdm.tqdm(batch_file_path.iterdir()):
-        start_batch(batch_file_path=f, client=client)
-
-    print("Waiting for batch completion ...")
-    relation_batches = list((resources_dir / "batches" / "relations" / "infos").iterdir())
-    wait_for_batches(relation_batches, client=client)
-    write_batch_answers(relation_batches, client=client)
-
-    print("Dumping generated documents ...")
-    for f in tqdm.tqdm((resources_dir / "models" / "described").iterdir()):
-        for version in versions:
-            models_from_answers(
-                client=client,
-                model="gpt-5-nano-2025-08-07",
-                model_path=f,
-                mention_answers_path=resources_dir / "batches" / "mentions" / "outputs" / f"{f.stem}.jsonl",
-                entities_answers_path=resources_dir / "batches" / "entities" / "outputs" / f"{f.stem}.jsonl",
-                relations_answers_path=resources_dir / "batches" / "relations" / "outputs" / f"{f.stem}.jsonl",
-                out_directory=resources_dir / "docs",
-                version=version
-            )
+    # "prefix" orders requests for the provider's prompt cache, but changes them, i.e., all are sent again
+    prompt_layout: prompts.PromptLayout = "default"
+
+    try:
+        # descriptions are tokenized once, by the first stage that needs them
+        run(resources_dir=resources_dir, client=client, pipeline_state=pipeline_state, versions=versions,
+            example=example, max_files=10, documents=DocumentStore(), response_cache=responses,
+            prompt_layout=prompt_layout)
+    finally:
+        pipeline_state.close()
+    print(f"{responses}.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+import base64
+import collections
+import hashlib
+import json
+import pathlib
+import sqlite3
+import typing
+
+import openai
+from openai.types.chat import ChatCompletion
+
+
+class PersistentCache:
+    """
+    Cache of json-serializable values, stored in a SQLite database, with the most recently used
+    entries kept in memory in front of it. Entries are grouped by namespace, e.g., the name and
+    version of the model that produced them, so results of different models never mix.
+
+    Without a path, entries are only kept in memory. Each process should use its own instance,
+    the database handles concurrent access of several processes.
+    """
+
+    # SQLite limits the number of parameters per statement
+    _max_keys_per_query = 500
+
+    def __init__(self, path: typing.Optional[pathlib.Path], max_memory_entries: int = 100_000):
+        self._path = path
+        self._max_memory_entries = max_memory_entries
+        self._memory: typing.OrderedDict[typing.Tuple[str, str], typing.Any] = collections.OrderedDict()
+        self._connection: typing.Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self._path, timeout=60)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+        return self._connection
+
+    def _remember(self, namespace: str, key: str, value: typing.Any) -> None:
+        self._memory[(namespace, key)] = value
+        self._memory.move_to_end((namespace, key))
+        while len(self._memory) > self._max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, namespace: str, keys: typing.Iterable[str]) -> typing.Dict[str, typing.Any]:
+        """
+        Returns the cached values of all given keys, that are in the cache, keys not cached are missing.
+        """
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            if (namespace, key) in self._memory:
+                self._memory.move_to_end((namespace, key))
+                found[key] = self._memory[(namespace, key)]
+            else:
+                missing.append(key)
+
+        if self._path is None or len(missing) == 0:
+            return found
+        connection = self._connect()
+        for i in range(0, len(missing), self._max_keys_per_query):
+            chunk = missing[i:i + self._max_keys_per_query]
+            rows = connection.execute(
+                f"SELECT key, value FROM entries WHERE namespace = ? AND key IN ({', '.join('?' * len(chunk))})",
+                [namespace, *chunk]
+            )
+            for key, value in rows:
+                found[key] = json.loads(value)
+                self._remember(namespace, key, found[key])
+        return found
+
+    def get(self, namespace: str, key: str, default: typing.Any = None) -> typing.Any:
+        return self.get_many(namespace, [key]).get(key, default)
+
+    def put(self, namespace: str, key: str, value: typing.Any) -> None:
+        self.put_many(namespace, {key: value})
+
+    def put_many(self, namespace: str, values: typing.Dict[str, typing.Any]) -> None:
+        for key, value in values.items():
+            self._remember(namespace, key, value)
+        if self._path is None or len(values) == 0:
+            return
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries (namespace, key, value) VALUES (?, ?, ?)",
+                ((namespace, key, json.dumps(value)) for key, value in values.items())
+            )
+
+
+def request_fingerprint(body: typing.Dict) -> str:
+    """
+    Hash of all parameters of a chat completion request, e.g., model, reasoning effort, and messages.
+    Images sent as data URLs are replaced by the hash of their bytes.
+    """
+    messages = []
+    for message in body["messages"]:
+        content = message["content"]
+        if not isinstance(content, str):
+            content = [
+                {**part, "image_url": {**part["image_url"], "url": _image_fingerprint(part["image_url"]["url"])}}
+                if part["type"] == "image_url" else part
+                for part in content
+            ]
+        messages.append({**message, "content": content})
+    key = json.dumps({**body, "messages": messages}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _image_fingerprint(url: str) -> str:
+    if not url.startswith("data:"):
+        return url
+    media_type, encoded = url[len("data:"):].split(";base64,", 1)
+    return f"{media_type};sha256:{hashlib.sha256(base64.b64decode(encoded)).hexdigest()}"
+
+
+class ResponseCache:
+    """
+    Responses of chat completion requests by request_fingerprint, so unchanged requests are answered
+    without calling the API again, e.g., after editing only some of the prompts. Responses are stored
+    as the bodies of batch answers, i.e., dumped chat completions.
+    """
+
+    _namespace = "chat-completions"
+
+    def __init__(self, persistent_cache: PersistentCache):
+        self._cache = persistent_cache
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, body: typing.Dict) -> typing.Optional[typing.Dict]:
+        response = self._cache.get(self._namespace, request_fingerprint(body))
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def put(self, body: typing.Dict, response: typing.Dict) -> None:
+        self._cache.put(self._namespace, request_fingerprint(body), response)
+
+    def put_many(self, responses: typing.List[typing.Tuple[typing.Dict, typing.Dict]]) -> None:
+        self._cache.put_many(self._namespace, {request_fingerprint(body): response for body, response in responses})
+
+    def complete(self, client: openai.OpenAI, body: typing.Dict) -> ChatCompletion:
+        """
+        Answers a request from the cache, or with the API, caching the response.
+        """
+        response = self.get(body)
+        if response is not None:
+            return ChatCompletion.model_validate(response)
+        completion = client.chat.completions.create(**body)
+        self.put(body, completion.model_dump(mode="json"))
+        return completion
+
+    @property
+    def hit_rate(self) -> float:
+        if self.hits + self.misses == 0:
+            return 0.0
+        return self.hits / (self.hits + self.misses)
+
+    def __str__(self):
+        return f"{self.hits} of {self.hits + self.misses} requests answered from cache ({self.hit_rate:.1%})"
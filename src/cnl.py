@@ -1,11 +1,13 @@
+import concurrent.futures
 import csv
+import os
 import pathlib
 import typing
 
-import dotenv
 import networkx as nx
 import tqdm
 
+import cache
 import conversion
 import load
 import mappings
@@ -13,21 +15,27 @@ import postprocess
 import templating
 from templating import util
 
-dotenv.load_dotenv()
-
 resources_folder = pathlib.Path(__file__).parent.parent / "resources"
 
 
-def post_process_graph(graph: nx.DiGraph):
-    postprocessing_pipeline = [
+def postprocessing_pipeline() -> typing.List[postprocess.BaseProcessor]:
+    # label analyses are kept between runs, so labels are parsed only once
+    label_cache = cache.PersistentCache(resources_folder / "cache" / "labels.sqlite")
+    return [
         # postprocess.DataObjectAssociationProcessor(),
-        # postprocess.DataObjectLabelProcessor(),
-        postprocess.NounActivityProcessor(),
+        # postprocess.DataObjectLabelProcessor(label_cache),
+        postprocess.NounActivityProcessor(label_cache),
         postprocess.MultiLineLabelProcessor(),
         # postprocess.DeferredChoiceProcessor(),
         postprocess.UnlabeledActorProcessor()
     ]
-    for p in postprocessing_pipeline:
+
+
+def post_process_graph(graph: nx.DiGraph,
+                       pipeline: typing.Optional[typing.List[postprocess.BaseProcessor]] = None):
+    if pipeline is None:
+        pipeline = postprocessing_pipeline()
+    for p in pipeline:
         p.process(graph)
     return graph
 
@@ -57,9 +65,12 @@ def apply_rule_templates(graph: nx.DiGraph, include_tags=True) -> typing.List[te
         templating.SequenceFlowTemplate(include_tags)
     ]
 
+    # depths and the type index are computed once and shared by all templates,
+    # which still run one after another, in order of priority
+    context = templating.TemplateContext(graph)
     unresolved_rules: typing.List[templating.UnresolvedRule] = []
     for t in rule_templates:
-        for r in t.generate(graph):
+        for r in t.generate(graph, context):
             unresolved_rules.append(r)
     unresolved_rules.sort(key=lambda _r: _r.depth)
 
@@ -68,16 +79,31 @@ def apply_rule_templates(graph: nx.DiGraph, include_tags=True) -> typing.List[te
         for n in r.nodes:
             rule_id_by_node[n] = i
 
+    # resolving a reference does not depend on any other rule, so each distinct reference
+    # is resolved only once, references it resolves to are expanded in the same pass,
+    # up to max_resolve_steps levels deep
     max_resolve_steps = 20
-    while max_resolve_steps > 0:
-        max_resolve_steps -= 1
-        for r in unresolved_rules:
-            refs = [c for c in r.content if isinstance(c, templating.ForwardReference)]
-            for ref in refs:
-                ref_index = r.content.index(ref)
-                resolved = util.resolve_reference(ref, rule_id_by_node, graph, with_tags=include_tags)
-                # splice in the (possible partially) resolved ref
-                r.content = r.content[0:ref_index] + resolved + r.content[ref_index + 1:]
+    resolved_by_ref: typing.Dict[typing.Tuple[str, str], typing.List[str | templating.ForwardReference]] = {}
+    visited_nodes: typing.Set[str] = set()
+
+    def _expand(content: typing.List[str | templating.ForwardReference],
+                steps_left: int) -> typing.List[str | templating.ForwardReference]:
+        expanded = []
+        for c in content:
+            if not isinstance(c, templating.ForwardReference) or steps_left == 0:
+                expanded.append(c)
+                continue
+            key = (c.node, c.resolve_direction)
+            if key not in resolved_by_ref:
+                resolved_by_ref[key] = util.resolve_reference(c, rule_id_by_node, graph,
+                                                              with_tags=include_tags,
+                                                              visited_nodes=visited_nodes)
+            expanded.extend(_expand(resolved_by_ref[key], steps_left - 1))
+        return expanded
+
+    for r in unresolved_rules:
+        r.content = _expand(r.content, max_resolve_steps)
+    util.visit_nodes(graph, list(visited_nodes))
 
     # resolve all unresolved references to their ids
     for r in unresolved_rules:
@@ -99,47 +125,138 @@ def apply_rule_templates(graph: nx.DiGraph, include_tags=True) -> typing.List[te
     ]
 
 
-def generate_sbvr(*, in_file: pathlib.Path, out_file: pathlib.Path):
-    if out_file.exists():
-        print(f"Already generated SBVR for {in_file.name}. Skipping.")
-        return
-
+class SBVRGenerator:
+    """
+    Generates SBVR for single models, keeping the mapping and the post-processors, and with them
+    their NLP models, loaded between models.
+    """
+
+    def __init__(self):
+        self._mapping = mappings.SapSamMappingCollection()
+        self._pipeline = postprocessing_pipeline()
+
+    def __call__(self, model: load.ModelInfo) -> typing.Tuple[load.ModelSBVR, typing.List[str]]:
+        """
+        Returns the SBVR of the given model, and the behaviour nodes no template visited.
+        """
+        return self.generate_all([model])[0]
+
+    def generate_all(self,
+                     models: typing.List[load.ModelInfo]) -> typing.List[typing.Tuple[load.ModelSBVR, typing.List[str]]]:
+        graphs = [conversion.sam_json_to_networkx(m.model_json, self._mapping.all) for m in models]
+        # post-processors see all graphs at once, e.g., to parse their labels in one batch
+        for p in self._pipeline:
+            p.process_all(graphs)
+        return [self._generate_from_graph(model, g) for model, g in zip(models, graphs)]
+
+    def _generate_from_graph(self,
+                             model: load.ModelInfo,
+                             g: nx.DiGraph) -> typing.Tuple[load.ModelSBVR, typing.List[str]]:
+        rules = apply_rule_templates(g, include_tags=True)
+        facts = apply_fact_templates(g)
+
+        unvisited = []
+        behaviour_types = set(self._mapping.behaviour.values())
+        for node, attr in g.nodes(data=True):
+            if attr.get("visited", False):
+                continue
+            if attr["type"] not in behaviour_types:
+                continue
+            unvisited.append(f"{attr['label']} ({attr['type']})")
+
+        model_sbvr = load.ModelSBVR(
+            model=model,
+            sbvr=load.SBVR(
+                rules=[f"R{i}: {r.text}" for i, r in enumerate(rules)],
+                vocab=[f.text for f in facts]
+            )
+        )
+        return model_sbvr, unvisited
+
+
+# generator of a worker process, set up once per worker by _init_worker
+_worker_generator: typing.Optional[SBVRGenerator] = None
+
+
+def _init_worker() -> None:
+    global _worker_generator
+    _worker_generator = SBVRGenerator()
+
+
+def _generate_in_worker(
+        models: typing.List[load.ModelInfo]) -> typing.List[typing.Tuple[load.ModelSBVR, typing.List[str]]]:
+    return _worker_generator.generate_all(models)
+
+
+def _truncate_incomplete_record(path: pathlib.Path) -> int:
+    """
+    Cuts off the last record of a csv file, if it was written only partially, e.g., because
+    generation was interrupted. Records may span lines, so newlines only end a record, if they
+    are outside of quotes. Returns the size of the remaining file.
+    """
+    with open(path, "rb+") as f:
+        content = f.read()
+        end = 0
+        position = 0
+        num_quotes = 0
+        while True:
+            newline = content.find(b"\n", position)
+            if newline == -1:
+                break
+            num_quotes += content.count(b'"', position, newline)
+            position = newline + 1
+            if num_quotes % 2 == 0:
+                end = position
+        if end != len(content):
+            print(f"Discarding incomplete record at the end of {path.name}.")
+            f.truncate(end)
+        return end
+
+
+def generate_sbvr(*,
+                  in_file: pathlib.Path,
+                  out_file: pathlib.Path,
+                  executor: typing.Optional[concurrent.futures.Executor] = None,
+                  chunk_size: int = 16):
+    """
+    Generates SBVR for all models in the given file, appending to out_file, so that models
+    already in there, e.g., from an interrupted run, are skipped. With an executor, whose
+    workers were set up by _init_worker, models are generated in parallel, rows are still
+    written in the order of the input file. Models are generated in chunks of chunk_size.
+    """
     models = list(load.load_raw_models(in_file))
 
+    wrote_header = False
+    if out_file.exists() and _truncate_incomplete_record(out_file) > 0:
+        wrote_header = True
+        done = set(m.model.id for m in load.load_sbvr_models(out_file))
+        models = [m for m in models if m.id not in done]
+        if len(models) == 0:
+            print(f"Already generated SBVR for {in_file.name}. Skipping.")
+            return
+        print(f"Resuming SBVR generation for {in_file.name}, {len(done)} models done already.")
+
+    chunks = [models[i:i + chunk_size] for i in range(0, len(models), chunk_size)]
+    if executor is None:
+        results = map(SBVRGenerator().generate_all, chunks)
+    else:
+        results = executor.map(_generate_in_worker, chunks)
+
     out_file.parent.mkdir(parents=True, exist_ok=True)
-    with open(out_file, "w", encoding="utf-8") as f:
+    with open(out_file, "a", encoding="utf-8") as f, tqdm.tqdm(total=len(models)) as progress:
         writer = csv.writer(f, lineterminator="\n")
-        wrote_header = False
-        for model in tqdm.tqdm(models):
-            mapping = mappings.SapSamMappingCollection()
-            g = conversion.sam_json_to_networkx(model.model_json, mapping.all)
-
-            post_process_graph(g)
-            rules = apply_rule_templates(g, include_tags=True)
-            facts = apply_fact_templates(g)
-
-            unvisited = []
-            for node, attr in g.nodes(data=True):
-                if attr.get("visited", False):
-                    continue
-                if attr["type"] not in mapping.behaviour.values():
-                    continue
-                unvisited.append(f"{attr['label']} ({attr['type']})")
-            if len(unvisited) > 0:
-                print(f"Unvisited nodes in {model.id}: {unvisited}")
-
-            model_sbvr = load.ModelSBVR(
-                model=model,
-                sbvr=load.SBVR(
-                    rules=[f"R{i}: {r.text}" for i, r in enumerate(rules)],
-                    vocab=[f.text for f in facts]
-                )
-            )
+        for chunk_results in results:
+            for model_sbvr, unvisited in chunk_results:
+                if len(unvisited) > 0:
+                    print(f"Unvisited nodes in {model_sbvr.model.id}: {unvisited}")
 
-            if not wrote_header:
-                writer.writerow(model_sbvr.row.keys())
-                wrote_header = True
-            writer.writerow(model_sbvr.row.values())
+                if not wrote_header:
+                    writer.writerow(model_sbvr.row.keys())
+                    wrote_header = True
+                writer.writerow(model_sbvr.row.values())
+                # complete rows only, so generation can resume after an interruption
+                f.flush()
+                progress.update()
 
 
 def count_selected_models(*, models_dir: pathlib.Path) -> int:
@@ -158,18 +275,22 @@ def main():
     total_num_selected = count_selected_models(models_dir=resources_dir / "models" / "selected")
     print(f"Selected {total_num_selected} models!")
 
-    for f in (resources_dir / "models" / "selected").iterdir():
-        if f.suffix != ".csv":
-            continue
-        print(f"Working on file {f.name}")
-
-        # print("\tDrawing models and storing them ...")
-        # show.draw_models_from_file(in_file=f,
-        #                            image_directory=resources_dir / "images",
-        #                            store=False, overwrite=False)
-        print("\tGenerating SBVR from models ...")
-        generate_sbvr(in_file=f,
-                      out_file=(resources_dir / "models" / "sbvr" / f"{f.stem}.csv"))
+    # one pool for all files, so workers load their NLP models only once
+    num_workers = os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker) as executor:
+        for f in (resources_dir / "models" / "selected").iterdir():
+            if f.suffix != ".csv":
+                continue
+            print(f"Working on file {f.name}")
+
+            # print("\tDrawing models and storing them ...")
+            # show.draw_models_from_file(in_file=f,
+            #                            image_directory=resources_dir / "images",
+            #                            store=False, overwrite=False)
+            print("\tGenerating SBVR from models ...")
+            generate_sbvr(in_file=f,
+                          out_file=(resources_dir / "models" / "sbvr" / f"{f.stem}.csv"),
+                          executor=executor)
 
 
 if __name__ == "__main__":
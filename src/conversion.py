@@ -3,7 +3,6 @@ import dataclasses
 import json
 import typing
 
-import matplotlib.pyplot as plt
 import networkx as nx
 
 
@@ -21,7 +20,7 @@ class Visitor:
 
         self._stencil_mapping = stencil_mapping
 
-    def __call__(self, shape: typing.Dict, parents: typing.List[typing.Dict]) -> None:
+    def __call__(self, shape: typing.Dict, executing_actor: typing.Optional[typing.Dict]) -> None:
         stencil = shape["stencil"]["id"]
         name = shape["properties"].get("name", "").strip()
         shape_id: str = shape["resourceId"]
@@ -42,33 +41,35 @@ class Visitor:
             self.edges.append(edge)
 
         # make connection to executing actor
-        executing_actor: typing.Optional[typing.Dict] = None
-        actor_candidates = []
-        for parent in reversed(parents):
-            if parent["stencil"]["id"] in ["Lane", "Pool"]:
-                actor_candidates.append(parent)
-                parent_name = parent["properties"].get("name", "").strip()
-                if len(parent_name) != 0:
-                    executing_actor = parent
-                    break
-        if executing_actor is None and len(actor_candidates) > 0:
-            executing_actor = actor_candidates[0]
         if executing_actor is not None:
             executor_id: str = executing_actor["resourceId"]
             self.edges.append((shape_id, executor_id))
 
 
 def traverse(shape: typing.Dict,
-             parents: typing.List[typing.Dict],
-             visitor: typing.Callable[[typing.Dict, typing.List[typing.Dict]], None]) -> None:
-    visitor(shape, parents)
-    for child in shape["childShapes"]:
-        traverse(child, parents + [shape], visitor)
+             visitor: typing.Callable[[typing.Dict, typing.Optional[typing.Dict]], None]) -> None:
+    """
+    Visits all shapes in pre-order, together with their executing actor, i.e., the nearest
+    enclosing Lane or Pool that has a name, or the nearest one, if none of them has a name.
+    """
+    # (shape, nearest enclosing lane or pool, nearest enclosing named lane or pool)
+    stack: typing.List[typing.Tuple[typing.Dict, typing.Optional[typing.Dict], typing.Optional[typing.Dict]]]
+    stack = [(shape, None, None)]
+    while len(stack) > 0:
+        shape, nearest_actor, nearest_named_actor = stack.pop()
+        visitor(shape, nearest_named_actor if nearest_named_actor is not None else nearest_actor)
+
+        if shape["stencil"]["id"] in ["Lane", "Pool"]:
+            nearest_actor = shape
+            if len(shape["properties"].get("name", "").strip()) != 0:
+                nearest_named_actor = shape
+        for child in reversed(shape["childShapes"]):
+            stack.append((child, nearest_actor, nearest_named_actor))
 
 
 def sam_json_to_networkx(sam_json: typing.Dict, stencil_mapping: typing.Dict[str, str]) -> nx.DiGraph:
     visitor = Visitor(stencil_mapping)
-    traverse(sam_json, [], visitor)
+    traverse(sam_json, visitor)
 
     g = nx.DiGraph()
     g.add_nodes_from((k, {"label": v.label, "type": v.type}) for k, v in visitor.nodes.items())
@@ -76,6 +77,53 @@ def sam_json_to_networkx(sam_json: typing.Dict, stencil_mapping: typing.Dict[str
     return g
 
 
+class ProcessGraphCache:
+    """
+    Process graphs of a single SAP-SAM model, built at most once per stencil mapping.
+    Graphs for a mapping that is part of an already built one (e.g., behaviour elements only,
+    after all elements were converted) are served as subgraph views of the built graph.
+    Graphs are shared between all callers, so they must not be modified.
+    """
+
+    def __init__(self, sam_json: typing.Dict):
+        self._sam_json = sam_json
+        self._graphs: typing.List[typing.Tuple[typing.Dict[str, str], nx.DiGraph]] = []
+
+    def prepare(self, stencil_mappings: typing.Iterable[typing.Dict[str, str]]) -> None:
+        """
+        Converts the model once for the union of the given mappings,
+        so that graphs for each of them can be served as views later.
+        """
+        merged_mapping = {}
+        for stencil_mapping in stencil_mappings:
+            for stencil, node_type in stencil_mapping.items():
+                if merged_mapping.get(stencil, node_type) != node_type:
+                    # mappings disagree on a type, graphs can not be shared
+                    return
+                merged_mapping[stencil] = node_type
+        self.get(merged_mapping)
+
+    def get(self, stencil_mapping: typing.Dict[str, str]) -> nx.DiGraph:
+        for mapping, graph in self._graphs:
+            if mapping == stencil_mapping:
+                return graph
+
+        view_types = set(stencil_mapping.values())
+        for mapping, graph in self._graphs:
+            if any(mapping.get(stencil) != node_type for stencil, node_type in stencil_mapping.items()):
+                continue
+            if any(stencil not in stencil_mapping for stencil, node_type in mapping.items() if node_type in view_types):
+                # some other stencil maps to one of the requested types, can't tell them apart by type
+                continue
+            view = graph.subgraph(n for n, node_type in graph.nodes(data="type") if node_type in view_types)
+            self._graphs.append((stencil_mapping, view))
+            return view
+
+        graph = sam_json_to_networkx(self._sam_json, stencil_mapping)
+        self._graphs.append((stencil_mapping, graph))
+        return graph
+
+
 def draw_process_graph(g: nx.DiGraph):
     pos = nx.spring_layout(g)
     labels = {
@@ -95,3 +143,41 @@ def draw_process_graph(g: nx.DiGraph):
     nx.draw_networkx_nodes(g, pos, node_color=list(colors.values()))
     nx.draw_networkx_edges(g, pos)
     nx.draw_networkx_labels(g, pos, labels)
+
+
+if __name__ == "__main__":
+    def main():
+        import pathlib
+        import time
+
+        import load
+        import mappings
+
+        csv.field_size_limit(2147483647)
+        resources_dir = pathlib.Path(__file__).parent.parent / "resources"
+        num_largest = 100
+        num_repetitions = 5
+
+        models = []
+        for models_file in (resources_dir / "models" / "selected").iterdir():
+            if models_file.suffix != ".csv":
+                continue
+            models.extend(m.model_json for m in load.load_raw_models(models_file))
+
+        def count_shapes(shape: typing.Dict) -> int:
+            return 1 + sum(count_shapes(c) for c in shape.get("childShapes", []))
+
+        models = sorted(models, key=count_shapes, reverse=True)[:num_largest]
+        num_shapes = sum(count_shapes(m) for m in models)
+        print(f"Converting the {len(models)} largest models with {num_shapes} shapes in total.")
+
+        stencil_mapping = mappings.SapSamMappingCollection().all
+        best = float("inf")
+        for _ in range(num_repetitions):
+            start = time.process_time()
+            for model in models:
+                sam_json_to_networkx(model, stencil_mapping)
+            best = min(best, time.process_time() - start)
+        print(f"Best of {num_repetitions}: {best:.3f}s, {num_shapes / best:.0f} shapes/s")
+
+    main()
@@ -400,7 +400,7 @@ class PetImporter:
 
         @staticmethod
         def read_entity_from_dict(json_entity: typing.Dict) -> PetEntity:
-            return PetEntity(json_entity["mentionIndices"])
+            return PetEntity(tuple(json_entity["mentionIndices"]))
 
         @staticmethod
         def read_relations_from_dict(
@@ -1,24 +1,27 @@
 import abc
-import base64
 import pathlib
 import typing
 
-import dotenv
 import openai
 from openai.types.chat import ChatCompletionUserMessageParam, ChatCompletionContentPartTextParam, \
     ChatCompletionContentPartImageParam, ChatCompletionContentPartParam, ChatCompletionDeveloperMessageParam
 from openai.types.chat.chat_completion_content_part_image_param import ImageURL
 
+import cache
+import images
 import load
 import prompts
-
-dotenv.load_dotenv()
+import registry
 
 
 class BaseLLMDescriber(abc.ABC):
-    def __init__(self, client: openai.OpenAI, model: str):
+    def __init__(self, client: openai.OpenAI, model: str,
+                 response_cache: typing.Optional[cache.ResponseCache] = None,
+                 prompt_layout: prompts.PromptLayout = "default"):
         self.client = client
         self.model = model
+        self.response_cache = response_cache
+        self.prompt_layout = prompt_layout
         self._prompt_dir = pathlib.Path(__file__).parent.parent / "resources" / "prompts"
         self._prompt_template = self.get_prompt_template()
 
@@ -43,10 +46,15 @@ class BaseLLMDescriber(abc.ABC):
             )
         ]
         if example is not None:
-            dev_message_content.append(ChatCompletionContentPartTextParam(
+            example_content = ChatCompletionContentPartTextParam(
                 text=example,
                 type="text"
-            ))
+            )
+            if self.prompt_layout == "prefix":
+                # the example is the same for all describers, their prompts are not
+                dev_message_content.insert(0, example_content)
+            else:
+                dev_message_content.append(example_content)
 
         user_message_content: typing.List[ChatCompletionContentPartParam | str] = []
         if image_path is not None:
@@ -62,11 +70,9 @@ class BaseLLMDescriber(abc.ABC):
                     text="The image of the process is as follows:",
                     type="text")
                 )
-            with open(image_path, "rb") as image_file:
-                b64_image = base64.b64encode(image_file.read()).decode("utf-8")
             user_message_content.append(
                 ChatCompletionContentPartImageParam(
-                    image_url=ImageURL(url=f"data:image/png;base64,{b64_image}"),
+                    image_url=ImageURL(url=images.cache.data_url(image_path)),
                     type="image_url"
                 )
             )
@@ -105,9 +111,12 @@ class BaseLLMDescriber(abc.ABC):
             example=example,
             reasoning_effort=reasoning_effort
         )
-        resp = self.client.chat.completions.create(
-            **request_params
-        )
+        if self.response_cache is not None:
+            resp = self.response_cache.complete(self.client, request_params)
+        else:
+            resp = self.client.chat.completions.create(
+                **request_params
+            )
 
         return load.LLMCompletion(text=resp.choices[0].message.content,
                                   prompt_tokens=resp.usage.prompt_tokens,
@@ -133,7 +142,7 @@ if __name__ == "__main__":
     def main():
         model = "gpt-5-mini-2025-08-07"
         # model = "gpt-5-nano-2025-08-07"
-        describer = LLMPictureDescriber(client=openai.OpenAI(), model=model)
+        describer = LLMPictureDescriber(client=registry.openai_client(), model=model)
         plausible_models_path = pathlib.Path(__file__).parent.parent / "resources" / "plausible" / "models"
         img_path = plausible_models_path / "0" / "images" / "Week 4 Task 2.png"
         describer.describe(img_path)
@@ -0,0 +1,178 @@
+import base64
+import collections
+import dataclasses
+import hashlib
+import io
+import math
+import pathlib
+import typing
+
+# rough size of an image in tokens, a high detail image of 1024x1024 pixels, for images of unknown size
+unknown_image_tokens = 765
+
+
+def image_tokens(width: int, height: int) -> int:
+    """
+    Prompt tokens of a high detail image, it is scaled to fit into 2048x2048 pixels, then its shortest
+    side to 768 pixels, and costs 170 tokens per tile of 512x512 pixels, plus 85 tokens.
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+@dataclasses.dataclass
+class ImagePayload:
+    url: str
+    original_bytes: int
+    original_tokens: int
+    tokens: int
+
+    @property
+    def bytes(self) -> int:
+        return len(self.url)
+
+
+@dataclasses.dataclass
+class ImageSavings:
+    num_images: int = 0
+    original_bytes: int = 0
+    bytes: int = 0
+    original_tokens: int = 0
+    tokens: int = 0
+
+    def add(self, payload: ImagePayload) -> None:
+        self.num_images += 1
+        self.original_bytes += payload.original_bytes
+        self.bytes += payload.bytes
+        self.original_tokens += payload.original_tokens
+        self.tokens += payload.tokens
+
+    def update(self, other: "ImageSavings") -> None:
+        self.num_images += other.num_images
+        self.original_bytes += other.original_bytes
+        self.bytes += other.bytes
+        self.original_tokens += other.original_tokens
+        self.tokens += other.tokens
+
+    def __str__(self):
+        return (f"{self.num_images} images, {self.original_bytes - self.bytes} bytes saved "
+                f"({self.original_bytes} -> {self.bytes}), "
+                f"{self.original_tokens - self.tokens} image tokens saved "
+                f"({self.original_tokens} -> {self.tokens})")
+
+
+class ImageCache:
+    """
+    Encodes images to data URLs for requests once, and reuses them for all versions and stages
+    that send the same image. Images larger than max_side pixels are downscaled, and, if format
+    is given, recompressed, e.g., to JPEG with the given quality. Without either, the original
+    file is sent unchanged.
+
+    Only the data URLs of the max_entries most recently used images are kept, requests are built
+    model by model, so all versions of a model share one encoding. Sizes and tokens of all images
+    encoded are kept by a digest of their data URL, for lookup.
+    """
+
+    def __init__(self,
+                 *,
+                 max_side: typing.Optional[int] = None,
+                 format: typing.Optional[typing.Literal["PNG", "JPEG", "WEBP"]] = None,
+                 quality: int = 85,
+                 max_entries: int = 64):
+        self._max_side = max_side
+        self._format = format
+        self._quality = quality
+        self._max_entries = max_entries
+        self._by_path: typing.OrderedDict[typing.Tuple[str, int, int], ImagePayload] = collections.OrderedDict()
+        # original bytes, original tokens and tokens of each data URL
+        self._by_digest: typing.Dict[bytes, typing.Tuple[int, int, int]] = {}
+
+    @staticmethod
+    def _digest(url: str) -> bytes:
+        return hashlib.sha256(url.encode("utf-8")).digest()
+
+    def _encode(self, image_path: pathlib.Path) -> ImagePayload:
+        # pillow is only needed for the first image
+        from PIL import Image, UnidentifiedImageError
+
+        original = image_path.read_bytes()
+        original_url = f"data:image/png;base64,{base64.b64encode(original).decode('utf-8')}"
+        try:
+            image = Image.open(io.BytesIO(original))
+        except UnidentifiedImageError:
+            print(f"Could not read image {image_path}, sending it unchanged.")
+            return ImagePayload(url=original_url, original_bytes=len(original_url),
+                                original_tokens=unknown_image_tokens, tokens=unknown_image_tokens)
+        with image:
+            original_tokens = image_tokens(image.width, image.height)
+            resize = self._max_side is not None and max(image.size) > self._max_side
+            if not resize and self._format is None:
+                return ImagePayload(url=original_url, original_bytes=len(original_url),
+                                    original_tokens=original_tokens, tokens=original_tokens)
+
+            image_format = self._format or "PNG"
+            if image_format == "JPEG" and image.mode not in ["RGB", "L"]:
+                image = image.convert("RGB")
+            if resize:
+                image.thumbnail((self._max_side, self._max_side), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, format=image_format, optimize=True, quality=self._quality)
+            tokens = image_tokens(image.width, image.height)
+
+        url = f"data:image/{image_format.lower()};base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+        if not resize and len(url) >= len(original_url):
+            # recompressing did not help
+            url = original_url
+        return ImagePayload(url=url, original_bytes=len(original_url), original_tokens=original_tokens, tokens=tokens)
+
+    def payload(self, image_path: pathlib.Path | str) -> ImagePayload:
+        image_path = pathlib.Path(image_path)
+        stat = image_path.stat()
+        key = (str(image_path.resolve()), stat.st_mtime_ns, stat.st_size)
+        if key in self._by_path:
+            self._by_path.move_to_end(key)
+            return self._by_path[key]
+        payload = self._encode(image_path)
+        self._by_path[key] = payload
+        self._by_digest[self._digest(payload.url)] = (payload.original_bytes, payload.original_tokens, payload.tokens)
+        while len(self._by_path) > self._max_entries:
+            self._by_path.popitem(last=False)
+        return payload
+
+    def data_url(self, image_path: pathlib.Path | str) -> str:
+        return self.payload(image_path).url
+
+    def lookup(self, url: str) -> typing.Optional[ImagePayload]:
+        """
+        Payload of a data URL encoded by this cache, None for all other URLs.
+        """
+        if not url.startswith("data:"):
+            return None
+        found = self._by_digest.get(self._digest(url))
+        if found is None:
+            return None
+        original_bytes, original_tokens, tokens = found
+        return ImagePayload(url=url, original_bytes=original_bytes, original_tokens=original_tokens, tokens=tokens)
+
+    def savings(self, body: typing.Dict) -> ImageSavings:
+        """
+        Savings of the images encoded by this cache in the messages of a chat completion request.
+        """
+        savings = ImageSavings()
+        for message in body["messages"]:
+            if isinstance(message["content"], str):
+                continue
+            for part in message["content"]:
+                if part["type"] != "image_url":
+                    continue
+                payload = self.lookup(part["image_url"]["url"])
+                if payload is not None:
+                    savings.add(payload)
+        return savings
+
+
+# shared by all describers and annotators, replace it to downscale or recompress images
+cache = ImageCache()
@@ -191,7 +191,10 @@ def load_sbvr_models(models_path: pathlib.Path) -> typing.Generator[ModelSBVR, N
 def load_described_models(models_path: pathlib.Path) -> typing.Generator[DescribedModel, None, None]:
     with (open(models_path, "r", encoding="utf-8") as f):
         csv_reader = csv.reader(f, delimiter=",")
-        header = next(csv_reader)
+        # no header, if no model of the file was described yet, see batches.write_described
+        header = next(csv_reader, None)
+        if header is None:
+            return
 
         model_id_index = header.index("Model ID")
         model_name_index = header.index("Name")
@@ -0,0 +1,312 @@
+import asyncio
+import dataclasses
+import json
+import os
+import pathlib
+import random
+import time
+import typing
+import uuid
+
+import openai
+import tqdm
+
+import answers
+import cache
+import images
+
+def estimate_prompt_tokens(body: typing.Dict) -> int:
+    """
+    Estimates the prompt tokens of a chat completion request, about four characters per token.
+    """
+    num_chars = 0
+    num_image_tokens = 0
+    for message in body["messages"]:
+        content = message["content"]
+        if isinstance(content, str):
+            num_chars += len(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                num_chars += len(part["text"])
+            elif part["type"] == "image_url":
+                payload = images.cache.lookup(part["image_url"]["url"])
+                num_image_tokens += images.unknown_image_tokens if payload is None else payload.tokens
+    return num_chars // 4 + num_image_tokens
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute, None disables a limit. Requests reserve their
+    estimated tokens, when they are sent, the difference to the tokens actually used is settled, once
+    the answer arrived.
+    """
+
+    def __init__(self, requests_per_minute: typing.Optional[int], tokens_per_minute: typing.Optional[int]):
+        self._requests_per_minute = requests_per_minute
+        self._tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self._requests_per_minute is not None:
+            self._requests = min(self._requests_per_minute,
+                                 self._requests + elapsed * self._requests_per_minute / 60)
+        if self._tokens_per_minute is not None:
+            self._tokens = min(self._tokens_per_minute,
+                               self._tokens + elapsed * self._tokens_per_minute / 60)
+
+    async def acquire(self, tokens: int) -> None:
+        # the lock keeps requests in order of arrival, large requests are not starved by small ones
+        async with self._lock:
+            if self._tokens_per_minute is not None:
+                # larger requests would wait forever
+                tokens = min(tokens, self._tokens_per_minute)
+            while True:
+                self._refill()
+                wait = 0.0
+                if self._requests_per_minute is not None and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self._requests_per_minute)
+                if self._tokens_per_minute is not None and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self._tokens_per_minute)
+                if wait == 0:
+                    break
+                await asyncio.sleep(wait)
+            self._requests -= 1
+            self._tokens -= tokens
+
+    def settle(self, reserved_tokens: int, used_tokens: int) -> None:
+        self._refill()
+        self._tokens -= used_tokens - reserved_tokens
+
+
+@dataclasses.dataclass
+class OnlineStats:
+    num_requests: int = 0
+    num_skipped: int = 0
+    num_failed: int = 0
+    num_retries: int = 0
+    num_cached: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in [408, 409, 429] or error.status_code >= 500
+    return False
+
+
+def _retry_after(error: Exception) -> typing.Optional[float]:
+    if not isinstance(error, openai.APIStatusError):
+        return None
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class OnlineRunner:
+    """
+    Answers chat completion requests, formatted as lines of batch files (see batches.batch_line),
+    with the online API instead of the batch API. Up to max_concurrency requests are in flight at
+    once, within the given rate limits. Failed requests are retried with exponential backoff and
+    full jitter, if the error is transient. With a response_cache, requests answered before are
+    answered from it.
+
+    Answers are written in the format of batch output files, in the order they complete, so they
+    can be read the same way, e.g., by batches.load_answers_by_model_id. Requests, whose answers
+    are in the output file already, are skipped, so interrupted runs can be resumed, an answer
+    the interruption left incomplete is discarded and requested again.
+    """
+
+    def __init__(self,
+                 client: openai.AsyncOpenAI,
+                 *,
+                 max_concurrency: int = 16,
+                 requests_per_minute: typing.Optional[int] = None,
+                 tokens_per_minute: typing.Optional[int] = None,
+                 max_retries: int = 6,
+                 max_backoff: float = 60.0,
+                 expected_completion_tokens: int = 1000,
+                 response_cache: typing.Optional[cache.ResponseCache] = None):
+        # retries are handled here, with jitter and the rate limiter in mind
+        self._client = client.with_options(max_retries=0)
+        self._max_concurrency = max_concurrency
+        self._limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self._max_retries = max_retries
+        self._max_backoff = max_backoff
+        self._expected_completion_tokens = expected_completion_tokens
+        self._response_cache = response_cache
+
+    async def complete(self, request: typing.Dict, stats: OnlineStats) -> typing.Dict:
+        body = request["body"]
+        if self._response_cache is not None:
+            response = self._response_cache.get(body)
+            if response is not None:
+                stats.num_cached += 1
+                return answers.answer_line(request["custom_id"], response, source="cached")
+        reserved_tokens = estimate_prompt_tokens(body) + self._expected_completion_tokens
+        attempt = 0
+        while True:
+            await self._limiter.acquire(reserved_tokens)
+            try:
+                response = await self._client.chat.completions.create(**body)
+            except Exception as e:
+                # failed requests use no tokens
+                self._limiter.settle(reserved_tokens, 0)
+                if not _is_retryable(e) or attempt >= self._max_retries:
+                    raise
+                backoff = random.uniform(0, min(self._max_backoff, 2 ** attempt))
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    backoff = max(backoff, retry_after)
+                attempt += 1
+                stats.num_retries += 1
+                await asyncio.sleep(backoff)
+                continue
+
+            if response.usage is not None:
+                self._limiter.settle(reserved_tokens, response.usage.total_tokens)
+                stats.prompt_tokens += response.usage.prompt_tokens
+                if response.usage.prompt_tokens_details is not None:
+                    stats.cached_tokens += response.usage.prompt_tokens_details.cached_tokens or 0
+                stats.completion_tokens += response.usage.completion_tokens
+            if self._response_cache is not None:
+                self._response_cache.put(body, response.model_dump(mode="json"))
+            return answers.answer_line(request["custom_id"], response.model_dump(mode="json"),
+                                       source="online", request_id=response._request_id)
+
+    @staticmethod
+    def error_line(request: typing.Dict, error: Exception) -> typing.Dict:
+        response = None
+        if isinstance(error, openai.APIStatusError):
+            response = {"status_code": error.status_code, "body": error.body}
+        return {
+            "id": f"online_{uuid.uuid4().hex}",
+            "custom_id": request["custom_id"],
+            "response": response,
+            "error": {"code": type(error).__name__, "message": str(error)},
+        }
+
+    @staticmethod
+    def _answered_ids(out_file: pathlib.Path) -> typing.Set[str]:
+        if not out_file.exists():
+            return set()
+        answered = set()
+        with open(out_file, "r", encoding="utf-8") as f:
+            for line in f:
+                answered.add(json.loads(line)["custom_id"])
+        return answered
+
+    async def run(self,
+                  requests: typing.Iterable[typing.Dict],
+                  *,
+                  out_file: pathlib.Path,
+                  error_file: typing.Optional[pathlib.Path] = None) -> OnlineStats:
+        stats = OnlineStats()
+        # new lines are appended, an incomplete last line of an interrupted run would corrupt the first
+        for path in [out_file, error_file]:
+            if path is not None and path.exists():
+                _truncate_incomplete_line(path)
+        answered = self._answered_ids(out_file)
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        if error_file is not None:
+            error_file.parent.mkdir(parents=True, exist_ok=True)
+        semaphore = asyncio.BoundedSemaphore(self._max_concurrency)
+
+        with open(out_file, "a", encoding="utf-8") as out_f, tqdm.tqdm() as progress:
+            error_f = None if error_file is None else open(error_file, "a", encoding="utf-8")
+
+            async def _answer(request: typing.Dict) -> None:
+                try:
+                    line = await self.complete(request, stats)
+                    out_f.write(json.dumps(line) + "\n")
+                    out_f.flush()
+                except Exception as e:
+                    stats.num_failed += 1
+                    print(f"Request {request['custom_id']} failed: {e}")
+                    if error_f is not None:
+                        error_f.write(json.dumps(self.error_line(request, e)) + "\n")
+                        error_f.flush()
+                finally:
+                    semaphore.release()
+                    progress.update()
+
+            try:
+                tasks = set()
+                for request in requests:
+                    if request["custom_id"] in answered:
+                        stats.num_skipped += 1
+                        continue
+                    # requests are only created, once one of the max_concurrency slots is free
+                    await semaphore.acquire()
+                    stats.num_requests += 1
+                    task = asyncio.create_task(_answer(request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await asyncio.gather(*tasks)
+            finally:
+                if error_f is not None:
+                    error_f.close()
+        return stats
+
+
+def _truncate_incomplete_line(path: pathlib.Path, chunk_size: int = 1 << 16) -> int:
+    """
+    Cuts off the last line of a jsonl file, if it was written only partially, i.e., does not end
+    with a newline, e.g., because a run was interrupted. Returns the size of the remaining file.
+    """
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            print(f"Discarding incomplete line at the end of {path.name}.")
+            f.truncate(end)
+        return end
+
+
+def read_requests(batch_file_path: pathlib.Path) -> typing.Iterator[typing.Dict]:
+    with open(batch_file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            yield json.loads(line)
+
+
+def answer_online(batch_files: typing.List[typing.Tuple[pathlib.Path, pathlib.Path, typing.Optional[pathlib.Path]]],
+                  *,
+                  client: openai.AsyncOpenAI,
+                  **runner_args) -> OnlineStats:
+    """
+    Answers all requests of the given batch files with the online API, see OnlineRunner. Files are
+    given as (batch file, output file, error file) and answered one after the other, within the
+    same rate limits.
+    """
+    runner = OnlineRunner(client, **runner_args)
+
+    async def _answer_all() -> OnlineStats:
+        total = OnlineStats()
+        for batch_file_path, out_file, error_file in batch_files:
+            stats = await runner.run(read_requests(batch_file_path), out_file=out_file, error_file=error_file)
+            for field in dataclasses.fields(OnlineStats):
+                setattr(total, field.name, getattr(total, field.name) + getattr(stats, field.name))
+        return total
+
+    return asyncio.run(_answer_all())
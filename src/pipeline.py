@@ -0,0 +1,479 @@
+import asyncio
+import concurrent.futures
+import csv
+import dataclasses
+import json
+import pathlib
+import time
+import typing
+from datetime import datetime
+
+import openai
+from openai.types import Batch
+
+import annotate
+import answers
+import batches
+import cache
+import data
+import load
+import online
+import prompts
+import registry
+
+stages = ["descriptions", "mentions", "entities", "relations"]
+
+# prefixes of custom ids of requests of each stage, see batches.description_request and BaseAnnotator.batch_line
+_custom_id_prefixes = {
+    "descriptions": "describe",
+    "mentions": "LLMMentionAnnotator",
+    "entities": "LLMEntitiesAnnotator",
+    "relations": "LLMRelationsAnnotator",
+}
+_stages_by_prefix = {prefix: stage for stage, prefix in _custom_id_prefixes.items()}
+
+@dataclasses.dataclass(frozen=True)
+class RequestKey:
+    stage: str
+    model_id: str
+    version: str
+
+    @property
+    def custom_id(self) -> str:
+        return f"{_custom_id_prefixes[self.stage]}-{self.model_id}-{self.version}"
+
+    @staticmethod
+    def from_custom_id(custom_id: str) -> typing.Optional["RequestKey"]:
+        parts = custom_id.split("-", maxsplit=2)
+        if len(parts) != 3 or parts[0] not in _stages_by_prefix:
+            return None
+        prefix, model_id, version = parts
+        return RequestKey(_stages_by_prefix[prefix], model_id, version)
+
+
+def description_version(version: str) -> str:
+    # annotations without hints are based on descriptions of the SBVR
+    return "sbvr" if version == "no_hints" else version
+
+
+class Pipeline:
+    """
+    Describes and annotates models, one chain of requests per model and version, i.e., description,
+    mentions, entities and relations. The request of the next stage of a chain is queued as soon as
+    the answer of its previous stage arrived, instead of waiting for all models to finish a stage.
+    Queued requests of all stages are packed into new batches continuously, or answered online, so
+    a single slow batch only delays the chains in it.
+
+    All state is kept in work_dir, in the layout batches uses for batch files, i.e., inputs,
+    manifests, ids, infos, outputs, so interrupted runs continue where they stopped, batch files
+    without a manifest were not packed completely and are discarded. Documents are written to
+    out_directory / version / <name of the SBVR file>.jsonl, once their chain completed.
+    """
+
+    def __init__(self,
+                 *,
+                 sbvr_files: typing.List[pathlib.Path],
+                 versions: typing.List[typing.Literal["sbvr", "image", "combined", "no_hints"]],
+                 work_dir: pathlib.Path,
+                 out_directory: pathlib.Path,
+                 client: openai.OpenAI,
+                 describe_model: str,
+                 annotate_model: str,
+                 example: typing.Optional[str],
+                 online_client: typing.Optional[openai.AsyncOpenAI] = None,
+                 min_batch_size: int = 100,
+                 max_batch_size: int = batches.max_batch_file_requests,
+                 max_batch_tokens: typing.Optional[int] = None,
+                 max_batch_wait: float = 600,
+                 poll_interval: float = 30,
+                 max_attempts: int = 3,
+                 documents: typing.Optional[batches.DocumentStore] = None,
+                 response_cache: typing.Optional[cache.ResponseCache] = None,
+                 prompt_layout: prompts.PromptLayout = "default",
+                 **runner_args):
+        """
+        Without online_client, requests are sent in batches. A new batch is started, once min_batch_size
+        requests are queued, the oldest queued request waited for max_batch_wait seconds, or nothing
+        else is in flight, that could add more requests. Started batches are split into shards of at
+        most max_batch_size requests and max_batch_tokens estimated prompt tokens, see batches.BatchPacker.
+
+        With a response_cache, requests answered before are answered from it, in both modes.
+        prompt_layout orders the parts of requests, see prompts.PromptLayout.
+        """
+        self._versions = [v for v in batches.annotation_versions if v in versions]
+        self._work_dir = work_dir
+        self._out_directory = out_directory
+        self._client = client
+        self._describe_model = describe_model
+        self._example = example
+        self._min_batch_size = min_batch_size
+        self._max_batch_size = max_batch_size
+        self._max_batch_tokens = max_batch_tokens
+        self._max_batch_wait = max_batch_wait
+        self._poll_interval = poll_interval
+        self._max_attempts = max_attempts
+        self._documents = documents if documents is not None else batches.DocumentStore()
+        self._response_cache = response_cache
+        self._prompt_layout = prompt_layout
+
+        self._online_client = online_client
+        self._runner: typing.Optional[online.OnlineRunner] = None
+        self._max_concurrency = runner_args.get("max_concurrency", 16)
+        if online_client is not None:
+            self._runner = online.OnlineRunner(online_client, response_cache=response_cache, **runner_args)
+        self.online_stats = online.OnlineStats()
+        self.batch_usage = answers.TokenUsage()
+
+        self._mentions_annotator = annotate.LLMMentionAnnotator(client, annotate_model, reasoning_effort="low",
+                                                                prompt_layout=prompt_layout)
+        self._entities_annotator = annotate.LLMEntitiesAnnotator(client, annotate_model, reasoning_effort="low",
+                                                                 prompt_layout=prompt_layout)
+        self._relations_annotator = annotate.LLMRelationsAnnotator(client, annotate_model, reasoning_effort="low",
+                                                                   prompt_layout=prompt_layout)
+
+        self._models: typing.Dict[str, load.ModelSBVR] = {}
+        self._source_file: typing.Dict[str, str] = {}
+        for sbvr_file in sbvr_files:
+            for model_sbvr in load.load_sbvr_models(sbvr_file):
+                self._models[model_sbvr.model.id] = model_sbvr
+                self._source_file[model_sbvr.model.id] = sbvr_file.stem
+
+        self._answers: typing.Dict[RequestKey, load.LLMCompletion] = {}
+        self._attempts: typing.Dict[RequestKey, int] = {}
+        self._queued: typing.Dict[RequestKey, float] = {}
+        self._in_flight: typing.Set[RequestKey] = set()
+        self._batches: typing.Dict[pathlib.Path, typing.Set[RequestKey]] = {}
+        self._poller = batches.BatchPoller(client)
+        self._written: typing.Set[typing.Tuple[str, str]] = set()
+        self._tasks: typing.Set[asyncio.Task] = set()
+        self._changed: typing.Optional[asyncio.Event] = None
+        self._online_slots: typing.Optional[asyncio.BoundedSemaphore] = None
+        self._num_batches = 0
+        # tokenizing and parsing documents runs on a single thread, off the event loop, so it does not
+        # block answers in flight, and spaCy and the document cache are only ever used by that thread
+        self._documents_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    # --- state ---
+
+    def _record_answers(self, answers_file_path: pathlib.Path) -> None:
+        with open(answers_file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                try:
+                    self._record_answer(json.loads(line))
+                except json.JSONDecodeError:
+                    # incomplete last line of an interrupted online run
+                    continue
+
+    def _record_answer(self, answer_line: typing.Dict) -> None:
+        key = RequestKey.from_custom_id(answer_line["custom_id"])
+        if key is None:
+            return
+        completion = answers.completion_from_line(answer_line)
+        if completion is not None:
+            self._answers[key] = completion
+
+    def _load_state(self) -> None:
+        for answers_file_path in sorted((self._work_dir / "outputs").glob("*.jsonl")):
+            self._record_answers(answers_file_path)
+
+        # the manifest of a batch is written once all its shards are complete
+        packed_shards = set()
+        for path in sorted((self._work_dir / "manifests").glob("*.json")):
+            packed_shards.update(batches.load_manifest(path)["shards"])
+
+        for batch_file_path in sorted((self._work_dir / "inputs").glob("*.jsonl")):
+            if batch_file_path.stem not in packed_shards:
+                # packing was interrupted, the requests are not in flight, so they are queued and packed again
+                print(f"Discarding incomplete batch file {batch_file_path.name}.")
+                batch_file_path.unlink()
+                continue
+            self._num_batches += 1
+            info_path = self._work_dir / "infos" / f"{batch_file_path.stem}.json"
+            keys = set()
+            with open(batch_file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    key = RequestKey.from_custom_id(json.loads(line)["custom_id"])
+                    if key is not None:
+                        keys.add(key)
+            if info_path.exists():
+                with open(info_path, "r", encoding="utf-8") as f:
+                    batch = Batch.model_validate_json(f.read())
+                answered = (self._work_dir / "outputs" / f"{batch_file_path.stem}.jsonl").exists()
+                if batch.status in batches.terminated_batch_statuses and (answered or batch.output_file_id is None):
+                    # finished before, unanswered requests are queued again
+                    continue
+            else:
+                # interrupted before the batch was started
+                batches.start_batch(batch_file_path=batch_file_path, client=self._client)
+            self._batches[info_path] = keys
+            self._poller.add(info_path)
+            self._in_flight.update(keys)
+
+        for version in self._versions:
+            version_directory = self._out_directory / version
+            if not version_directory.exists():
+                continue
+            for docs_file_path in version_directory.glob("*.jsonl"):
+                with open(docs_file_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip() != "":
+                            self._written.add((json.loads(line)["id"], version))
+
+    def _next_request(self, model_id: str, version: str) -> typing.Optional[RequestKey]:
+        for stage in stages:
+            key_version = description_version(version) if stage == "descriptions" else version
+            key = RequestKey(stage, model_id, key_version)
+            if key not in self._answers:
+                return key
+        return None
+
+    def _queue_ready(self) -> None:
+        for model_id in self._models:
+            for version in self._versions:
+                key = self._next_request(model_id, version)
+                if key is None:
+                    continue
+                if key in self._queued or key in self._in_flight:
+                    continue
+                if self._attempts.get(key, 0) >= self._max_attempts:
+                    continue
+                self._queued[key] = time.monotonic()
+
+    def _failed(self, key: RequestKey) -> None:
+        self._attempts[key] = self._attempts.get(key, 0) + 1
+        if self._attempts[key] >= self._max_attempts:
+            print(f"Giving up on {key.custom_id} after {self._attempts[key]} attempts.")
+
+    def _finished(self) -> bool:
+        return len(self._queued) == 0 and len(self._in_flight) == 0
+
+    # --- requests ---
+
+    def _described_model(self, model_id: str) -> load.DescribedModel:
+        model_sbvr = self._models[model_id]
+        return load.DescribedModel(
+            model=model_sbvr.model,
+            sbvr=model_sbvr.sbvr,
+            descriptions=load.ProcessDescriptions(
+                from_sbvr=self._answers.get(RequestKey("descriptions", model_id, "sbvr")),
+                from_picture=self._answers.get(RequestKey("descriptions", model_id, "image")),
+                from_both=self._answers.get(RequestKey("descriptions", model_id, "combined")),
+            )
+        )
+
+    def _annotation_stages(self, model_id: str, version: str, stage: str):
+        answer_stages = [
+            (self._mentions_annotator.parser, "mentions"),
+            (self._entities_annotator.parser, "entities"),
+        ][:stages.index(stage) - 1]
+        return [(parser, self._answers[RequestKey(s, model_id, version)].text) for parser, s in answer_stages]
+
+    def _request(self, key: RequestKey) -> typing.Dict:
+        if key.stage == "descriptions":
+            return batches.description_request(self._models[key.model_id], key.version,
+                                               client=self._client, model=self._describe_model,
+                                               example=self._example, prompt_layout=self._prompt_layout)
+
+        described_model = self._described_model(key.model_id)
+        annotator = {
+            "mentions": self._mentions_annotator,
+            "entities": self._entities_annotator,
+            "relations": self._relations_annotator,
+        }[key.stage]
+        doc = self._documents.parsed(described_model, key.version,
+                                     self._annotation_stages(key.model_id, key.version, key.stage))
+        return batches.annotation_request(annotator, doc, described_model, key.version)
+
+    async def _on_documents_thread(self, function: typing.Callable, *args) -> typing.Any:
+        return await asyncio.get_running_loop().run_in_executor(self._documents_thread, function, *args)
+
+    # --- dispatching ---
+
+    async def _dispatch(self) -> None:
+        if len(self._queued) == 0:
+            return
+        if self._runner is not None:
+            for key in list(self._queued):
+                await self._start_online(key)
+            return
+
+        oldest = min(self._queued.values())
+        waited_long_enough = time.monotonic() - oldest >= self._max_batch_wait
+        nothing_else_coming = len(self._in_flight) == 0
+        if len(self._queued) < self._min_batch_size and not waited_long_enough and not nothing_else_coming:
+            return
+        await self._start_batch(list(self._queued))
+
+    async def _start_online(self, key: RequestKey) -> None:
+        request = await self._on_documents_thread(self._request, key)
+        del self._queued[key]
+        self._in_flight.add(key)
+        task = asyncio.create_task(self._answer_online(key, request))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _answer_online(self, key: RequestKey, request: typing.Dict) -> None:
+        async with self._online_slots:
+            self.online_stats.num_requests += 1
+            try:
+                line = await self._runner.complete(request, self.online_stats)
+                with open(self._work_dir / "outputs" / "online.jsonl", "a", encoding="utf-8") as f:
+                    f.write(json.dumps(line) + "\n")
+                self._record_answer(line)
+            except Exception as e:
+                self.online_stats.num_failed += 1
+                print(f"Request {key.custom_id} failed: {e}")
+                with open(self._work_dir / "errors" / "online.jsonl", "a", encoding="utf-8") as f:
+                    f.write(json.dumps(self._runner.error_line(request, e)) + "\n")
+                self._failed(key)
+            finally:
+                self._in_flight.discard(key)
+                self._changed.set()
+
+    async def _start_batch(self, keys: typing.List[RequestKey]) -> None:
+        self._num_batches += 1
+        batch_file_path = (self._work_dir / "inputs" /
+                           f"{datetime.now():%Y%m%d%H%M%S}{self._num_batches:05d}.jsonl")
+        packer = batches.BatchPacker(batch_file_path, max_requests=self._max_batch_size,
+                                     max_tokens=self._max_batch_tokens, response_cache=self._response_cache)
+        # built in chunks, so answers that arrive meanwhile are recorded in between
+        for i in range(0, len(keys), 100):
+            chunk = keys[i:i + 100]
+            for request in await self._on_documents_thread(lambda: [self._request(key) for key in chunk]):
+                packer.add(request)
+        manifest = batches.load_manifest(packer.close())
+        shards = manifest["custom_ids"]
+        if manifest["cached"] is not None:
+            self._record_answers(self._work_dir / "outputs" / f"{manifest['cached']}.jsonl")
+            for key in keys:
+                if shards[key.custom_id] == manifest["cached"]:
+                    del self._queued[key]
+            self._changed.set()
+
+        keys_by_shard: typing.Dict[str, typing.Set[RequestKey]] = {}
+        for key in keys:
+            if shards[key.custom_id] != manifest["cached"]:
+                keys_by_shard.setdefault(shards[key.custom_id], set()).add(key)
+        for shard, shard_keys in keys_by_shard.items():
+            await asyncio.to_thread(batches.start_batch, batch_file_path=self._work_dir / "inputs" / f"{shard}.jsonl",
+                                    client=self._client)
+            self._batches[self._work_dir / "infos" / f"{shard}.json"] = shard_keys
+            for key in shard_keys:
+                del self._queued[key]
+                self._in_flight.add(key)
+            self._poller.add(self._work_dir / "infos" / f"{shard}.json")
+            print(f"Started batch {shard} with {len(shard_keys)} requests.")
+
+    async def _download(self, info_path: pathlib.Path) -> None:
+        with open(info_path, "r", encoding="utf-8") as f:
+            batch = Batch.model_validate_json(f.read())
+        await asyncio.to_thread(batches.write_batch_answers, [info_path], client=self._client)
+        answers_file_path = self._work_dir / "outputs" / f"{info_path.stem}.jsonl"
+        # batches without a single successful request have no output file
+        if answers_file_path.exists():
+            self._record_answers(answers_file_path)
+            self.batch_usage.update(answers.token_usage(answers_file_path))
+            if self._response_cache is not None:
+                batches.cache_answers(self._work_dir / "inputs" / f"{info_path.stem}.jsonl", answers_file_path,
+                                      self._response_cache)
+        for key in self._batches.pop(info_path):
+            self._in_flight.discard(key)
+            if key not in self._answers:
+                self._failed(key)
+        print(f"Batch {info_path.stem} {batch.status}.")
+
+    async def _poll_batches(self) -> None:
+        terminated = await asyncio.to_thread(self._poller.poll)
+        # answers of all batches, that terminated in this poll, are downloaded concurrently
+        await asyncio.gather(*[self._download(info_path) for info_path in terminated])
+        if len(terminated) > 0:
+            self._changed.set()
+
+    # --- documents ---
+
+    def _write_documents(self) -> None:
+        for model_id in self._models:
+            for version in self._versions:
+                if (model_id, version) in self._written:
+                    continue
+                relations_answer = self._answers.get(RequestKey("relations", model_id, version))
+                if relations_answer is None:
+                    continue
+                doc = self._documents.parsed(self._described_model(model_id), version,
+                                             self._annotation_stages(model_id, version, "relations"))
+                doc = self._relations_annotator.parser.parse(document=doc, string=relations_answer.text)
+
+                out_file = self._out_directory / version / f"{self._source_file[model_id]}.jsonl"
+                out_file.parent.mkdir(parents=True, exist_ok=True)
+                with open(out_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(data.PetDictExporter().export_document(doc)) + "\n")
+                self._written.add((model_id, version))
+
+    # --- main loop ---
+
+    async def run(self) -> None:
+        for directory in ["inputs", "outputs", "errors"]:
+            (self._work_dir / directory).mkdir(parents=True, exist_ok=True)
+        self._changed = asyncio.Event()
+        self._online_slots = asyncio.BoundedSemaphore(self._max_concurrency)
+        self._load_state()
+
+        num_chains = len(self._models) * len(self._versions)
+        while True:
+            await self._on_documents_thread(self._write_documents)
+            self._queue_ready()
+            if self._finished():
+                break
+            await self._dispatch()
+            if len(self._batches) > 0 and self._poller.next_poll_in() == 0:
+                await self._poll_batches()
+            print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {len(self._written)}/{num_chains} documents, "
+                  f"{len(self._queued)} requests queued, {len(self._in_flight)} in flight, "
+                  f"{len(self._batches)} batches running.")
+            timeout = self._poll_interval
+            if len(self._batches) > 0:
+                timeout = min(timeout, self._poller.next_poll_in())
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+        self._poller.close()
+        self._documents_thread.shutdown()
+
+        if self._runner is not None:
+            print(f"Answered {self.online_stats.num_requests} requests online, {self.online_stats.num_failed} failed, "
+                  f"{self.online_stats.num_retries} retries, {self.online_stats.prompt_tokens} prompt tokens "
+                  f"({self.online_stats.cached_tokens} cached), {self.online_stats.completion_tokens} completion tokens.")
+        if self.batch_usage.num_answers > 0:
+            print(f"Answered in batches: {self.batch_usage}.")
+        if self._response_cache is not None:
+            print(f"{self._response_cache}.")
+
+
+def main():
+    csv.field_size_limit(2147483647)
+    resources_dir = pathlib.Path(__file__).parent.parent / "resources"
+
+    with open(resources_dir / "prompts" / "examples" / "pet-example.txt") as f:
+        example = f.read()
+
+    pipeline = Pipeline(
+        sbvr_files=sorted((resources_dir / "models" / "sbvr").glob("*.csv")),
+        versions=["no_hints"],
+        work_dir=resources_dir / "batches" / "pipeline",
+        out_directory=resources_dir / "docs",
+        client=registry.openai_client(),
+        describe_model="gpt-5-nano-2025-08-07",
+        annotate_model="gpt-5-mini-2025-08-07",
+        example=example,
+        response_cache=cache.ResponseCache(cache.PersistentCache(batches.responses_cache_path)),
+        # online_client=registry.async_openai_client(),
+    )
+    asyncio.run(pipeline.run())
+
+
+if __name__ == "__main__":
+    main()
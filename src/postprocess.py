@@ -1,18 +1,94 @@
 import abc
 import csv
+import dataclasses
 import json
 import typing
 import uuid
 
-import matplotlib.pyplot as plt
 import networkx as nx
-import spacy
-from nltk.corpus import wordnet
-from spacy.tokens import Token
 
+import cache
 import conversion
 import mappings
 import patterns
+import registry
+
+if typing.TYPE_CHECKING:
+    import spacy.language
+    import spacy.tokens
+
+
+@dataclasses.dataclass
+class LabelAnalysis:
+    """
+    What processors use from the parse of a label, small enough to be cached instead of parsing again.
+    """
+    # part of speech of the last root token, None if there is no root
+    root_pos: typing.Optional[str]
+    # whether any root token is a verb
+    has_verb_root: bool
+    # text of the subtree of the first noun, that is a direct object
+    noun_object: typing.Optional[str]
+    # part of speech of the root of the first sentence, None if there is no sentence
+    first_sentence_root_pos: typing.Optional[str]
+
+    @staticmethod
+    def from_doc(doc: "spacy.tokens.Doc") -> "LabelAnalysis":
+        root_pos = None
+        has_verb_root = False
+        noun_object = None
+        for token in doc:
+            if token.dep_ == "ROOT":
+                root_pos = token.pos_
+                if token.pos_ == "VERB":
+                    has_verb_root = True
+            if noun_object is None and token.dep_ == "dobj" and token.pos_ == "NOUN":
+                subtokens = sorted(token.subtree, key=lambda x: x.idx)
+                noun_object = "".join(t.text_with_ws for t in subtokens)
+        first_sentence = next(doc.sents, None)
+        return LabelAnalysis(
+            root_pos=root_pos,
+            has_verb_root=has_verb_root,
+            noun_object=noun_object,
+            first_sentence_root_pos=None if first_sentence is None else first_sentence.root.pos_
+        )
+
+
+class LabelAnalyzer:
+    """
+    Analyses labels with the given spaCy model, parsing only labels, whose analysis is not in the
+    cache yet. Analyses are cached per model name and version, the model itself is only loaded,
+    once a label is not in the cache.
+    """
+
+    def __init__(self, model_name: str,
+                 label_cache: typing.Optional[cache.PersistentCache] = None,
+                 unused_pipes: typing.Optional[typing.List[str]] = None):
+        if label_cache is None:
+            label_cache = cache.PersistentCache(None)
+        self._model_name = model_name
+        self._cache = label_cache
+        self._namespace = f"label-analysis/{registry.spacy_model_key(model_name)}"
+        self._unused_pipes = unused_pipes or []
+
+    def analyse_all(self, labels: typing.Iterable[str]) -> typing.Dict[str, LabelAnalysis]:
+        labels = list(dict.fromkeys(labels))
+        analyses = {
+            label: LabelAnalysis(**analysis)
+            for label, analysis in self._cache.get_many(self._namespace, labels).items()
+        }
+        missing = [label for label in labels if label not in analyses]
+        if len(missing) == 0:
+            return analyses
+
+        docs = registry.parse(self._model_name, missing, disable=self._unused_pipes)
+        parsed = {label: LabelAnalysis.from_doc(doc) for label, doc in zip(missing, docs)}
+        self._cache.put_many(self._namespace, {label: dataclasses.asdict(a) for label, a in parsed.items()})
+        analyses.update(parsed)
+        return analyses
+
+    def analyse(self, label: str) -> LabelAnalysis:
+        return self.analyse_all([label])[label]
 
 
 class BaseProcessor(abc.ABC):
@@ -20,14 +96,29 @@ class BaseProcessor(abc.ABC):
     def process(self, graph: nx.DiGraph):
         raise NotImplementedError()
 
+    def process_all(self, graphs: typing.List[nx.DiGraph]):
+        """
+        Processes several graphs at once, which processors may do more efficiently than one by one.
+        """
+        for graph in graphs:
+            self.process(graph)
+
 
 class NounActivityProcessor(BaseProcessor):
-    def __init__(self):
-        self._nlp = spacy.load("en_core_web_sm")
+    # only part-of-speech tags and dependencies are used
+    _unused_pipes = ["ner", "lemmatizer"]
+
+    def __init__(self, label_cache: typing.Optional[cache.PersistentCache] = None):
+        if label_cache is None:
+            label_cache = cache.PersistentCache(None)
+        self._cache = label_cache
+        # verb forms depend on the WordNet shipped with nltk, not on the spaCy model
+        self._verb_namespace = f"noun-verb/{registry.wordnet_key()}"
+        self._analyzer = LabelAnalyzer("en_core_web_sm", label_cache, self._unused_pipes)
 
     @staticmethod
     def get_verb_for_noun_activity(label: str) -> typing.Optional[str]:
-        lemmas = wordnet.lemmas(label)
+        lemmas = registry.wordnet().lemmas(label)
         if len(lemmas) == 0:
             # can't resolve, skip this activity
             return None
@@ -37,34 +128,44 @@ class NounActivityProcessor(BaseProcessor):
                     return related_form.name()
         return None
 
-    def process_activity(self, graph: nx.DiGraph, node: str, node_labels: typing.Dict[str, str]):
-        label = node_labels[node]
-        if label.strip() == "":
-            return
-        label_doc = self._nlp(label)
+    def verbs_for_noun_activities(self, labels: typing.List[str]) -> typing.Dict[str, typing.Optional[str]]:
+        verbs = self._cache.get_many(self._verb_namespace, labels)
+        missing = {label: self.get_verb_for_noun_activity(label) for label in labels if label not in verbs}
+        self._cache.put_many(self._verb_namespace, missing)
+        verbs.update(missing)
+        return verbs
 
-        root: typing.Optional[Token] = None
-        for token in label_doc:
-            if token.dep_ == "ROOT":
-                root = token
-                if token.pos_ == "VERB":
-                    return
-
-        assert root is not None, ", ".join(f"{t.text} ({t.dep_})" for t in label_doc) + f" from: '{label}' ({graph.nodes[node]['type']})"
+    @staticmethod
+    def needs_verb(label: str, analysis: LabelAnalysis) -> bool:
+        """
+        Whether the given activity label has no predicate, but is a noun, i.e., should be replaced by a verb.
+        """
+        if analysis.has_verb_root:
+            return False
+        assert analysis.root_pos is not None, f"No root in '{label}' (Activity)"
         # no predicate in this activity label, is it a Noun?
-        if root.pos_ == "NOUN":
-            verb_form = self.get_verb_for_noun_activity(label)
-            if verb_form is not None:
-                node_labels[node] = verb_form
-                nx.set_node_attributes(graph, node_labels, "label")
+        return analysis.root_pos == "NOUN"
 
     def process(self, graph: nx.DiGraph):
-        node_types = nx.get_node_attributes(graph, "type")
-        node_labels = nx.get_node_attributes(graph, "label")
-        for node, node_type in node_types.items():
-            if node_type not in ["Activity"]:
-                continue
-            self.process_activity(graph, node, node_labels)
+        self.process_all([graph])
+
+    def process_all(self, graphs: typing.List[nx.DiGraph]):
+        # analyse the labels of all activities in one batch
+        activities: typing.List[typing.Tuple[nx.DiGraph, str, str]] = []
+        for graph in graphs:
+            for node, attr in graph.nodes(data=True):
+                if attr["type"] not in ["Activity"]:
+                    continue
+                if attr["label"].strip() == "":
+                    continue
+                activities.append((graph, node, attr["label"]))
+
+        analyses = self._analyzer.analyse_all(label for _, _, label in activities)
+        verbs = self.verbs_for_noun_activities([label for label, a in analyses.items() if self.needs_verb(label, a)])
+        for graph, node, label in activities:
+            verb_form = verbs.get(label)
+            if verb_form is not None:
+                graph.nodes[node]["label"] = verb_form
 
 
 class DataObjectAssociationProcessor(BaseProcessor):
@@ -120,35 +221,28 @@ class MultiLineLabelProcessor(BaseProcessor):
 
 
 class DataObjectLabelProcessor(BaseProcessor):
-    def __init__(self):
-        self._nlp = spacy.load("en_core_web_trf")
+    def __init__(self, label_cache: typing.Optional[cache.PersistentCache] = None):
+        self._analyzer = LabelAnalyzer("en_core_web_trf", label_cache)
+
+    @property
+    def _nlp(self) -> "spacy.language.Language":
+        return registry.spacy_model("en_core_web_trf")
 
     def data_object_from_activity(self, activity_label: str) -> typing.Optional[str]:
-        activity_doc = self._nlp(activity_label)
-        for token in activity_doc:
-            if token.dep_ == "dobj" and token.pos_ == "NOUN":
-                subtokens = sorted(token.subtree, key=lambda x: x.idx)
-                return "".join(t.text_with_ws for t in subtokens)
-        return None
+        return self._analyzer.analyse(activity_label).noun_object
 
     def supplement_activity_with_data_object(self, activity_label: str, data_object_label: str) -> typing.Optional[str]:
         pass
 
     def activity_label_well_formed(self, activity_label: str) -> bool:
-        activity_doc = self._nlp(activity_label)
-        has_predicate = False
-        has_object = False
-        for t in activity_doc:
-            if t.dep_ == "ROOT" and t.pos_ == "VERB":
-                has_predicate = True
-            if t.dep_ == "dobj" and t.pos_ == "NOUN":
-                has_object = True
+        analysis = self._analyzer.analyse(activity_label)
+        has_predicate = analysis.has_verb_root
+        has_object = analysis.noun_object is not None
         return has_predicate and has_object
 
     def data_object_well_formed(self, data_object_label) -> bool:
-        data_object_doc = self._nlp(data_object_label)
-        data_object_root = next(data_object_doc.sents).root
-        if data_object_root.pos_ == "NOUN":
+        data_object_root_pos = self._analyzer.analyse(data_object_label).first_sentence_root_pos
+        if data_object_root_pos == "NOUN":
             # assume this is a well-formed data object
             return True
         return False
@@ -156,7 +250,7 @@ class DataObjectLabelProcessor(BaseProcessor):
     def build_labels(self, data_object_label: str, activity_label: str) -> typing.Tuple[str, str]:
         activity_doc = self._nlp(activity_label)
 
-        activity_object: typing.Optional[Token] = None
+        activity_object: typing.Optional["spacy.tokens.Token"] = None
         for token in activity_doc:
             if token.dep_ == "dobj":
                 activity_object = token
@@ -283,6 +377,8 @@ class MessageEventProcessor(BaseProcessor):
 
 if __name__ == "__main__":
     def main():
+        import matplotlib.pyplot as plt
+
         with open("../resources/plausible/models/0.csv", "r", encoding="utf-8") as f:
             csv_reader = csv.reader(f, delimiter=",")
             next(csv_reader)
@@ -2,6 +2,10 @@ import pathlib
 import re
 import typing
 
+# order of the parts of requests, "prefix" puts the parts shared by most requests first, so the
+# provider can answer them from its prompt cache, see BaseAnnotator.get_params
+PromptLayout = typing.Literal["default", "prefix"]
+
 
 class Prompt:
     def __init__(self, template_path: pathlib.Path):
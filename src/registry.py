@@ -0,0 +1,79 @@
+"""
+Resources shared by everything running in a process, i.e., NLP models and the environment, loaded on
+first use, so that importing modules, which might need them, stays fast. Each resource is loaded
+once per process.
+"""
+import importlib.metadata
+import typing
+
+if typing.TYPE_CHECKING:
+    import openai
+    import spacy.language
+    import spacy.tokens
+
+_spacy_models: typing.Dict[str, "spacy.language.Language"] = {}
+_env_loaded = False
+
+
+def spacy_model(model_name: str) -> "spacy.language.Language":
+    if model_name not in _spacy_models:
+        import spacy
+        _spacy_models[model_name] = spacy.load(model_name)
+    return _spacy_models[model_name]
+
+
+def spacy_model_key(model_name: str) -> str:
+    """
+    Name and version of the given spaCy model, read from its package, without loading it, if possible.
+    """
+    try:
+        version = importlib.metadata.version(model_name)
+    except importlib.metadata.PackageNotFoundError:
+        version = spacy_model(model_name).meta["version"]
+    return f"{model_name}=={version}"
+
+
+def parse(model_name: str,
+          texts: typing.Iterable[str],
+          disable: typing.Iterable[str] = ()) -> typing.Iterator["spacy.tokens.Doc"]:
+    """
+    Parses texts with the shared instance of the given model, skipping the given pipes, which
+    callers do not use. Pipes the model does not have are ignored.
+    """
+    nlp = spacy_model(model_name)
+    return nlp.pipe(texts, disable=[p for p in disable if p in nlp.pipe_names])
+
+
+def wordnet():
+    from nltk.corpus import wordnet
+    return wordnet
+
+
+def wordnet_key() -> str:
+    """
+    Version of the WordNet used by wordnet(), i.e., of the nltk package shipping it.
+    """
+    return f"nltk=={importlib.metadata.version('nltk')}"
+
+
+def load_env() -> None:
+    """
+    Loads variables from .env into the environment, e.g., the OpenAI API key.
+    """
+    global _env_loaded
+    if not _env_loaded:
+        import dotenv
+        dotenv.load_dotenv()
+        _env_loaded = True
+
+
+def openai_client() -> "openai.OpenAI":
+    load_env()
+    import openai
+    return openai.OpenAI()
+
+
+def async_openai_client() -> "openai.AsyncOpenAI":
+    load_env()
+    import openai
+    return openai.AsyncOpenAI()
@@ -1,13 +1,11 @@
 import pathlib
 
 import openai
-import dotenv
 from openai.types.chat import ChatCompletionUserMessageParam
 
 import load
 import prompts
-
-dotenv.load_dotenv()
+import registry
 
 
 class LLMRephraser:
@@ -56,6 +54,6 @@ if __name__ == "__main__":
             example = f.read()
         model = "gpt-5-mini-2025-08-07"
         # model = "gpt-5-nano-2025-08-07"
-        rephraser = LLMRephraser(client=openai.OpenAI(), model=model)
+        rephraser = LLMRephraser(client=registry.openai_client(), model=model)
         rephraser.rephrase(text=sbvr, example=example)
     main()
@@ -1,7 +1,15 @@
+import concurrent.futures
 import csv
+import dataclasses
 import enum
+import io
+import itertools
 import json
+import math
+import os
 import pathlib
+import re
+import time
 import typing
 
 import langdetect
@@ -12,6 +20,10 @@ import conversion
 import mappings
 import patterns
 
+# langdetect is randomized, fix its seed so selection is reproducible,
+# regardless of which process checks a model and in what order
+langdetect.DetectorFactory.seed = 0
+
 
 class ConstraintState(enum.Enum):
     HOLDS = 0
@@ -20,6 +32,12 @@ class ConstraintState(enum.Enum):
 
 
 class BaseConstraint:
+    # pinned constraints guard the remaining ones, e.g., against malformed shapes,
+    # and are never moved behind them when scheduling constraints
+    pinned = False
+    # whether update may return VIOLATED, i.e., the constraint may reject a model in the middle of traversing it
+    rejects_on_update = True
+
     def __init__(self):
         self._state = ConstraintState.UNDECIDED
 
@@ -31,11 +49,17 @@ class BaseConstraint:
 
 
 class StencilConstraint(BaseConstraint):
+    pinned = True
+
     def __init__(self, *, allowed_stencils: typing.Set[str], disallowed_stencils: typing.Set[str]):
         super().__init__()
         self._stencils = allowed_stencils
         self._disallowed_stencils = disallowed_stencils
 
+    @property
+    def disallowed_stencils(self) -> typing.Set[str]:
+        return self._disallowed_stencils
+
     def update(self, shape: typing.Dict):
         if "stencil" not in shape or "id" not in shape["stencil"]:
             self._state = ConstraintState.VIOLATED
@@ -60,6 +84,10 @@ class LabelLengthConstraint(BaseConstraint):
         super().__init__()
         self._activity_stencils = activity_stencils
 
+    @property
+    def activity_stencils(self) -> typing.List[str]:
+        return self._activity_stencils
+
     def update(self, shape: typing.Dict):
         if shape["stencil"]["id"] not in self._activity_stencils:
             return self._state
@@ -78,6 +106,8 @@ class LabelLengthConstraint(BaseConstraint):
 
 
 class LanguageConstraint(BaseConstraint):
+    rejects_on_update = False
+
     def __init__(self, allowed_languages: typing.List[str]):
         super().__init__()
         self._text = ""
@@ -116,6 +146,8 @@ class LanguageConstraint(BaseConstraint):
         return ConstraintState.HOLDS
 
 class RequiredStencilConstraint(BaseConstraint):
+    rejects_on_update = False
+
     def __init__(self, required_stencils: typing.Set[str]):
         super().__init__()
         self._stencils = required_stencils
@@ -133,6 +165,8 @@ class RequiredStencilConstraint(BaseConstraint):
         return self._state
 
 class ElementOccurrencesConstraint(BaseConstraint):
+    rejects_on_update = False
+
     def __init__(self,
                  element_min_max: typing.Dict[str, typing.Tuple[int, int]],
                  stencil_mapping: mappings.MappingCollection):
@@ -161,24 +195,36 @@ class ElementOccurrencesConstraint(BaseConstraint):
         return ConstraintState.HOLDS
 
 
-class ConnectivityConstraint(BaseConstraint):
+class GraphConstraint(BaseConstraint):
+    """
+    Constraint that is decided on the process graph of the whole model at once, i.e.,
+    when it sees the root shape. Graphs are provided by the row's ProcessGraphCache,
+    so a model is converted only once, no matter how many graph constraints check it.
+    """
+
     def __init__(self, stencil_mapping: typing.Dict[str, str]):
         super().__init__()
         self._stencil_mapping = stencil_mapping
         self._root_seen = False
 
-    def update(self, shape: typing.Dict):
+    @property
+    def stencil_mapping(self) -> typing.Dict[str, str]:
+        return self._stencil_mapping
+
+    def check(self, g: nx.DiGraph) -> ConstraintState:
+        raise NotImplementedError()
+
+    def update(self, shape: typing.Dict) -> ConstraintState:
+        return self.update_graph(conversion.ProcessGraphCache(shape))
+
+    def update_graph(self, graphs: conversion.ProcessGraphCache) -> ConstraintState:
         if self._root_seen:
-            print("WARN: Connectivity Constraint was called twice, "
-                  "possible with a non-root stencil, which will "
-                  "result in undefined behavior.")
+            print(f"WARN: {self.__class__.__name__} was called twice, "
+                  f"possible with a non-root stencil, which will "
+                  f"result in undefined behavior.")
         self._root_seen = True
-        g = conversion.sam_json_to_networkx(shape, self._stencil_mapping)
-        if nx.is_empty(g):
-            return ConstraintState.VIOLATED
-        if not nx.is_connected(g.to_undirected()):
-            return ConstraintState.VIOLATED
-        return ConstraintState.HOLDS
+        self._state = self.check(graphs.get(self._stencil_mapping))
+        return self._state
 
     def holds_finally(self):
         print(f"WARN: Called holds_finally on {self.__class__.__name__}, "
@@ -187,20 +233,17 @@ class ConnectivityConstraint(BaseConstraint):
         raise AssertionError()
 
 
-class GatewayConnectivityConstraint(BaseConstraint):
-    def __init__(self, stencil_mapping: typing.Dict[str, str]):
-        super().__init__()
-        self._stencil_mapping = stencil_mapping
-        self._root_seen = False
+class ConnectivityConstraint(GraphConstraint):
+    def check(self, g: nx.DiGraph) -> ConstraintState:
+        if nx.is_empty(g):
+            return ConstraintState.VIOLATED
+        if not nx.is_weakly_connected(g):
+            return ConstraintState.VIOLATED
+        return ConstraintState.HOLDS
 
-    def update(self, shape: typing.Dict):
-        if self._root_seen:
-            print("WARN: GatewayConnectivityConstraint was called twice, "
-                  "possible with a non-root stencil, which will "
-                  "result in undefined behavior.")
-        self._root_seen = True
-        g = conversion.sam_json_to_networkx(shape, self._stencil_mapping)
 
+class GatewayConnectivityConstraint(GraphConstraint):
+    def check(self, g: nx.DiGraph) -> ConstraintState:
         for node, node_type in g.nodes(data="type"):
             if node_type not in ["Parallel", "Exclusive"]:
                 continue
@@ -212,27 +255,9 @@ class GatewayConnectivityConstraint(BaseConstraint):
                 return ConstraintState.VIOLATED
         return ConstraintState.HOLDS
 
-    def holds_finally(self):
-        print(f"WARN: Called holds_finally on {self.__class__.__name__}, "
-              f"which should not happen, "
-              f"the first shape should evaluate this constraint.")
-        raise AssertionError()
-
-
-class SequenceFlowConnectivityConstraint(BaseConstraint):
-    def __init__(self, stencil_mapping: typing.Dict[str, str]):
-        super().__init__()
-        self._stencil_mapping = stencil_mapping
-        self._root_seen = False
-
-    def update(self, shape: typing.Dict):
-        if self._root_seen:
-            print("WARN: Connectivity Constraint was called twice, "
-                  "possible with a non-root stencil, which will "
-                  "result in undefined behavior.")
-        self._root_seen = True
-        g = conversion.sam_json_to_networkx(shape, self._stencil_mapping)
 
+class SequenceFlowConnectivityConstraint(GraphConstraint):
+    def check(self, g: nx.DiGraph) -> ConstraintState:
         for node, node_type in g.nodes(data="type"):
             if node_type != "Flow":
                 continue
@@ -242,49 +267,30 @@ class SequenceFlowConnectivityConstraint(BaseConstraint):
                 return ConstraintState.VIOLATED
         return ConstraintState.HOLDS
 
-    def holds_finally(self):
-        print(f"WARN: Called holds_finally on {self.__class__.__name__}, "
-              f"which should not happen, "
-              f"the first shape should evaluate this constraint.")
-        raise AssertionError()
 
-class ReachabilityConstraint(BaseConstraint):
+class ReachabilityConstraint(GraphConstraint):
     def __init__(self, stencil_mapping: mappings.MappingCollection):
-        super().__init__()
-        self._stencil_mapping = stencil_mapping
-        self._root_seen = False
+        super().__init__(stencil_mapping.behaviour)
 
-    def update(self, shape: typing.Dict):
-        if self._root_seen:
-            print("WARN: ExplicitActorConstraint was called twice, "
-                  "possible with a non-root stencil, which will "
-                  "result in undefined behavior.")
-        self._root_seen = True
-        g = conversion.sam_json_to_networkx(shape, self._stencil_mapping.behaviour)
+    def check(self, g: nx.DiGraph) -> ConstraintState:
         start_candidates = [n for n, degree in g.in_degree if degree == 0]
-        for n in g.nodes:
-            if not any(nx.has_path(g, s, n) for s in start_candidates):
-                self._state = ConstraintState.VIOLATED
-                return self._state
-        self._state = ConstraintState.HOLDS
-        return self._state
+        reachable = set(start_candidates)
+        for s in start_candidates:
+            if len(reachable) == len(g):
+                break
+            reachable.update(nx.descendants(g, s))
+        if len(reachable) != len(g):
+            return ConstraintState.VIOLATED
+        return ConstraintState.HOLDS
 
 
-class ExplicitActorConstraint(BaseConstraint):
+class ExplicitActorConstraint(GraphConstraint):
     def __init__(self, stencil_mapping: mappings.MappingCollection, actor_type: str, checked_types: typing.Set[str]):
-        super().__init__()
-        self._stencil_mapping = stencil_mapping
-        self._root_seen = False
+        super().__init__(stencil_mapping.all)
         self._actor_type = actor_type
         self._checked_types = checked_types
 
-    def update(self, shape: typing.Dict):
-        if self._root_seen:
-            print("WARN: ExplicitActorConstraint was called twice, "
-                  "possible with a non-root stencil, which will "
-                  "result in undefined behavior.")
-        self._root_seen = True
-        g = conversion.sam_json_to_networkx(shape, self._stencil_mapping.all)
+    def check(self, g: nx.DiGraph) -> ConstraintState:
         for node, node_type in g.nodes(data="type"):
             if node_type not in self._checked_types:
                 continue
@@ -299,20 +305,12 @@ class ExplicitActorConstraint(BaseConstraint):
         return ConstraintState.HOLDS
 
 
-class ProcessStartConstraint(BaseConstraint):
+class ProcessStartConstraint(GraphConstraint):
     def __init__(self, stencil_mapping: typing.Dict[str, str], allowed_start_types: typing.Set[str]):
-        super().__init__()
-        self._stencil_mapping = stencil_mapping
+        super().__init__(stencil_mapping)
         self._allowed_start_types = allowed_start_types
-        self._root_seen = False
 
-    def update(self, shape: typing.Dict):
-        if self._root_seen:
-            print("WARN: Connectivity Constraint was called twice, "
-                  "possible with a non-root stencil, which will "
-                  "result in undefined behavior.")
-        self._root_seen = True
-        g = conversion.sam_json_to_networkx(shape, self._stencil_mapping)
+    def check(self, g: nx.DiGraph) -> ConstraintState:
         for node, node_type in g.nodes(data="type"):
             if node_type not in self._stencil_mapping.values():
                 continue
@@ -322,44 +320,133 @@ class ProcessStartConstraint(BaseConstraint):
                 return ConstraintState.VIOLATED
         return ConstraintState.HOLDS
 
-    def holds_finally(self):
-        print(f"WARN: Called holds_finally on {self.__class__.__name__}, "
-              f"which should not happen, "
-              f"the first shape should evaluate this constraint.")
-        raise AssertionError()
-
-
-def filter_models(constraint_factories: typing.List[typing.Callable[[], typing.List[BaseConstraint]]],
-                  *,
-                  output_file_path: pathlib.Path,
-                  input_file_path: pathlib.Path):
-
-    def traverse(_shape: typing.Dict,
-                 _constraints: typing.List[BaseConstraint],
-                 _violations: typing.Dict[str, int]) -> bool:
-        satisfied_constraints = []
-        for constraint in _constraints:
-            constraint_state = constraint.update(_shape)
-            if constraint_state == ConstraintState.VIOLATED:
-                if constraint.__class__.__name__ not in _violations:
-                    _violations[constraint.__class__.__name__] = 0
-                _violations[constraint.__class__.__name__] += 1
-                return False
-            if constraint_state == ConstraintState.HOLDS:
-                # remove constraint, no need to check again
-                satisfied_constraints.append(constraint)
-        for s in satisfied_constraints:
-            constraints.remove(s)
-
-        for child in _shape.get("childShapes", []):
-            should_continue = traverse(child, _constraints, _violations)
-            if not should_continue:
-                return False
-        return True
-
-    plausible_models = []
-    total_num_models = 0
 
+class StencilPrefilter:
+    """
+    Finds models containing a stencil the StencilConstraint disallows in the raw text of their json,
+    which is much cheaper than parsing it. Such models are rejected in any case, the prefilter only
+    has to tell which constraint the rejection counts for, so that violation counts stay the same as
+    when traversing the parsed model: Unless a LabelLengthConstraint could reject an activity shape of
+    the model before, this is the StencilConstraint, and the model is never parsed. Otherwise, only the
+    constraints that decide shape by shape are run on the parsed model.
+    """
+
+    # quotes inside json strings are escaped, so these only match actual keys
+    _children_pattern = re.compile(r'"childShapes"\s*:')
+    _properties_pattern = re.compile(r'"properties"\s*:\s*(?=\{)')
+    # json string of at most one character, i.e., a label LabelLengthConstraint may reject
+    _short_name_pattern = re.compile(
+        r'"name"\s*:\s*"(?:[^"\\]|\\u[dD][89abAB][0-9a-fA-F]{2}\\u[dD][c-fC-F][0-9a-fA-F]{2}|\\u[0-9a-fA-F]{4}|\\.)?"'
+    )
+    _next_stencil_pattern = re.compile(r'\s*,\s*"stencil"\s*:\s*\{\s*"id"\s*:\s*"([^"\\]*)"')
+    _previous_stencil_pattern = re.compile(r'"stencil"\s*:\s*\{\s*"id"\s*:\s*"([^"\\]*)"\s*}\s*,\s*$')
+
+    def __init__(self, constraint_factory: typing.Callable[[], typing.List[BaseConstraint]]):
+        self._constraint_factory = constraint_factory
+        constraints = constraint_factory()
+        stencil_constraint = next(c for c in constraints if isinstance(c, StencilConstraint))
+        self.constraint_name = stencil_constraint.__class__.__name__
+        self._stencil_pattern = re.compile(
+            r'"stencil"\s*:\s*\{\s*"id"\s*:\s*"(?:' +
+            "|".join(re.escape(s) for s in sorted(stencil_constraint.disallowed_stencils)) +
+            r')"'
+        )
+        self._activity_stencils = set(
+            s for c in constraints if isinstance(c, LabelLengthConstraint) for s in c.activity_stencils
+        )
+        # other constraints rejecting single shapes may reject the model before, too
+        self._needs_parsing = any(
+            c.rejects_on_update for c in constraints if not isinstance(c, (StencilConstraint, LabelLengthConstraint))
+        )
+        self._decoder = json.JSONDecoder()
+
+    @classmethod
+    def for_factory(cls,
+                    constraint_factory: typing.Callable[[], typing.List[BaseConstraint]]
+                    ) -> typing.Optional["StencilPrefilter"]:
+        stencil_constraints = [c for c in constraint_factory() if isinstance(c, StencilConstraint)]
+        if len(stencil_constraints) != 1 or len(stencil_constraints[0].disallowed_stencils) == 0:
+            return None
+        return cls(constraint_factory)
+
+    def violated_constraint(self, model_json: str) -> typing.Optional[str]:
+        """
+        Returns the name of the constraint, which rejects the given model, if it contains a
+        disallowed stencil, None if it does not or the prefilter can not tell.
+        """
+        if self._stencil_pattern.search(model_json) is None:
+            return None
+        if self._children_pattern.search(model_json) is None:
+            # no children, model is counted as empty
+            return None
+        if not self._needs_parsing and not self._may_have_short_activity_label(model_json):
+            return self.constraint_name
+
+        sam_json = json.loads(model_json)
+        if "childShapes" not in sam_json:
+            return None
+        violations = {}
+        traverse(sam_json, [c for c in self._constraint_factory() if c.rejects_on_update], violations)
+        return next(iter(violations), None)
+
+    def _may_have_short_activity_label(self, model_json: str) -> bool:
+        if len(self._activity_stencils) == 0:
+            return False
+        for name_match in self._short_name_pattern.finditer(model_json):
+            # find the properties object this name belongs to, and the stencil next to it
+            properties_start = model_json.rfind('"properties"', 0, name_match.start())
+            if properties_start == -1:
+                return True
+            properties_match = self._properties_pattern.match(model_json, properties_start)
+            if properties_match is None:
+                return True
+            properties, properties_end = self._decoder.raw_decode(model_json, properties_match.end())
+            if properties_end <= name_match.start() or not isinstance(properties, dict):
+                return True
+            name = properties.get("name")
+            if not isinstance(name, str) or len(name) > 1:
+                # some nested name, which is not checked
+                continue
+            # stencil is either the key right after the properties, or the one right before
+            stencil_match = self._next_stencil_pattern.match(model_json, properties_end)
+            if stencil_match is None:
+                stencil_match = self._previous_stencil_pattern.search(
+                    model_json[max(0, properties_start - 256):properties_start]
+                )
+            if stencil_match is None or stencil_match.group(1) in self._activity_stencils:
+                return True
+        return False
+
+
+def traverse(shape: typing.Dict,
+             constraints: typing.List[BaseConstraint],
+             violations: typing.Dict[str, int],
+             graphs: typing.Optional[conversion.ProcessGraphCache] = None) -> bool:
+    satisfied_constraints = []
+    for constraint in constraints:
+        if graphs is not None and isinstance(constraint, GraphConstraint):
+            constraint_state = constraint.update_graph(graphs)
+        else:
+            constraint_state = constraint.update(shape)
+        if constraint_state == ConstraintState.VIOLATED:
+            if constraint.__class__.__name__ not in violations:
+                violations[constraint.__class__.__name__] = 0
+            violations[constraint.__class__.__name__] += 1
+            return False
+        if constraint_state == ConstraintState.HOLDS:
+            # remove constraint, no need to check again
+            satisfied_constraints.append(constraint)
+    for s in satisfied_constraints:
+        constraints.remove(s)
+
+    for child in shape.get("childShapes", []):
+        should_continue = traverse(child, constraints, violations, graphs)
+        if not should_continue:
+            return False
+    return True
+
+
+def empty_violations(constraint_factories: typing.List[typing.Callable[[], typing.List[BaseConstraint]]]) -> typing.Dict[str, int]:
     constraint_names = [c.__class__.__name__ for cf in constraint_factories for c in cf()]
 
     violations = {c: 0 for c in constraint_names}
@@ -367,40 +454,365 @@ def filter_models(constraint_factories: typing.List[typing.Callable[[], typing.L
         "NotBPMN": 0,
         "Empty": 0
     })
-    with open(input_file_path, "r", encoding="utf8") as f:
-        csvfile = csv.reader(f, delimiter=",", quotechar='"')
-        header = next(csvfile)
-        for row in tqdm(csvfile):
-            total_num_models += 1
-            all_hold = True
-            for constraint_factory in constraint_factories:
-                if not all_hold:
-                    break
-                constraints = constraint_factory()
+    return violations
 
-                if row[8] != "http://b3mn.org/stencilset/bpmn2.0#":
-                    violations["NotBPMN"] += 1
+
+def select_rows(rows: typing.Iterable[typing.List[str]],
+                constraint_factories: typing.List[typing.Callable[[], typing.List[BaseConstraint]]],
+                violations: typing.Dict[str, int]) -> typing.Tuple[typing.List[typing.List[str]], int]:
+    """
+    Checks each SAP-SAM row against the constraints built by the given factories,
+    counts violations into "violations" and returns the plausible rows along with
+    the total number of rows seen.
+    """
+    plausible_models = []
+    total_num_models = 0
+    # stencils of the first factory's constraints can be checked on the raw text,
+    # later factories only see models that passed them anyway
+    prefilter = StencilPrefilter.for_factory(constraint_factories[0]) if len(constraint_factories) > 0 else None
+    for row in rows:
+        total_num_models += 1
+        all_hold = True
+        sam_json: typing.Optional[typing.Dict] = None
+        graphs: typing.Optional[conversion.ProcessGraphCache] = None
+        for constraint_factory in constraint_factories:
+            if not all_hold:
+                break
+            constraints = constraint_factory()
+
+            if row[8] != "http://b3mn.org/stencilset/bpmn2.0#":
+                violations["NotBPMN"] += 1
+                all_hold = False
+                break
+            if sam_json is None and prefilter is not None:
+                violated_constraint = prefilter.violated_constraint(row[4])
+                if violated_constraint is not None:
+                    violations[violated_constraint] += 1
                     all_hold = False
                     break
+            if sam_json is None:
                 sam_json = json.loads(row[4])
-                if "childShapes" not in sam_json:
-                    violations["Empty"] += 1
+                # one graph cache per row, shared by the graph constraints of all factories
+                graphs = conversion.ProcessGraphCache(sam_json)
+            if "childShapes" not in sam_json:
+                violations["Empty"] += 1
+                all_hold = False
+                break
+
+            graph_constraints = [c for c in constraints if isinstance(c, GraphConstraint)]
+            if len(graph_constraints) > 0:
+                graphs.prepare(c.stencil_mapping for c in graph_constraints)
+
+            plausible = traverse(sam_json, constraints, violations, graphs)
+            if not plausible:
+                all_hold = False
+                break
+
+            for c in constraints:
+                if c.holds_finally() != ConstraintState.HOLDS:
                     all_hold = False
+                    violations[c.__class__.__name__] += 1
                     break
 
-                plausible = traverse(sam_json, constraints, violations)
-                if not plausible:
-                    all_hold = False
+        if all_hold:
+            plausible_models.append(row)
+    return plausible_models, total_num_models
+
+
+@dataclasses.dataclass
+class ConstraintProfile:
+    name: str
+    pinned: bool
+    num_models: int = 0
+    num_rejections: int = 0
+    seconds: float = 0.0
+
+    @property
+    def cost(self) -> float:
+        return self.seconds / max(self.num_models, 1)
+
+    @property
+    def rejection_rate(self) -> float:
+        return self.num_rejections / max(self.num_models, 1)
+
+    @property
+    def rank(self) -> float:
+        # expected cost of evaluating this constraint per model it rejects
+        if self.num_rejections == 0:
+            return math.inf
+        return self.cost / self.rejection_rate
+
+
+class ScheduledFactory:
+    """
+    Wraps a constraint factory and returns its constraints in the given order.
+    Picklable, as long as the wrapped factory is, so it can be handed to worker processes.
+    """
+
+    def __init__(self,
+                 constraint_factory: typing.Callable[[], typing.List[BaseConstraint]],
+                 order: typing.List[int]):
+        self._constraint_factory = constraint_factory
+        self._order = order
+
+    def __call__(self) -> typing.List[BaseConstraint]:
+        constraints = self._constraint_factory()
+        return [constraints[i] for i in self._order]
+
+
+def profile_row(sam_json: typing.Dict,
+                constraints: typing.List[BaseConstraint],
+                graphs: conversion.ProcessGraphCache) -> typing.List[typing.Tuple[float, bool]]:
+    """
+    Evaluates each constraint on its own, i.e., without stopping at the first violated one, and
+    returns the seconds spent on it and whether it rejected the model, for each constraint.
+    Pinned constraints are evaluated first, if one of them rejects the model, the remaining
+    constraints are not evaluated and reported with no cost.
+    """
+    seconds = [0.0 for _ in constraints]
+    states = [ConstraintState.UNDECIDED for _ in constraints]
+    pinned = [i for i, c in enumerate(constraints) if c.pinned]
+    unpinned = [i for i, c in enumerate(constraints) if not c.pinned]
+
+    for indices in [pinned, unpinned]:
+        shapes = [sam_json]
+        while len(shapes) > 0 and any(states[i] == ConstraintState.UNDECIDED for i in indices):
+            shape = shapes.pop()
+            for i in indices:
+                if states[i] != ConstraintState.UNDECIDED:
+                    continue
+                start = time.perf_counter()
+                if isinstance(constraints[i], GraphConstraint):
+                    states[i] = constraints[i].update_graph(graphs)
+                else:
+                    states[i] = constraints[i].update(shape)
+                seconds[i] += time.perf_counter() - start
+            # visit children in document order, same as traverse
+            shapes.extend(reversed(shape.get("childShapes", [])))
+
+        for i in indices:
+            if states[i] != ConstraintState.UNDECIDED:
+                continue
+            start = time.perf_counter()
+            states[i] = constraints[i].holds_finally()
+            seconds[i] += time.perf_counter() - start
+
+        if any(states[i] == ConstraintState.VIOLATED for i in indices):
+            break
+
+    return [(t, state == ConstraintState.VIOLATED) for t, state in zip(seconds, states)]
+
+
+def _selection_seconds(rows: typing.List[typing.List[str]],
+                       constraint_factories: typing.List[typing.Callable[[], typing.List[BaseConstraint]]]) -> float:
+    violations = empty_violations(constraint_factories)
+    start = time.perf_counter()
+    select_rows(rows, constraint_factories, violations)
+    return time.perf_counter() - start
+
+
+def schedule_constraints(rows: typing.Iterable[typing.List[str]],
+                         constraint_factories: typing.List[typing.Callable[[], typing.List[BaseConstraint]]]
+                         ) -> typing.List[ScheduledFactory]:
+    """
+    Profiles cost and rejection rate of each constraint on the given sample rows and orders the
+    constraints of each factory by expected cost per rejected model, so that cheap and selective
+    constraints run first and expensive ones are skipped for most of the models that get rejected.
+    Factories keep their order, as later ones may rely on earlier ones, e.g., structure constraints
+    on a model being small enough. Which constraints a model satisfies does not depend on the order,
+    violation counts do, though, as each rejected model counts only for its first violated constraint.
+
+    The reported saving is measured, by selecting the sample rows with select_rows in both orders,
+    alternately, taking the fastest of three runs of each.
+    """
+    rows = list(rows)
+    profiles: typing.List[typing.List[ConstraintProfile]] = [
+        [ConstraintProfile(name=c.__class__.__name__, pinned=c.pinned) for c in cf()]
+        for cf in constraint_factories
+    ]
+    num_models = 0
+    for row in rows:
+        num_models += 1
+        if row[8] != "http://b3mn.org/stencilset/bpmn2.0#":
+            continue
+        sam_json = json.loads(row[4])
+        if "childShapes" not in sam_json:
+            continue
+        graphs = conversion.ProcessGraphCache(sam_json)
+
+        for factory_index, constraint_factory in enumerate(constraint_factories):
+            constraints = constraint_factory()
+            graph_constraints = [c for c in constraints if isinstance(c, GraphConstraint)]
+            if len(graph_constraints) > 0:
+                graphs.prepare(c.stencil_mapping for c in graph_constraints)
+
+            model_measurements = profile_row(sam_json, constraints, graphs)
+            skipped = any(rejected for (_, rejected), c in zip(model_measurements, constraints) if c.pinned)
+            for profile, (seconds, rejected), c in zip(profiles[factory_index], model_measurements, constraints):
+                if skipped and not c.pinned:
+                    continue
+                profile.num_models += 1
+                profile.seconds += seconds
+                profile.num_rejections += int(rejected)
+
+            if any(rejected for _, rejected in model_measurements):
+                break
+
+    scheduled_factories = []
+    print(f"Constraint schedule from a sample of {num_models} models:")
+    print("--------------------------")
+    for constraint_factory, factory_profiles in zip(constraint_factories, profiles):
+        original_order = list(range(len(factory_profiles)))
+        order = sorted(original_order,
+                       key=lambda i: (not factory_profiles[i].pinned,
+                                      factory_profiles[i].rank,
+                                      factory_profiles[i].cost))
+        scheduled_factories.append(ScheduledFactory(constraint_factory, order))
+
+        for i in order:
+            p = factory_profiles[i]
+            print(f"{p.name}: {p.cost * 1000:.3f} ms per model, "
+                  f"rejects {p.rejection_rate:.1%}{' (pinned)' if p.pinned else ''}")
+        print("--------------------------")
+    original_seconds = math.inf
+    scheduled_seconds = math.inf
+    for _ in range(3):
+        original_seconds = min(original_seconds, _selection_seconds(rows, constraint_factories))
+        scheduled_seconds = min(scheduled_seconds, _selection_seconds(rows, scheduled_factories))
+    saved = 1 - scheduled_seconds / original_seconds if original_seconds > 0 else 0.0
+    print(f"Measured selection time per model on the sample: "
+          f"{original_seconds / max(num_models, 1) * 1000:.3f} ms in original order, "
+          f"{scheduled_seconds / max(num_models, 1) * 1000:.3f} ms scheduled ({saved:.1%} saved)")
+    return scheduled_factories
+
+
+def find_record_boundaries(input_file_path: pathlib.Path, offsets: typing.List[int]) -> typing.List[int]:
+    """
+    Returns, for each of the given byte offsets, the offset right after the first csv record
+    that ends at or behind it. A newline ends a record iff the number of quote characters
+    before it is even, which also holds for escaped quotes (""), so a single pass over the raw
+    bytes suffices, no matter how many newlines are hidden in quoted fields.
+    """
+    block_size = 16 * 1024 * 1024
+    pending = sorted(offsets)
+    boundaries = []
+    file_size = input_file_path.stat().st_size
+
+    with open(input_file_path, "rb") as f:
+        block_start = 0
+        num_quotes = 0
+        while len(pending) > 0:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+            block_end = block_start + len(block)
+
+            position = 0
+            quotes_until_position = num_quotes
+            while len(pending) > 0 and pending[0] < block_end:
+                newline = block.find(b"\n", max(pending[0] - block_start, position))
+                if newline == -1:
                     break
+                quotes_until_position += block.count(b'"', position, newline)
+                position = newline + 1
+                if quotes_until_position % 2 == 0:
+                    boundary = block_start + newline + 1
+                    while len(pending) > 0 and pending[0] <= newline + block_start:
+                        boundaries.append(boundary)
+                        pending.pop(0)
+                else:
+                    # newline is part of a quoted field, keep on searching behind it
+                    pending[0] = block_start + newline + 1
+
+            num_quotes += block.count(b'"')
+            block_start = block_end
+
+    # offsets without record end behind them belong to the last record
+    boundaries.extend(file_size for _ in pending)
+    return boundaries
+
+
+def _select_shard(input_file_path: pathlib.Path,
+                  start: int,
+                  end: int,
+                  constraint_factories: typing.List[typing.Callable[[], typing.List[BaseConstraint]]]
+                  ) -> typing.Tuple[typing.List[typing.List[str]], int, typing.Dict[str, int]]:
+    csv.field_size_limit(2147483647)
+    with open(input_file_path, "rb") as f:
+        f.seek(start)
+        shard = f.read(end - start)
+    # decode the same way the sequential reader does, i.e. with universal newlines
+    text = io.TextIOWrapper(io.BytesIO(shard), encoding="utf8")
+    csvfile = csv.reader(text, delimiter=",", quotechar='"')
+    violations = empty_violations(constraint_factories)
+    plausible_models, total_num_models = select_rows(csvfile, constraint_factories, violations)
+    return plausible_models, total_num_models, violations
+
+
+def select_rows_parallel(input_file_path: pathlib.Path,
+                         constraint_factories: typing.List[typing.Callable[[], typing.List[BaseConstraint]]],
+                         violations: typing.Dict[str, int],
+                         *,
+                         num_workers: int,
+                         shard_size: int = 64 * 1024 * 1024) -> typing.Tuple[typing.List[typing.List[str]], int]:
+    """
+    Same as select_rows, but splits the raw csv file into byte-range shards of whole records,
+    which are checked in a pool of worker processes. Results are merged in shard order, so
+    plausible rows and violation counts are the same as when selecting sequentially.
+    Constraint factories have to be picklable, i.e., defined on module level.
+    """
+    file_size = input_file_path.stat().st_size
+    num_shards = max(num_workers, math.ceil(file_size / shard_size))
+    header_end, *shard_ends = find_record_boundaries(
+        input_file_path,
+        [0] + [file_size * i // num_shards for i in range(1, num_shards)]
+    )
+    shard_bounds = sorted(set(b for b in [header_end, *shard_ends, file_size] if b >= header_end))
+    shard_starts = shard_bounds[:-1]
+    shard_ends = shard_bounds[1:]
+
+    plausible_models = []
+    total_num_models = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        shard_results = executor.map(_select_shard,
+                                     itertools.repeat(input_file_path),
+                                     shard_starts,
+                                     shard_ends,
+                                     itertools.repeat(constraint_factories))
+        for shard_plausible, shard_total, shard_violations in tqdm(shard_results, total=len(shard_starts)):
+            plausible_models.extend(shard_plausible)
+            total_num_models += shard_total
+            for c, v in shard_violations.items():
+                if c not in violations:
+                    violations[c] = 0
+                violations[c] += v
+    return plausible_models, total_num_models
+
+
+def filter_models(constraint_factories: typing.List[typing.Callable[[], typing.List[BaseConstraint]]],
+                  *,
+                  output_file_path: pathlib.Path,
+                  input_file_path: pathlib.Path,
+                  num_workers: int = 1,
+                  schedule_sample_size: typing.Optional[int] = None):
+    violations = empty_violations(constraint_factories)
+
+    if schedule_sample_size is not None:
+        with open(input_file_path, "r", encoding="utf8") as f:
+            csvfile = csv.reader(f, delimiter=",", quotechar='"')
+            next(csvfile)
+            sample = list(itertools.islice(csvfile, schedule_sample_size))
+        constraint_factories = schedule_constraints(sample, constraint_factories)
 
-                for c in constraints:
-                    if c.holds_finally() != ConstraintState.HOLDS:
-                        all_hold = False
-                        violations[c.__class__.__name__] += 1
-                        break
+    with open(input_file_path, "r", encoding="utf8") as f:
+        csvfile = csv.reader(f, delimiter=",", quotechar='"')
+        header = next(csvfile)
+        if num_workers <= 1:
+            plausible_models, total_num_models = select_rows(tqdm(csvfile), constraint_factories, violations)
 
-            if all_hold:
-                plausible_models.append(row)
+    if num_workers > 1:
+        plausible_models, total_num_models = select_rows_parallel(input_file_path, constraint_factories, violations,
+                                                                  num_workers=num_workers)
 
     print(f"Number of plausible models: {len(plausible_models)} of a total of {total_num_models}")
     print("Violations per constraint:")
@@ -421,37 +833,42 @@ def filter_models(constraint_factories: typing.List[typing.Callable[[], typing.L
         json.dump(violations, f)
 
 
+def _basic_constraints():
+    mapping = mappings.SapSamMappingCollection()
+    return [
+        StencilConstraint(allowed_stencils=set(mapping.all.keys()) | mapping.ignored,
+                          disallowed_stencils=mapping.disallowed),
+        LabelLengthConstraint(activity_stencils=["Task"]),
+        LanguageConstraint(["en"]),
+        ElementOccurrencesConstraint({
+            "Activity": (8, 40),
+            "StartEvent": (1, 1),
+            "EndEvent": (1, 1),
+            "Gateway": (1, 10),
+            "Actor": (1, 10),
+        }, stencil_mapping=mappings.SimpleSapSamCollection()),
+    ]
+
+
+def _structure_constraints():
+    mapping = mappings.SapSamMappingCollection()
+    return [
+        ConnectivityConstraint(mapping.behaviour),
+        ProcessStartConstraint(mapping.behaviour, {"StartEvent"}),
+        ExplicitActorConstraint(mapping, actor_type="Actor", checked_types={"Activity"}),
+        ReachabilityConstraint(mapping),
+        SequenceFlowConnectivityConstraint(mapping.behaviour),
+        GatewayConnectivityConstraint(mapping.behaviour),
+    ]
 
-if __name__ == "__main__":
-    def _basic_constraints():
-        mapping = mappings.SapSamMappingCollection()
-        return [
-            StencilConstraint(allowed_stencils=set(mapping.all.keys()) | mapping.ignored,
-                              disallowed_stencils=mapping.disallowed),
-            LabelLengthConstraint(activity_stencils=["Task"]),
-            LanguageConstraint(["en"]),
-            ElementOccurrencesConstraint({
-                "Activity": (8, 40),
-                "StartEvent": (1, 1),
-                "EndEvent": (1, 1),
-                "Gateway": (1, 10),
-                "Actor": (1, 10),
-            }, stencil_mapping=mappings.SimpleSapSamCollection()),
-        ]
-
-    def _structure_constraints():
-        mapping = mappings.SapSamMappingCollection()
-        return [
-            ConnectivityConstraint(mapping.behaviour),
-            ProcessStartConstraint(mapping.behaviour, {"StartEvent"}),
-            ExplicitActorConstraint(mapping, actor_type="Actor", checked_types={"Activity"}),
-            ReachabilityConstraint(mapping),
-            SequenceFlowConnectivityConstraint(mapping.behaviour),
-            GatewayConnectivityConstraint(mapping.behaviour),
-        ]
 
+if __name__ == "__main__":
     def main():
         csv.field_size_limit(2147483647)
+        num_workers = os.cpu_count() or 1
+        # profile constraints on this many models per file and run cheap, selective ones first,
+        # changes which constraint a rejected model is counted for, so off for reproducing our numbers
+        schedule_sample_size: typing.Optional[int] = None
 
         raw_models_dir = pathlib.Path(__file__).parent.parent / "resources" / "models" / "raw"
         plausible_models_dir = pathlib.Path(__file__).parent.parent / "resources" / "models" / "selected"
@@ -463,7 +880,9 @@ if __name__ == "__main__":
                 continue
             filter_models([_basic_constraints, _structure_constraints],
                           input_file_path=models_file_path,
-                          output_file_path=out_file_path)
+                          output_file_path=out_file_path,
+                          num_workers=num_workers,
+                          schedule_sample_size=schedule_sample_size)
         print("All done!")
 
         all_violations = {}
@@ -0,0 +1,123 @@
+import pathlib
+import sqlite3
+import typing
+
+
+class PipelineState:
+    """
+    Durable state of batches.main, stored in a SQLite database, so interrupted runs continue where
+    they stopped. Each request, i.e., a stage of a model in a version, is recorded with the shard
+    of the batch it was sent in, and its status:
+
+    - generated: written to a shard, which may not have been started yet
+    - answered: answered by its batch, or from the response cache
+    - failed: its batch failed, or did not answer it, it is generated again by the next run
+
+    Batches, i.e., the requests packed at once for a source, and their shards (see
+    batches.BatchPacker) are recorded as well, shards with their status, one of generated, started,
+    downloaded.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS requests ("
+                "custom_id TEXT PRIMARY KEY, stage TEXT NOT NULL, source TEXT NOT NULL, "
+                "shard TEXT NOT NULL, status TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                "stage TEXT NOT NULL, name TEXT NOT NULL, source TEXT NOT NULL, PRIMARY KEY (stage, name))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS shards ("
+                "stage TEXT NOT NULL, name TEXT NOT NULL, source TEXT NOT NULL, status TEXT NOT NULL, "
+                "PRIMARY KEY (stage, name))"
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def num_batches(self, stage: str, source: str) -> int:
+        rows = self._connection.execute("SELECT COUNT(*) FROM batches WHERE stage = ? AND source = ?",
+                                        [stage, source])
+        return rows.fetchone()[0]
+
+    def record_manifest(self, stage: str, source: str, batch: str, manifest: typing.Dict) -> None:
+        """
+        Records all requests and shards of a freshly packed batch, see batches.BatchPacker.
+        """
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO batches (stage, name, source) VALUES (?, ?, ?)",
+                                     [stage, batch, source])
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO shards (stage, name, source, status) VALUES (?, ?, ?, 'generated')",
+                ((stage, shard, source) for shard in manifest["shards"])
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO requests (custom_id, stage, source, shard, status) VALUES (?, ?, ?, ?, ?)",
+                ((custom_id, stage, source, shard, "answered" if shard == manifest["cached"] else "generated")
+                 for custom_id, shard in manifest["custom_ids"].items())
+            )
+
+    def custom_ids(self,
+                   stage: str,
+                   *,
+                   source: typing.Optional[str] = None,
+                   statuses: typing.Optional[typing.List[str]] = None) -> typing.Set[str]:
+        query = "SELECT custom_id FROM requests WHERE stage = ?"
+        parameters = [stage]
+        if source is not None:
+            query += " AND source = ?"
+            parameters.append(source)
+        if statuses is not None:
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            parameters.extend(statuses)
+        return {custom_id for custom_id, in self._connection.execute(query, parameters)}
+
+    def shards(self,
+               stage: str,
+               *,
+               source: typing.Optional[str] = None,
+               statuses: typing.Optional[typing.List[str]] = None) -> typing.List[str]:
+        query = "SELECT name FROM shards WHERE stage = ?"
+        parameters = [stage]
+        if source is not None:
+            query += " AND source = ?"
+            parameters.append(source)
+        if statuses is not None:
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            parameters.extend(statuses)
+        return [name for name, in self._connection.execute(query + " ORDER BY name", parameters)]
+
+    def answer_shards(self, stage: str, source: str) -> typing.List[str]:
+        """
+        Names of all shards, including those of cached answers, with answered requests of a source.
+        """
+        rows = self._connection.execute(
+            "SELECT DISTINCT shard FROM requests WHERE stage = ? AND source = ? AND status = 'answered' "
+            "ORDER BY shard",
+            [stage, source]
+        )
+        return [shard for shard, in rows]
+
+    def set_shard_status(self, stage: str, name: str, status: str) -> None:
+        with self._connection:
+            self._connection.execute("UPDATE shards SET status = ? WHERE stage = ? AND name = ?", [status, stage, name])
+
+    def record_answers(self, stage: str, shard: str, answered: typing.Set[str]) -> None:
+        """
+        Marks the requests of a downloaded shard as answered, or failed, if they are not in answered.
+        """
+        with self._connection:
+            rows = self._connection.execute("SELECT custom_id FROM requests WHERE stage = ? AND shard = ?",
+                                            [stage, shard]).fetchall()
+            self._connection.executemany(
+                "UPDATE requests SET status = ? WHERE custom_id = ?",
+                (("answered" if custom_id in answered else "failed", custom_id) for custom_id, in rows)
+            )
+            self._connection.execute("UPDATE shards SET status = 'downloaded' WHERE stage = ? AND name = ?",
+                                     [stage, shard])
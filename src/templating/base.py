@@ -4,6 +4,8 @@ import typing
 
 import networkx as nx
 
+import patterns
+
 
 @dataclasses.dataclass
 class Fact:
@@ -24,12 +26,26 @@ class UnresolvedRule:
     nodes: typing.List[str]
 
 
+class TemplateContext:
+    """
+    Data about a process graph, which all rule templates applied to it share, so it is
+    computed only once per graph. Templates only mark nodes as visited, the structure
+    of the graph must not change while the context is in use.
+    """
+
+    def __init__(self, graph: nx.DiGraph):
+        self.depths: typing.Dict[str, int] = patterns.get_node_depths(graph)
+        self.nodes_by_type: typing.Dict[str, typing.List[str]] = patterns.index_node_types(graph)
+
+
 class BaseRuleTemplate(abc.ABC):
     def __init__(self, include_tags: bool):
         self._include_tags = include_tags
 
     @abc.abstractmethod
-    def generate(self, graph: nx.DiGraph) -> typing.List[UnresolvedRule]:
+    def generate(self,
+                 graph: nx.DiGraph,
+                 context: typing.Optional[TemplateContext] = None) -> typing.List[UnresolvedRule]:
         raise NotImplementedError()
 
 
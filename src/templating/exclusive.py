@@ -40,10 +40,14 @@ class ImplicitMergeTemplate(base.BaseRuleTemplate):
 
         return pattern
 
-    def generate(self, graph: nx.DiGraph) -> typing.List[base.UnresolvedRule]:
+    def generate(self,
+                 graph: nx.DiGraph,
+                 context: typing.Optional[base.TemplateContext] = None) -> typing.List[base.UnresolvedRule]:
+        if context is None:
+            context = base.TemplateContext(graph)
         rules = []
-        matches = patterns.find_graph_pattern(graph, self.pattern())
-        depths = patterns.get_node_depths(graph)
+        matches = patterns.find_graph_pattern(graph, self.pattern(), context.nodes_by_type)
+        depths = context.depths
 
         for match in matches:
             if util.match_is_visited(graph, match):
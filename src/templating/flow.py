@@ -14,11 +14,15 @@ class SequenceFlowTemplate(base.BaseRuleTemplate):
 
         return pattern
 
-    def generate(self, graph: nx.DiGraph) -> typing.List[base.UnresolvedRule]:
+    def generate(self,
+                 graph: nx.DiGraph,
+                 context: typing.Optional[base.TemplateContext] = None) -> typing.List[base.UnresolvedRule]:
+        if context is None:
+            context = base.TemplateContext(graph)
         rules: typing.List[base.UnresolvedRule] = []
-        depths = patterns.get_node_depths(graph)
+        depths = context.depths
 
-        for match in patterns.find_graph_pattern(graph, self.pattern()):
+        for match in patterns.find_graph_pattern(graph, self.pattern(), context.nodes_by_type):
             if util.match_is_visited(graph, match):
                 continue
 
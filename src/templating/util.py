@@ -20,17 +20,15 @@ def match_is_visited(graph: nx.Graph, match: typing.Dict[str, str]) -> bool:
 
 
 def visit_match(graph: nx.Graph, match: typing.Dict[str, str]):
-    visited = nx.get_node_attributes(graph, "visited")
-    for node in match.values():
-        visited[node] = True
-    nx.set_node_attributes(graph, visited, "visited")
+    visit_nodes(graph, list(match.values()))
 
 
 def visit_nodes(graph: nx.Graph, nodes: typing.List[str]):
-    visited = nx.get_node_attributes(graph, "visited")
+    # only touches the given nodes, instead of reading and writing the attribute of all nodes
+    node_attributes = graph.nodes
     for node in nodes:
-        visited[node] = True
-    nx.set_node_attributes(graph, visited, "visited")
+        if node in node_attributes:
+            node_attributes[node]["visited"] = True
 
 
 def match_to_subgraph(graph: nx.Graph, match: typing.Dict[str, str]) -> nx.DiGraph:
@@ -44,16 +42,27 @@ def match_to_subgraph(graph: nx.Graph, match: typing.Dict[str, str]) -> nx.DiGra
 def resolve_reference(ref: base.ForwardReference,
                       rule_id_by_node: typing.Dict[str, int],
                       graph: nx.DiGraph,
-                      with_tags: bool) -> typing.List[str | base.ForwardReference]:
+                      with_tags: bool,
+                      visited_nodes: typing.Optional[typing.Set[str]] = None) -> typing.List[str | base.ForwardReference]:
+    """
+    Resolves the reference to text, or further references. The referenced node is marked as
+    visited, or, if visited_nodes is given, added to it, so callers can mark them all at once.
+    """
+    def _visit():
+        if visited_nodes is None:
+            visit_nodes(graph, [ref.node])
+        else:
+            visited_nodes.add(ref.node)
+
     node_type = graph.nodes[ref.node]["type"]
     if node_type == "StartEvent":
-        nx.set_node_attributes(graph, {ref.node: True}, "visited")
+        _visit()
         return ["the process starts"]
     if node_type == "EndEvent":
-        nx.set_node_attributes(graph, {ref.node: True}, "visited")
+        _visit()
         return ["the process ends"]
     if node_type == "Activity":
-        nx.set_node_attributes(graph, {ref.node: True}, "visited")
+        _visit()
         actor = patterns.get_actor(graph, ref.node)
         actor_label = graph.nodes[actor]["label"]
         node_label = graph.nodes[ref.node]["label"]
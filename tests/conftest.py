@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# modules in src import each other by name, the same as when run from src
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "src"))
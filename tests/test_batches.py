@@ -0,0 +1,164 @@
+import contextlib
+import json
+import pathlib
+import types
+import typing
+
+import pytest
+from openai.types import Batch
+
+import batches
+import state
+
+
+class FakeBatchAPI:
+    """
+    Files and batches endpoints of the OpenAI client, as far as batches uses them. Batches complete
+    on their second retrieve. Requests in fail fail that many times. While interrupt is set, the next
+    retrieve raises KeyboardInterrupt, as if the run was interrupted while waiting.
+    """
+
+    def __init__(self, *, fail: typing.Optional[typing.Dict[str, int]] = None):
+        self.fail = dict(fail or {})
+        self.interrupt = False
+        self.file_contents: typing.Dict[str, bytes] = {}
+        self.input_files: typing.Dict[str, str] = {}
+        self.num_retrieves: typing.Dict[str, int] = {}
+        self.uploaded: typing.List[typing.List[str]] = []
+        self.files = types.SimpleNamespace(
+            create=self._create_file,
+            with_streaming_response=types.SimpleNamespace(content=self._stream_file),
+        )
+        self.batches = types.SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _create_file(self, file, purpose: str):
+        with file:
+            content = file.read()
+        file_id = f"file-{len(self.file_contents)}"
+        self.file_contents[file_id] = content
+        self.uploaded.append([json.loads(line)["custom_id"] for line in content.splitlines()])
+        return types.SimpleNamespace(id=file_id)
+
+    @contextlib.contextmanager
+    def _stream_file(self, file_id: str):
+        content = self.file_contents[file_id]
+        yield types.SimpleNamespace(iter_bytes=lambda: iter([content[:10], content[10:]]))
+
+    def _batch(self, batch_id: str, status: str, **fields) -> Batch:
+        return Batch(id=batch_id, object="batch", endpoint="/v1/chat/completions", completion_window="24h",
+                     created_at=0, input_file_id=self.input_files[batch_id], status=status, **fields)
+
+    def _create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> Batch:
+        batch_id = f"batch-{len(self.input_files)}"
+        self.input_files[batch_id] = input_file_id
+        self.num_retrieves[batch_id] = 0
+        return self._batch(batch_id, "validating")
+
+    def _retrieve_batch(self, batch_id: str) -> Batch:
+        if self.interrupt:
+            self.interrupt = False
+            raise KeyboardInterrupt()
+        self.num_retrieves[batch_id] += 1
+        if self.num_retrieves[batch_id] < 2:
+            return self._batch(batch_id, "in_progress")
+
+        answered, failed = [], []
+        for line in self.file_contents[self.input_files[batch_id]].splitlines():
+            custom_id = json.loads(line)["custom_id"]
+            if self.fail.get(custom_id, 0) > 0:
+                self.fail[custom_id] -= 1
+                failed.append({"id": "batch_req_failed", "custom_id": custom_id, "error": None,
+                               "response": {"status_code": 500, "body": {"error": {"message": "server error"}}}})
+            else:
+                answered.append({"id": "batch_req_answered", "custom_id": custom_id, "error": None,
+                                 "response": {"status_code": 200, "body": {
+                                     "choices": [{"message": {"content": f"answer to {custom_id}"}}],
+                                     "usage": {"prompt_tokens": 10, "completion_tokens": 5},
+                                 }}})
+        fields = {"request_counts": {"total": len(answered) + len(failed), "completed": len(answered),
+                                     "failed": len(failed)}}
+        for lines, field in [(answered, "output_file_id"), (failed, "error_file_id")]:
+            if len(lines) > 0:
+                file_id = f"file-{len(self.file_contents)}"
+                self.file_contents[file_id] = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+                fields[field] = file_id
+        return self._batch(batch_id, "completed", **fields)
+
+
+def custom_ids(source: str) -> typing.List[str]:
+    return [f"describe-{source}{i}-sbvr" for i in range(4)]
+
+
+def generate(source: str, batch_file_path: pathlib.Path, skip: typing.Set[str]) -> None:
+    with batches.BatchPacker(batch_file_path, max_requests=3) as packer:
+        for custom_id in custom_ids(source):
+            if custom_id not in skip:
+                body = {"model": "stub", "messages": [{"role": "user", "content": f"{source} {custom_id}"}]}
+                packer.add(batches.batch_request(custom_id=custom_id, body=body))
+
+
+def answered(answers_file_path: pathlib.Path) -> typing.List[str]:
+    with open(answers_file_path, "r", encoding="utf-8") as f:
+        return sorted(json.loads(line)["custom_id"] for line in f)
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    intervals = {status: 0.01 for status in batches.batch_poll_intervals}
+    monkeypatch.setattr(batches, "batch_poll_intervals", intervals)
+    monkeypatch.setattr(batches, "max_batch_poll_interval", 0.01)
+
+
+@pytest.fixture
+def pipeline_state(tmp_path):
+    pipeline_state = state.PipelineState(tmp_path / "state.sqlite")
+    yield pipeline_state
+    pipeline_state.close()
+
+
+def test_retries_failed_requests(tmp_path, pipeline_state):
+    stage_directory = tmp_path / "descriptions"
+    client = FakeBatchAPI(fail={"describe-a1-sbvr": 1, "describe-a2-sbvr": 3})
+
+    batches.answer_stage(stage_directory, ["a"], generate, client=client, pipeline_state=pipeline_state,
+                         max_attempts=3)
+
+    # two shards of at most 3 requests, then one retry batch per attempt
+    requests = custom_ids("a")
+    assert client.uploaded == [requests[:3], requests[3:], requests[1:3], requests[2:3]]
+    assert pipeline_state.num_batches("descriptions", "a") == 3
+    assert answered(stage_directory / "answers" / "a.jsonl") == [requests[0], requests[1], requests[3]]
+    assert pipeline_state.custom_ids("descriptions", statuses=["failed"]) == {requests[2]}
+    assert answered(stage_directory / "errors" / "a.jsonl") == [requests[2]]
+
+    # the next run only requests what still failed
+    batches.answer_stage(stage_directory, ["a"], generate, client=client, pipeline_state=pipeline_state)
+
+    assert client.uploaded[4:] == [[requests[2]]]
+    assert answered(stage_directory / "answers" / "a.jsonl") == requests
+    assert pipeline_state.custom_ids("descriptions", statuses=["answered"]) == set(requests)
+
+
+def test_resumes_interrupted_stage(tmp_path):
+    stage_directory = tmp_path / "descriptions"
+    client = FakeBatchAPI()
+    client.interrupt = True
+
+    pipeline_state = state.PipelineState(tmp_path / "state.sqlite")
+    with pytest.raises(KeyboardInterrupt):
+        batches.answer_stage(stage_directory, ["a", "b"], generate, client=client, pipeline_state=pipeline_state)
+    pipeline_state.close()
+
+    pipeline_state = state.PipelineState(tmp_path / "state.sqlite")
+    assert pipeline_state.shards("descriptions", statuses=["started"]) == ["a-000", "a-001", "b-000", "b-001"]
+    num_uploaded = len(client.uploaded)
+
+    batches.answer_stage(stage_directory, ["a", "b"], generate, client=client, pipeline_state=pipeline_state)
+
+    # nothing is generated or uploaded again, the batches started before are downloaded
+    assert len(client.uploaded) == num_uploaded
+    assert pipeline_state.num_batches("descriptions", "a") == 1
+    assert pipeline_state.shards("descriptions", statuses=["downloaded"]) == ["a-000", "a-001", "b-000", "b-001"]
+    for source in ["a", "b"]:
+        assert answered(stage_directory / "answers" / f"{source}.jsonl") == custom_ids(source)
+    pipeline_state.close()
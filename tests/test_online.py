@@ -0,0 +1,140 @@
+import http.server
+import json
+import pathlib
+import threading
+import time
+import typing
+
+import openai
+import pytest
+
+import answers
+import batches
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    OpenAI-compatible chat completions endpoint. Answers "answer to <text>" for the text of the last
+    message, requests with "fatal" in their text fail permanently, those with "flaky" are rate
+    limited once.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        text = body["messages"][-1]["content"]
+        server: StubServer = self.server
+        with server.lock:
+            server.num_calls += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            first_call = text not in server.seen
+            server.seen.add(text)
+        try:
+            if "fatal" in text:
+                return self._send(400, {"error": {"message": "bad request", "type": "invalid_request_error"}})
+            if "flaky" in text and first_call:
+                return self._send(429, {"error": {"message": "slow down", "type": "rate_limit"}}, {"retry-after": "0"})
+            # later requests finish first, so answers complete out of order
+            time.sleep(0.05 if text.endswith("0") else 0.01)
+            self._send(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": f"answer to {text}"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+            })
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send(self, status: int, data: typing.Dict, headers: typing.Optional[typing.Dict[str, str]] = None):
+        content = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.seen: typing.Set[str] = set()
+        self.num_calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(stub_server):
+    return openai.AsyncOpenAI(base_url=f"http://127.0.0.1:{stub_server.server_port}/v1", api_key="stub")
+
+
+def write_requests(path: pathlib.Path, texts: typing.List[str]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for i, text in enumerate(texts):
+            body = {"model": "stub", "messages": [{"role": "user", "content": text}]}
+            f.write(batches.batch_line(custom_id=f"describe-m{i}-sbvr", body=body) + "\n")
+
+
+def read_lines(path: pathlib.Path) -> typing.List[typing.Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_answers_concurrently_and_retries(tmp_path, stub_server, client):
+    texts = [f"doc {i}" for i in range(30)]
+    texts[3] = "flaky doc"
+    texts[7] = "fatal doc"
+    write_requests(tmp_path / "inputs" / "f.jsonl", texts)
+
+    batches.write_online_answers([tmp_path / "inputs" / "f.jsonl"], client, max_concurrency=4, max_backoff=0.01)
+
+    assert 1 < stub_server.max_in_flight <= 4
+    answered = read_lines(tmp_path / "outputs" / "f.jsonl")
+    assert len(answered) == 29
+    assert [a["custom_id"] for a in answered] != sorted((a["custom_id"] for a in answered),
+                                                        key=lambda c: int(c.split("-")[1][1:]))
+    errors = read_lines(tmp_path / "errors" / "f.jsonl")
+    assert [e["custom_id"] for e in errors] == ["describe-m7-sbvr"]
+    answers_by_model_id = batches.load_answers_by_model_id(tmp_path / "outputs" / "f.jsonl")
+    assert answers_by_model_id["m3"]["sbvr"].text == "answer to flaky doc"
+    assert answers_by_model_id["m12"]["sbvr"].text == "answer to doc 12"
+
+
+def test_resumes_after_incomplete_last_line(tmp_path, stub_server, client):
+    write_requests(tmp_path / "inputs" / "f.jsonl", [f"doc {i}" for i in range(10)])
+    out_file = tmp_path / "outputs" / "f.jsonl"
+    out_file.parent.mkdir(parents=True)
+    first = answers.answer_line("describe-m0-sbvr", {
+        "choices": [{"message": {"content": "answer to doc 0"}}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5},
+    }, source="online")
+    # the second answer was cut off by the interruption
+    out_file.write_text(json.dumps(first) + "\n" + '{"id": "online_1", "custom_id": "describe-m1-', encoding="utf-8")
+
+    batches.write_online_answers([tmp_path / "inputs" / "f.jsonl"], client, max_concurrency=4)
+
+    answered = read_lines(out_file)
+    assert sorted(a["custom_id"] for a in answered) == sorted(f"describe-m{i}-sbvr" for i in range(10))
+    assert stub_server.num_calls == 9
+    assert batches.load_answers_by_model_id(out_file)["m1"]["sbvr"].text == "answer to doc 1"